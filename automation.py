@@ -0,0 +1,315 @@
+import asyncio
+import heapq
+import math
+import operator
+import threading
+import time
+
+from smarthome import Device, listeners, lock as model_lock
+
+OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+def apply_change(device, settings=None, status=None):
+    """Merge-patch ``settings`` into the device's settings and set ``status``, as one change."""
+    values = {}
+    if settings:
+        values["settings"] = settings
+    if status is not None:
+        values["status"] = status
+    device.merge(**values)
+
+
+class Job:
+    """One pending change: ``settings``/``status`` for ``device`` at ``due``, repeating ``every`` seconds."""
+
+    __slots__ = ("id", "device", "due", "every", "settings", "status", "cancelled")
+
+    def __init__(self, job_id, device, due, every, settings, status):
+        self.id = job_id
+        self.device = device
+        self.due = due
+        self.every = every
+        self.settings = settings
+        self.status = status
+        self.cancelled = False
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "device": self.device.name,
+            "device_id": self.device.id,
+            "due": self.due,
+            "every": self.every,
+            "settings": self.settings,
+            "status": self.status,
+        }
+
+
+class Scheduler:
+    """Applies timed and recurring device changes from inside the process.
+
+    Jobs wait in a heap ordered by due time, so adding one or taking the
+    next costs O(log n) however many are pending, and each wakeup only
+    touches the jobs that are due.  Cancelled jobs are marked and skipped
+    when they surface, and the heap is rebuilt once they make up half of it.
+    A recurring job that missed runs (say, while the process was paused)
+    runs once and moves on to its next slot in the future.
+
+    ``run()`` is the asyncio task that sleeps until the earliest job is due;
+    ``schedule()`` may be called from any thread and wakes it if the new
+    job comes first.  Due jobs are applied under the model lock in a worker
+    thread, and ``after_run`` (if given) is called once a batch is applied.
+    """
+
+    def __init__(self, clock=time.time, after_run=None):
+        self.clock = clock
+        self.after_run = after_run
+        self._heap = []  # (due, job id, job)
+        self._jobs = {}  # job id -> job, for cancelling and listing
+        self._cancelled = 0
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def schedule(self, device, at, settings=None, status=None, every=None):
+        """Queue a change for ``device`` at time ``at`` (and every ``every`` seconds after)."""
+        if not settings and status is None:
+            raise ValueError("A job must change settings or status.")
+        if every is not None and every <= 0:
+            raise ValueError("every must be positive.")
+        with self._lock:
+            self._last_id += 1
+            job = Job(self._last_id, device, float(at), every, settings, status)
+            self._jobs[job.id] = job
+            heapq.heappush(self._heap, (job.due, job.id, job))
+            first = self._heap[0][2] is job
+        if first:
+            self._wake()
+        return job
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            if job is None:
+                return False
+            job.cancelled = True
+            self._cancelled += 1
+            if self._cancelled > 32 and self._cancelled > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+        return True
+
+    def jobs(self):
+        """Pending jobs, soonest first."""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: (job.due, job.id))
+
+    def clear(self):
+        with self._lock:
+            self._heap.clear()
+            self._jobs.clear()
+            self._cancelled = 0
+
+    def next_due(self):
+        with self._lock:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+                self._cancelled -= 1
+            return self._heap[0][0] if self._heap else None
+
+    def run_due(self, now=None):
+        """Apply every job due by ``now``; returns how many were applied."""
+        if now is None:
+            now = self.clock()
+        applied = 0
+        with model_lock:
+            while True:
+                with self._lock:
+                    if not self._heap or self._heap[0][0] > now:
+                        break
+                    due, _, job = heapq.heappop(self._heap)
+                    if job.cancelled:
+                        self._cancelled -= 1
+                        continue
+                    if job.device not in Device.devices:
+                        del self._jobs[job.id]
+                        continue
+                    if job.every is None:
+                        del self._jobs[job.id]
+                    else:
+                        job.due = due + job.every * (math.floor((now - due) / job.every) + 1)
+                        heapq.heappush(self._heap, (job.due, job.id, job))
+                apply_change(job.device, job.settings, job.status)
+                applied += 1
+        if applied and self.after_run is not None:
+            self.after_run()
+        return applied
+
+    async def run(self):
+        """Apply jobs as they fall due until cancelled."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                self._wakeup.clear()
+                due = self.next_due()
+                delay = None if due is None else max(0.0, due - self.clock())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                await asyncio.to_thread(self.run_due)
+        finally:
+            self._loop = None
+
+    def _wake(self):
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:  # the loop has already closed
+            pass
+
+
+class Rule:
+    """When ``watched.data[field] <op> value`` becomes true, change ``target``."""
+
+    __slots__ = ("id", "watched", "field", "op", "value", "target", "settings", "status", "active")
+
+    def __init__(self, rule_id, watched, field, op, value, target, settings, status):
+        self.id = rule_id
+        self.watched = watched
+        self.field = field
+        self.op = op
+        self.value = value
+        self.target = target
+        self.settings = settings
+        self.status = status
+        self.active = False
+
+    def matches(self, data):
+        if self.field not in data:
+            return False
+        try:
+            return bool(OPERATORS[self.op](data[self.field], self.value))
+        except TypeError:  # e.g. a string reading against a numeric threshold
+            return False
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "device": self.watched.name,
+            "device_id": self.watched.id,
+            "field": self.field,
+            "op": self.op,
+            "value": self.value,
+            "target": self.target.name,
+            "target_id": self.target.id,
+            "settings": self.settings,
+            "status": self.status,
+            "active": self.active,
+        }
+
+
+class RuleEngine:
+    """Automation rules evaluated as device data comes in.
+
+    Rules are indexed by the id of the device they watch and then by data
+    field, so a patch to one device's ``data`` only evaluates the rules on
+    the fields it changed, however many rules there are overall (replacing
+    ``data`` outright evaluates all of that device's rules).  A rule
+    fires when its condition becomes true and not again until it has been
+    false in between.  Rules only change ``settings`` and ``status``, never
+    ``data``, so one rule firing can't set off another.
+
+    Call ``attach()`` to start following device changes.
+    """
+
+    def __init__(self):
+        self._rules = {}  # rule id -> Rule
+        self._watching = {}  # device id -> field -> {rule id: Rule}
+        self._last_id = 0
+
+    def __len__(self):
+        return len(self._rules)
+
+    def attach(self):
+        listeners.append(self._on_change)
+
+    def detach(self):
+        if self._on_change in listeners:
+            listeners.remove(self._on_change)
+
+    def add(self, watched, field, op, value, target=None, settings=None, status=None):
+        if op not in OPERATORS:
+            raise ValueError(f"op must be one of {', '.join(OPERATORS)}.")
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ValueError("value must be a finite number.")
+        if not settings and status is None:
+            raise ValueError("A rule must change settings or status.")
+        self._last_id += 1
+        rule = Rule(self._last_id, watched, field, op, value, target or watched, settings, status)
+        rule.active = rule.matches(watched.data)  # only changes from here on fire it
+        self._rules[rule.id] = rule
+        self._watching.setdefault(watched.id, {}).setdefault(field, {})[rule.id] = rule
+        return rule
+
+    def remove(self, rule_id):
+        rule = self._rules.pop(rule_id, None)
+        if rule is None:
+            return False
+        fields = self._watching[rule.watched.id]
+        del fields[rule.field][rule_id]
+        if not fields[rule.field]:
+            del fields[rule.field]
+            if not fields:
+                del self._watching[rule.watched.id]
+        return True
+
+    def rules(self):
+        return list(self._rules.values())
+
+    def clear(self):
+        self._rules.clear()
+        self._watching.clear()
+
+    def _on_change(self, op, entity, changes):
+        if type(entity) is not Device:
+            return
+        fields = self._watching.get(entity.id)
+        if fields is None:
+            return
+        if op == "delete":
+            for rules in list(fields.values()):
+                for rule_id in list(rules):
+                    self.remove(rule_id)
+            return
+        if op not in ("update", "patch") or "data" not in changes:
+            return
+        changed = changes["data"]
+        if op == "patch" and isinstance(changed, dict):
+            # A patch names just the keys that changed, so only their rules can flip.
+            watched = [fields[key] for key in changed if key in fields]
+        else:
+            watched = list(fields.values())  # data was replaced; any field may differ
+        data = entity.data
+        for rules in watched:
+            for rule in list(rules.values()):
+                matched = rule.matches(data)
+                if matched and not rule.active and rule.target in Device.devices:
+                    apply_change(rule.target, rule.settings, rule.status)
+                rule.active = matched
@@ -0,0 +1,290 @@
+"""Micro-benchmarks for the smarthome model.
+
+Run all benchmarks with ``python bench_smarthome.py`` or pick some by name,
+e.g. ``python bench_smarthome.py lookup``.
+"""
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import geo
+from automation import RuleEngine, Scheduler
+from smarthome import User, House, Room, Device, rooms_per_house, summary
+from storage import FileStorage
+
+
+def reset():
+    User.users.clear()
+    House.houses.clear()
+    Room.rooms.clear()
+    Device.devices.clear()
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def build_devices(count, devices_per_room=50):
+    user = User(name="Bench", username="bench")
+    house = House(name="Bench House", owner=user)
+    room = None
+    for i in range(count):
+        if i % devices_per_room == 0:
+            room = Room(name=f"room-{i // devices_per_room}", floor=(i // devices_per_room) % 4, size=20, house=house)
+        Device(device_type="sensor", name=f"device-{i}", room=room)
+
+
+def bench_lookup():
+    """Name lookup latency should stay flat as the fleet grows."""
+    print("devices     lookup (us)")
+    for count in (1_000, 10_000, 100_000, 1_000_000):
+        reset()
+        build_devices(count)
+        names = [f"device-{i}" for i in range(0, count, max(1, count // 1000))]
+        per_call = timed(lambda: [Device.devices.get(n) for n in names], 5) / len(names)
+        print(f"{count:>9,}   {per_call * 1e6:10.3f}")
+
+
+def build_landlord(houses, rooms_per_house, devices_per_room):
+    user = User(name="Landlord", username="landlord")
+    for h in range(houses):
+        house = House(name=f"house-{h}", owner=user)
+        for r in range(rooms_per_house):
+            room = Room(name=f"room-{h}-{r}", house=house)
+            for d in range(devices_per_room):
+                Device(device_type="sensor", name=f"device-{h}-{r}-{d}", room=room)
+    return user
+
+
+def bench_teardown():
+    """Cascading delete should cost the same per entity at every tree size."""
+    print("houses  entities   delete (ms)   per entity (us)")
+    for houses in (50, 100, 200, 400):
+        reset()
+        user = build_landlord(houses, 40, 30)
+        entities = len(House.houses) + len(Room.rooms) + len(Device.devices) + 1
+        start = time.perf_counter()
+        user.delete()
+        elapsed = time.perf_counter() - start
+        print(f"{houses:>6}  {entities:>8,}   {elapsed * 1e3:10.1f}   {elapsed / entities * 1e6:10.3f}")
+
+
+def bench_serialize():
+    """Repeated to_dict() of an unchanged tree should reuse cached subtrees."""
+    reset()
+    user = build_landlord(50, 40, 30)
+    device = Device.devices.get("device-0-0-0")
+    start = time.perf_counter()
+    user.to_dict()
+    cold = time.perf_counter() - start
+    warm = timed(user.to_dict, 100)
+    def after_one_update():
+        device.status = "on" if device.status != "on" else "off"
+        user.to_dict()
+    one_change = timed(after_one_update, 100)
+    print(f"cold build        {cold * 1e3:10.3f} ms")
+    print(f"unchanged         {warm * 1e3:10.3f} ms")
+    print(f"one device update {one_change * 1e3:10.3f} ms")
+
+
+def bench_wal(count=200_000):
+    """Sustained write throughput with the write-ahead log attached."""
+    backends = (
+        ("wal", lambda directory: FileStorage(directory)),
+        ("wal+fsync", lambda directory: FileStorage(directory, fsync=True)),
+    )
+    for label, make_storage in backends:
+        reset()
+        with tempfile.TemporaryDirectory() as directory:
+            storage = make_storage(directory)
+            storage.open()
+            start = time.perf_counter()
+            build_devices(count)
+            for i, device in enumerate(Device.devices):
+                device.status = "on"
+                if i % 1000 == 0:
+                    storage.flush()  # one group commit per 1000 writes
+            storage.flush()
+            elapsed = time.perf_counter() - start
+            storage.close()
+        writes = count * 2 + len(Room.rooms) + 2
+        print(f"{label:<10} {writes:,} writes  {writes / elapsed:12,.0f} writes/s")
+
+
+def bench_recovery(count=1_000_000):
+    """Startup time from a snapshot alone and from a snapshot plus a WAL tail."""
+    reset()
+    with tempfile.TemporaryDirectory() as directory:
+        storage = FileStorage(directory)
+        storage.open()
+        build_devices(count)
+        storage.snapshot()
+        for device in list(Device.devices)[: count // 10]:
+            device.status = "on"
+        storage.close()
+
+        reset()
+        start = time.perf_counter()
+        storage = FileStorage(directory)
+        storage.open()
+        elapsed = time.perf_counter() - start
+        storage.close()
+    print(f"recovered {len(Device.devices):,} devices + {count // 10:,} WAL entries in {elapsed:.2f} s")
+
+
+def bench_select():
+    """Filtered queries should cost O(matches), not O(fleet)."""
+    print("devices     offline   select (us)   full scan (us)")
+    for count in (10_000, 100_000, 1_000_000):
+        reset()
+        build_devices(count)
+        for device in list(Device.devices)[::1000]:
+            device.status = "offline"
+        house = House.houses[0]
+        query = lambda: Device.select(status="offline", house=house)
+        scan = lambda: [d for d in Device.devices if d.status == "offline" and d.room.house is house]
+        matches = len(query())
+        print(f"{count:>9,}   {matches:>7,}   {timed(query, 20) * 1e6:11.1f}   {timed(scan, 3) * 1e6:14.1f}")
+
+
+def build_fleet(count, devices_per_room=5, house_rooms=4, user_houses=10):
+    """``count`` devices spread over many users, houses and rooms."""
+    house = room = None
+    devices_per_house = devices_per_room * house_rooms
+    for i in range(count):
+        if i % devices_per_house == 0:
+            number = i // devices_per_house
+            if number % user_houses == 0:
+                user = User(name="Bench", username=f"user-{number // user_houses}")
+            house = House(name=f"house-{number}", owner=user)
+        if i % devices_per_room == 0:
+            number = i // devices_per_room
+            room = Room(name=f"room-{number % house_rooms}", floor=number % 4, size=20, house=house)
+        Device(device_type="sensor", name=f"device-{i}", room=room)
+
+
+def bench_stats():
+    """Dashboard counters should cost the same however many devices and houses there are."""
+    print("devices     houses    summary (us)   100 houses (us)   full scan (us)")
+    for count in (10_000, 100_000, 1_000_000):
+        reset()
+        build_fleet(count)
+        for device in list(Device.devices)[::7]:
+            device.status = "offline"
+        middle = list(House.houses)[len(House.houses) // 2].id
+
+        def scan():
+            by_status, by_type, by_floor = {}, {}, {}
+            for device in Device.devices:
+                by_status[device.status] = by_status.get(device.status, 0) + 1
+                by_type[device.device_type] = by_type.get(device.device_type, 0) + 1
+            for room in Room.rooms:
+                by_floor[room.floor] = by_floor.get(room.floor, 0) + room.size
+            rooms = {house.name: len(house.rooms) for house in House.houses}
+            houses = {user.username: len(user.houses) for user in User.users}
+            return by_status, by_type, by_floor, rooms, houses
+
+        print(
+            f"{count:>9,}   {len(House.houses):>6,}   {timed(summary, 20) * 1e6:12.1f}"
+            f"   {timed(lambda: rooms_per_house(middle, 100), 20) * 1e6:15.1f}   {timed(scan, 3) * 1e6:14.1f}"
+        )
+
+
+def bench_geo():
+    """Radius and box queries should cost O(houses in the area), not O(houses)."""
+    random.seed(0)
+    print("houses      radius km   matches   near (us)   full scan (us)")
+    for count in (10_000, 100_000, 1_000_000):
+        reset()
+        user = User(name="Bench", username="bench")
+        for i in range(count):  # spread over the contiguous US
+            House(name=f"house-{i}", gps=f"{random.uniform(25, 49):.5f}, {random.uniform(-124, -67):.5f}", owner=user)
+        for radius in (5, 50):
+            query = lambda: House.near(40.7128, -74.0060, radius)
+            limit = math.sin(radius / geo.EARTH_RADIUS_KM / 2) ** 2
+            scan = lambda: [
+                house for house in House.houses
+                if geo.haversine_terms(40.7128, -74.0060, [house.coordinates])[0] <= limit
+            ]
+            matches = len(query())
+            print(
+                f"{count:>9,}   {radius:>9}   {matches:>7,}"
+                f"   {timed(query, 20) * 1e6:9.1f}   {timed(scan, 1) * 1e6:14.1f}"
+            )
+        box = lambda: House.within(40, -75, 41, -73)
+        print(f"{count:>9,}   box 1x2 deg {len(box()):>7,}   {timed(box, 20) * 1e6:9.1f}")
+
+
+def bench_automation():
+    """A scheduler tick and a data patch should cost the same however many jobs and rules exist."""
+    print("jobs/rules   tick, 100 due (us)   data replace (us)   data patch (us)")
+    for count in (1_000, 10_000, 100_000):
+        reset()
+        build_devices(count)
+        devices = list(Device.devices)
+        scheduler = Scheduler(clock=lambda: 0)
+        for i, device in enumerate(devices):
+            scheduler.schedule(device, 1_000 + i, status="scheduled", every=count)
+        engine = RuleEngine()
+        engine.attach()
+        for device in devices:
+            engine.add(device, "temperature", ">", 25, status="hot")
+        sensor = devices[0]
+        for i in range(100):  # rules on the sensor's other readings
+            engine.add(sensor, f"reading-{i}", ">", 25, status="hot")
+        now = iter(range(1_000 + 99, 10**9, 100))
+        tick = lambda: scheduler.run_due(next(now))
+        readings = iter(range(10**9))
+        replace = lambda: sensor.assign(data={"temperature": next(readings) % 50})
+        patch = lambda: sensor.merge(data={"temperature": next(readings) % 50})
+        print(
+            f"{count:>10,}   {timed(tick, 50) * 1e6:18.1f}   {timed(replace, 1000) * 1e6:17.1f}"
+            f"   {timed(patch, 1000) * 1e6:15.1f}"
+        )
+        engine.detach()
+
+
+def bench_memory(count=200_000):
+    """Bytes held per device (with its share of rooms, indexes and registries)."""
+    reset()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    build_devices(count)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    by_file = {}
+    for stat in after.compare_to(before, "filename"):
+        name = os.path.basename(stat.traceback[0].filename)
+        by_file[name] = by_file.get(name, 0) + stat.size_diff
+    total = sum(by_file.values())
+    print(f"{count:,} devices: {total / 2**20:.1f} MiB, {total / count:.0f} bytes per device")
+    for name, size in sorted(by_file.items(), key=lambda item: -item[1])[:5]:
+        print(f"  {name:<20} {size / count:8.0f} bytes per device")
+
+
+BENCHMARKS = {
+    "lookup": bench_lookup,
+    "teardown": bench_teardown,
+    "serialize": bench_serialize,
+    "wal": bench_wal,
+    "recovery": bench_recovery,
+    "select": bench_select,
+    "stats": bench_stats,
+    "geo": bench_geo,
+    "automation": bench_automation,
+    "memory": bench_memory,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+        reset()
@@ -0,0 +1,343 @@
+"""Benchmarks for the FastAPI routes, driven in-process through TestClient.
+
+Run all benchmarks with ``python bench_smarthome_api.py`` or pick some by
+name, e.g. ``python bench_smarthome_api.py batch``.
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Any, Dict
+
+import httpx
+
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+
+from bench_smarthome import build_landlord, reset
+from smarthome import Device
+from smarthome_api import UserOut, _encode_json, app, orjson, synchronized
+from storage import FileStorage
+
+client = TestClient(app)
+
+
+def setup_room():
+    client.post("/users", json={
+        "name": "Bench", "username": "bench", "phone": "", "privileges": "admin", "email": ""
+    })
+    client.post("/houses", json={
+        "name": "Bench House", "address": "", "gps": "", "owner_username": "bench"
+    })
+    client.post("/rooms", json={
+        "name": "Bench Room", "floor": 1, "size": 100, "house_name": "Bench House", "room_type": "lab"
+    })
+
+
+def device_payload(i):
+    return {"device_type": "sensor", "name": f"device-{i}", "status": "on", "room_name": "Bench Room"}
+
+
+def bench_batch(count=10_000):
+    """Provisioning through one batch call versus one POST per device."""
+    reset()
+    setup_room()
+    start = time.perf_counter()
+    for i in range(count):
+        client.post("/devices", json=device_payload(i))
+    single = time.perf_counter() - start
+
+    reset()
+    setup_room()
+    start = time.perf_counter()
+    response = client.post("/devices:batch", json={"items": [device_payload(i) for i in range(count)]})
+    batch = time.perf_counter() - start
+    assert response.json()["applied"]
+
+    print(f"{count:,} single POSTs   {single:8.2f} s")
+    print(f"one {count:,}-item batch {batch:8.2f} s  ({single / batch:.0f}x faster)")
+
+
+def bench_command(count=2_000):
+    """Switching off every light in a house: one PUT per device versus one scene command."""
+    reset()
+    setup_room()
+    client.post("/devices:batch", json={"items": [dict(device_payload(i), device_type="light") for i in range(count)]})
+    start = time.perf_counter()
+    for i in range(count):
+        client.put(f"/devices/device-{i}", json={"status": "off"})
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    response = client.post("/houses/Bench House/command", json={"device_type": "light", "status": "on"})
+    command = time.perf_counter() - start
+    assert response.json() == {"matched": count, "changed": count}
+
+    print(f"{count:,} single PUTs    {single:8.3f} s")
+    print(f"one scene command    {command:8.3f} s  ({single / command:.0f}x faster)")
+
+
+def bench_patch(count=1_000, keys=50):
+    """Changing one setting of a device with many: PUT of the whole dict versus a merge PATCH.
+
+    Every change is also written to a write-ahead log, to compare how much
+    each one records.
+    """
+    reset()
+    setup_room()
+    settings = {f"key-{k}": k for k in range(keys)}
+    client.post("/devices:batch", json={"items": [dict(device_payload(i), settings=settings) for i in range(count)]})
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for label, send in (
+            ("PUT", lambda i: client.put(f"/devices/device-{i}", json={"settings": dict(settings, **{"key-0": -i})})),
+            ("PATCH", lambda i: client.patch(
+                f"/devices/device-{i}",
+                content=json.dumps({"settings": {"key-0": i}}),
+                headers={"Content-Type": "application/merge-patch+json"},
+            )),
+        ):
+            storage = FileStorage(os.path.join(directory, label))
+            storage.open()
+            start = time.perf_counter()
+            for i in range(count):
+                send(i)
+            elapsed = time.perf_counter() - start
+            storage.close()
+            results[label] = elapsed, os.path.getsize(storage.wal_path)
+
+    for label, (elapsed, logged) in results.items():
+        print(f"{count:,} {label:<6} {elapsed:7.3f} s  {logged / count:8.0f} bytes logged per change")
+
+
+def bench_encode(houses=20, rooms_per_house=20, devices_per_room=25, repeat=20):
+    """GET of one user with a large tree: FastAPI validating the result versus encoding it directly."""
+    reset()
+    user = build_landlord(houses, rooms_per_house, devices_per_room)
+    tree = user.to_dict()
+    validated = FastAPI()
+    validated.get("/untyped", response_model=Dict[str, Any])(lambda: user.to_dict())
+    validated.get("/typed", response_model=UserOut)(lambda: user.to_dict())
+    validated_client = TestClient(validated)
+
+    def per_request(http, path):
+        assert http.get(path).status_code == 200
+        start = time.perf_counter()
+        for _ in range(repeat):
+            http.get(path)
+        return (time.perf_counter() - start) / repeat
+
+    print(f"one user, {len(Device.devices):,} devices           ms per GET")
+    print(f"response_model=Dict[str, Any]  {per_request(validated_client, '/untyped') * 1e3:10.1f}")
+    print(f"response_model=UserOut         {per_request(validated_client, '/typed') * 1e3:10.1f}")
+    print(f"encoded directly (the API)     {per_request(client, '/users/landlord') * 1e3:10.1f}")
+    start = time.perf_counter()
+    for _ in range(repeat):
+        json.dumps(tree, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    print(f"json.dumps of the tree alone   {(time.perf_counter() - start) / repeat * 1e3:10.1f}")
+    start = time.perf_counter()
+    for _ in range(repeat):
+        _encode_json(tree)
+    encoder = "orjson" if orjson is not None else "json"
+    print(f"_encode_json ({encoder}) alone    {(time.perf_counter() - start) / repeat * 1e3:10.1f}")
+
+
+def bench_ingest(devices=1_000, readings=100_000, requests=20):
+    """Sustained telemetry ingestion through the columnar /telemetry endpoint."""
+    reset()
+    setup_room()
+    client.post("/devices:batch", json={"items": [device_payload(i) for i in range(devices)]})
+    per_request = readings // requests
+    bodies = []
+    for r in range(requests):
+        offset = r * per_request
+        bodies.append({
+            "device": [f"device-{(offset + i) % devices}" for i in range(per_request)],
+            "metric": ["temperature"] * per_request,
+            "ts": [float(offset + i) for i in range(per_request)],
+            "value": [20.0 + i % 10 for i in range(per_request)],
+        })
+    start = time.perf_counter()
+    for body in bodies:
+        response = client.post("/telemetry", json=body)
+        assert response.json()["accepted"] == per_request
+    elapsed = time.perf_counter() - start
+    print(f"{per_request * requests:,} readings in {requests} requests  {per_request * requests / elapsed:12,.0f} readings/s")
+
+
+def bench_contention(devices=100, requests=4_000):
+    """Throughput of concurrent PUTs as more client threads share the model lock."""
+    reset()
+    setup_room()
+    client.post("/devices:batch", json={"items": [device_payload(i) for i in range(devices)]})
+
+    def put(i):
+        return client.put(f"/devices/device-{i % devices}", json={"status": str(i)}).status_code
+
+    print("threads   requests/s")
+    for threads in (1, 2, 4, 8, 16):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            statuses = list(pool.map(put, range(requests)))
+        elapsed = time.perf_counter() - start
+        assert statuses.count(200) == requests
+        print(f"{threads:>7}   {requests / elapsed:10,.0f}")
+
+
+def bench_load(clients=1_000, requests=20_000, devices=100):
+    """Latency and throughput with ``clients`` concurrent clients, 3 GETs to 1 PUT.
+
+    Compares the routes as served (on the event loop) with the same route
+    bodies run the way plain ``def`` routes are, in Starlette's threadpool.
+    Requests go through httpx's in-process ASGI transport, so this measures
+    the request path, not the network.
+    """
+    reset()
+    setup_room()
+    client.post("/devices:batch", json={"items": [device_payload(i) for i in range(devices)]})
+    print("model        requests/s   p50 ms   p99 ms")
+    for label, target in (("threadpool", threadpool_app()), ("event loop", app)):
+        rate, latencies = asyncio.run(_load(target, clients, requests, devices))
+        latencies.sort()
+        p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+        print(f"{label:<10} {rate:12,.0f} {p50 * 1000:8.1f} {p99 * 1000:8.1f}")
+
+
+def threadpool_app():
+    """The API served the old way: route bodies in the threadpool, behind an http middleware."""
+    threaded = FastAPI()
+
+    @threaded.middleware("http")
+    async def flush_storage(request, call_next):
+        return await call_next(request)  # the benchmark runs without storage
+
+    for route in app.routes:
+        if not isinstance(route, APIRoute):
+            continue
+        endpoint = route.endpoint
+        if hasattr(endpoint, "__wrapped__"):
+            endpoint = synchronized(endpoint.__wrapped__)
+        threaded.add_api_route(route.path, endpoint, methods=route.methods, response_model=route.response_model)
+    return threaded
+
+
+class _YieldingTransport(httpx.ASGITransport):
+    """In-process transport that lets the other clients run before each request.
+
+    Nothing in a plain ASGITransport round trip waits, so without this one
+    client would send every request while the others never got a turn.
+    """
+
+    async def handle_async_request(self, request):
+        await asyncio.sleep(0)
+        return await super().handle_async_request(request)
+
+
+async def _load(target, clients, requests, devices):
+    transport = _YieldingTransport(app=target)
+    latencies = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as http:
+        counter = iter(range(requests))
+
+        async def client_loop():
+            for i in counter:
+                start = time.perf_counter()
+                if i % 4:
+                    response = await http.get(f"/devices/device-{i % devices}")
+                else:
+                    response = await http.put(f"/devices/device-{i % devices}", json={"status": str(i)})
+                latencies.append(time.perf_counter() - start)
+                assert response.status_code == 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop() for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+    return requests / elapsed, latencies
+
+
+def bench_sharding(max_workers=None, homes=64, requests=20_000, concurrency=64):
+    """Request throughput through the shard router with 1..N worker processes.
+
+    Needs uvicorn; every worker count gets a fresh router and workers.
+    """
+    try:
+        import uvicorn  # noqa: F401 -- the workers and the router run under it
+    except ImportError:
+        print("uvicorn is not installed; skipping.")
+        return
+    max_workers = max_workers or os.cpu_count() or 1
+    port = 8700
+    print("workers   requests/s")
+    workers = 1
+    while workers <= max_workers:
+        router = subprocess.Popen(
+            [sys.executable, "sharding.py", "--workers", str(workers), "--port", str(port)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        try:
+            rate = asyncio.run(_drive_router(f"http://127.0.0.1:{port}", homes, requests, concurrency))
+        finally:
+            router.terminate()
+            router.wait()
+        print(f"{workers:>7}   {rate:10,.0f}")
+        workers *= 2
+        port += workers + 1
+
+
+async def _drive_router(base_url, homes, requests, concurrency):
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+        for _ in range(300):
+            try:
+                await http.get("/users")
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+        for i in range(homes):
+            await http.post("/users", json={
+                "name": "", "username": f"owner-{i}", "phone": "", "privileges": "user", "email": ""
+            })
+            await http.post("/houses", json={
+                "name": f"house-{i}", "address": "", "gps": "", "owner_username": f"owner-{i}"
+            })
+            await http.post("/rooms", json={
+                "name": f"room-{i}", "floor": 1, "size": 10, "house_name": f"house-{i}", "room_type": ""
+            })
+            await http.post("/devices", json={
+                "device_type": "sensor", "name": f"device-{i}", "status": "off", "room_name": f"room-{i}"
+            })
+
+        counter = iter(range(requests))
+
+        async def client_loop():
+            for i in counter:
+                response = await http.put(f"/devices/device-{i % homes}", json={"status": str(i)})
+                assert response.status_code == 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+        return requests / (time.perf_counter() - start)
+
+
+BENCHMARKS = {
+    "batch": bench_batch,
+    "ingest": bench_ingest,
+    "command": bench_command,
+    "patch": bench_patch,
+    "encode": bench_encode,
+    "contention": bench_contention,
+    "load": bench_load,
+    "sharding": bench_sharding,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+        reset()
@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from collections import deque
+
+from smarthome import listeners
+from storage import encode_changes
+
+
+def scope_of(entity):
+    """Map each ancestor type (and the entity's own) to its id.
+
+    A device in room 3 of house 2 owned by user 1 gives
+    ``{"device": d, "room": 3, "house": 2, "user": 1}``.  Parent links are
+    still in place when a delete is reported, so deletes are scoped too.
+    """
+    scope = {}
+    while entity is not None:
+        scope[type(entity).__name__.lower()] = entity.id
+        entity = entity.parent()
+    return scope
+
+
+class Subscription:
+    """One subscriber's bounded queue of events matching its filters.
+
+    Producers never block: when the queue is full the oldest event is
+    dropped and counted, and the next ``get()`` returns an ``overflow``
+    notice with the number lost so the client knows to re-read state.
+    ``put()`` may be called from any thread; ``get()`` runs on the loop the
+    subscription was created on.
+    """
+
+    def __init__(self, bus, filters, maxsize, loop):
+        self.bus = bus
+        self.filters = filters
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._loop = loop
+        self._ready = asyncio.Event()
+
+    def matches(self, event):
+        scope = event["scope"]
+        return all(scope.get(kind) == entity_id for kind, entity_id in self.filters.items())
+
+    def put(self, event):
+        with self._lock:
+            if len(self._queue) >= self.maxsize:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(event)
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:  # the subscriber's loop has already closed
+            pass
+
+    async def get(self):
+        while True:
+            with self._lock:
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    return {"op": "overflow", "dropped": dropped, "version": self.bus.version}
+                if self._queue:
+                    return self._queue.popleft()
+            self._ready.clear()
+            await self._ready.wait()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    """Fans model changes out to asyncio subscribers (WebSocket/SSE feeds).
+
+    ``attach()`` hooks the bus into ``smarthome.listeners``; every change is
+    turned into an event carrying the entity type and id, the changed
+    fields, the ids of its ancestors (``scope``) and a monotonically
+    increasing ``version`` that lets clients spot gaps.  Nothing is built
+    while there are no subscribers.
+    """
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self.version = 0
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def attach(self):
+        listeners.append(self.publish)
+
+    def detach(self):
+        if self.publish in listeners:
+            listeners.remove(self.publish)
+
+    def subscribe(self, queue_size=None, **filters):
+        """Subscribe from a running event loop, optionally scoped by ancestor id.
+
+        ``filters`` are ``user=``, ``house=``, ``room=`` (or ``device=``) ids;
+        an event matches if its scope has every one of them.
+        """
+        subscription = Subscription(
+            self, filters, queue_size or self.queue_size, asyncio.get_running_loop()
+        )
+        with self._lock:
+            self._subscribers = self._subscribers + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s is not subscription]
+
+    def publish(self, op, entity, changes):
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        with self._lock:
+            self.version += 1
+            version = self.version
+        if op == "create":
+            changes = entity.to_dict(0)
+        else:
+            changes = encode_changes(entity, changes)
+        event = {
+            "op": op,
+            "type": type(entity).__name__,
+            "id": entity.id,
+            "changes": changes,
+            "scope": scope_of(entity),
+            "version": version,
+        }
+        for subscription in subscribers:
+            if subscription.matches(event):
+                subscription.put(event)
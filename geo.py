@@ -0,0 +1,179 @@
+"""Parsed GPS positions and the grid index behind radius and box queries.
+
+``House.gps`` stays the free-form string clients send ("40.7128° N,
+74.0060° W" or "40.7128, -74.0060"); ``parse_gps()`` turns it into
+``(latitude, longitude)`` floats.  ``House.houses`` keeps a secondary index
+keyed by ``grid_cell()``, a fixed grid of ``CELL_DEGREES`` squares, so
+``near()`` and ``within()`` only visit the cells the query area overlaps
+and then check each candidate exactly.
+"""
+import math
+import re
+
+try:
+    import numpy
+except ImportError:  # distances are computed one by one without it
+    numpy = None
+
+EARTH_RADIUS_KM = 6371.0088
+CELL_DEGREES = 0.25
+_COLUMNS = round(360 / CELL_DEGREES)
+# Below this many candidates numpy's per-call overhead outweighs the loop.
+_VECTORIZE_FROM = 64
+
+_COORDINATE = re.compile(r"\s*([+-]?\d+(?:\.\d*)?)\s*°?\s*([NSEWnsew]?)\s*")
+
+
+def parse_gps(text):
+    """``(latitude, longitude)`` from a "lat, lon" string, or None if it isn't one.
+
+    Each part is a decimal number, optionally followed by a degree sign and
+    a hemisphere letter; S and W make it negative, and E/W or N/S letters
+    may put longitude first.
+    """
+    if not isinstance(text, str):
+        return None
+    parts = text.split(",")
+    if len(parts) != 2:
+        return None
+    axes = {}
+    for position, part in enumerate(parts):
+        match = _COORDINATE.fullmatch(part)
+        if match is None:
+            return None
+        value = float(match.group(1))
+        hemisphere = match.group(2).upper()
+        if hemisphere in ("S", "W"):
+            value = -abs(value)
+        if hemisphere in ("E", "W"):
+            axis = "lon"
+        elif hemisphere in ("N", "S"):
+            axis = "lat"
+        else:
+            axis = ("lat", "lon")[position]
+        if axis in axes:
+            return None
+        axes[axis] = value
+    latitude, longitude = axes["lat"], axes["lon"]
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return latitude, longitude
+
+
+def cell_of(latitude, longitude):
+    return math.floor(latitude / CELL_DEGREES), math.floor((longitude + 180) / CELL_DEGREES) % _COLUMNS
+
+
+def grid_cell(gps):
+    """Index key for a ``gps`` string: its grid cell, or None if it doesn't parse."""
+    point = parse_gps(gps)
+    return None if point is None else cell_of(*point)
+
+
+def within(registry, field, south, west, north, east):
+    """Members of ``registry`` (grid-indexed on ``field``) inside the box, ordered by id.
+
+    A box with ``west > east`` crosses the antimeridian.
+    """
+    inside = _lon_test(west, east)
+    return sorted(
+        (
+            entity
+            for entity in _candidates(registry, field, south, north, _column_spans(west, east))
+            if south <= entity.coordinates[0] <= north and inside(entity.coordinates[1])
+        ),
+        key=_by_id,
+    )
+
+
+def near(registry, field, latitude, longitude, radius_km):
+    """Members of ``registry`` (grid-indexed on ``field``) within ``radius_km`` of the point, ordered by id."""
+    angle = radius_km / EARTH_RADIUS_KM
+    span = math.degrees(angle)
+    south, north = latitude - span, latitude + span
+    # Widest longitude offset of the circle; it reaches every meridian
+    # once it covers a pole.
+    reach = math.sin(angle) / math.cos(math.radians(latitude)) if abs(latitude) < 90 else 2
+    if south <= -90 or north >= 90 or reach >= 1:
+        spans = [(0, _COLUMNS - 1)]
+    else:
+        offset = math.degrees(math.asin(reach))
+        spans = _column_spans(_wrap(longitude - offset), _wrap(longitude + offset))
+    candidates = list(_candidates(registry, field, max(south, -90), min(north, 90), spans))
+    # Compare haversine terms rather than distances to skip the asin/sqrt.
+    limit = math.sin(angle / 2) ** 2 if angle < math.pi else 1
+    terms = haversine_terms(latitude, longitude, [entity.coordinates for entity in candidates])
+    return sorted((entity for entity, term in zip(candidates, terms) if term <= limit), key=_by_id)
+
+
+def haversine_terms(latitude, longitude, points):
+    """``sin²(d / 2R)`` for the distance ``d`` from the point to each of ``points``.
+
+    Monotonic in distance, so it can be compared against a radius directly.
+    Uses numpy over the whole candidate set when it is installed.
+    """
+    lat0 = math.radians(latitude)
+    lon0 = math.radians(longitude)
+    cos0 = math.cos(lat0)
+    if numpy is not None and len(points) >= _VECTORIZE_FROM:
+        coordinates = numpy.radians(numpy.array(points, dtype=float))
+        lats, lons = coordinates[:, 0], coordinates[:, 1]
+        return (
+            numpy.sin((lats - lat0) / 2) ** 2 + cos0 * numpy.cos(lats) * numpy.sin((lons - lon0) / 2) ** 2
+        ).tolist()
+    sin, cos, radians = math.sin, math.cos, math.radians
+    terms = []
+    for lat, lon in points:
+        lat = radians(lat)
+        terms.append(sin((lat - lat0) / 2) ** 2 + cos0 * cos(lat) * sin((radians(lon) - lon0) / 2) ** 2)
+    return terms
+
+
+def _candidates(registry, field, south, north, spans):
+    """Members in the grid cells between ``south`` and ``north`` and within the column ``spans``."""
+    index = registry.indexes[field]
+    first_row, last_row = math.floor(south / CELL_DEGREES), math.floor(north / CELL_DEGREES)
+    cells = (last_row - first_row + 1) * sum(last - first + 1 for first, last in spans)
+    if cells > len(index):
+        # A large area covers more cells than there are occupied ones.
+        for cell, bucket in index.items():
+            if cell is not None and first_row <= cell[0] <= last_row and _in_spans(cell[1], spans):
+                yield from bucket
+        return
+    for row in range(first_row, last_row + 1):
+        for first, last in spans:
+            for column in range(first, last + 1):
+                bucket = index.get((row, column))
+                if bucket:
+                    yield from bucket
+
+
+def _column_spans(west, east):
+    """Grid columns covering the longitudes from ``west`` to ``east``, as inclusive ranges."""
+    first = math.floor((west + 180) / CELL_DEGREES) % _COLUMNS
+    last = math.floor((east + 180) / CELL_DEGREES) % _COLUMNS
+    if west <= east and (first < last or (first == last and east - west < CELL_DEGREES)):
+        return [(first, last)]
+    # Across the antimeridian (or ending exactly on it, which wraps to column
+    # 0).  Spans that meet or overlap cover every column, e.g. -180 to 180.
+    if last >= first - 1:
+        return [(0, _COLUMNS - 1)]
+    return [(first, _COLUMNS - 1), (0, last)]
+
+
+def _in_spans(column, spans):
+    return any(first <= column <= last for first, last in spans)
+
+
+def _lon_test(west, east):
+    if west <= east:
+        return lambda lon: west <= lon <= east
+    return lambda lon: lon >= west or lon <= east
+
+
+def _wrap(longitude):
+    return (longitude + 180) % 360 - 180
+
+
+def _by_id(entity):
+    return entity.id
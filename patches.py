@@ -0,0 +1,215 @@
+"""JSON merge patches (RFC 7396) and JSON Patch (RFC 6902) over plain dicts.
+
+Both work copy-on-write: the input document is never modified, and the
+result shares every value that didn't change.  That matters because the
+model hands out its dicts (in cached ``to_dict()`` output and in queued
+change events), so they must not change underneath their readers.
+"""
+import re
+
+
+class PatchError(ValueError):
+    """A patch that can't be applied to the document."""
+
+
+class InvalidPatchError(PatchError):
+    """A patch that is malformed whatever the document it is applied to."""
+
+
+class PatchConflictError(PatchError):
+    """A well-formed patch that doesn't fit the document: a missing path or a failed test."""
+
+
+_OPERATIONS = ("add", "remove", "replace", "move", "copy", "test")
+# A "~" that doesn't start one of the escapes "~0" or "~1".
+_BAD_ESCAPE = re.compile("~(?![01])")
+
+
+def merge_patch(target, patch):
+    """Apply merge patch ``patch`` to ``target``; returns ``(result, effective patch)``.
+
+    The effective patch holds only the members that changed something
+    (setting a key to the value it already has, or removing a missing key,
+    is left out), so it is empty when the result equals ``target``.
+    """
+    if not isinstance(patch, dict):
+        return patch, patch if patch != target else {}
+    result = dict(target) if isinstance(target, dict) else {}
+    effective = {}
+    for key, value in patch.items():
+        if value is None:
+            if key in result:
+                del result[key]
+                effective[key] = None
+            continue
+        current = result.get(key)
+        if isinstance(value, dict):
+            merged, changed = merge_patch(current, value)
+            if changed or not isinstance(current, dict):
+                result[key] = merged
+                effective[key] = changed if isinstance(current, dict) else merged
+        elif key not in result or current != value:
+            result[key] = value
+            effective[key] = value
+    if not isinstance(target, dict):
+        return result, result
+    return result, effective
+
+
+def merge_diff(old, new):
+    """The merge patch turning dict ``old`` into dict ``new``, or None if there isn't one.
+
+    Merge patches can't set a member to null, so a ``new`` holding a null
+    that ``old`` doesn't have has no merge patch.
+    """
+    patch = {}
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    for key, value in new.items():
+        if key in old and old[key] == value:
+            continue
+        if value is None:
+            return None
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            nested = merge_diff(old[key], value)
+            if nested is None:
+                return None
+            patch[key] = nested
+        else:
+            if isinstance(value, dict) and _has_null(value):
+                return None
+            patch[key] = value
+    return patch
+
+
+def json_patch(document, operations):
+    """Apply a list of JSON Patch operations to ``document`` and return the result.
+
+    Supports add, remove, replace, move, copy and test.  Raises
+    ``InvalidPatchError`` if an operation is malformed and
+    ``PatchConflictError`` if a path doesn't exist or a test fails; the
+    input document is left as it was either way.
+    """
+    if not isinstance(operations, list):
+        raise InvalidPatchError("A JSON Patch is a list of operations.")
+    # Check every operation before applying any, so a malformed patch is
+    # reported as such even if an earlier operation wouldn't apply.
+    steps = [_parse_operation(operation) for operation in operations]
+    for op, path, source, operation in steps:
+        if op == "add":
+            document = _add(document, path, operation["value"])
+        elif op == "remove":
+            document, _ = _remove(document, path)
+        elif op == "replace":
+            document, _ = _remove(document, path)
+            document = _add(document, path, operation["value"])
+        elif op in ("move", "copy"):
+            if op == "move":
+                document, value = _remove(document, source)
+            else:
+                value = _get(document, source)
+            document = _add(document, path, value)
+        elif _get(document, path) != operation["value"]:  # test
+            raise PatchConflictError(f"Test failed at {operation['path']}.")
+    return document
+
+
+def _parse_operation(operation):
+    """``(op, path, from path or None, operation)`` for one well-formed operation."""
+    if not isinstance(operation, dict) or "op" not in operation or "path" not in operation:
+        raise InvalidPatchError("Every operation needs op and path.")
+    op = operation["op"]
+    if op not in _OPERATIONS:
+        raise InvalidPatchError(f"Unknown op {op!r}.")
+    path = _pointer(operation["path"])
+    if op in ("add", "replace", "test") and "value" not in operation:
+        raise InvalidPatchError(f"{op} needs a value.")
+    source = None
+    if op in ("move", "copy"):
+        if "from" not in operation:
+            raise InvalidPatchError(f"{op} needs from.")
+        source = _pointer(operation["from"])
+        if op == "move" and path[:len(source)] == source and path != source:
+            raise InvalidPatchError("Can't move a value into itself.")
+    if op in ("remove", "replace") and not path:
+        raise InvalidPatchError(f"Can't {op} the whole document.")
+    return op, path, source, operation
+
+
+def _has_null(value):
+    return any(item is None or (isinstance(item, dict) and _has_null(item)) for item in value.values())
+
+
+def _pointer(path):
+    """Split a JSON Pointer into its reference tokens."""
+    if not isinstance(path, str) or (path and not path.startswith("/")) or _BAD_ESCAPE.search(path):
+        raise InvalidPatchError(f"Invalid path {path!r}.")
+    return [token.replace("~1", "/").replace("~0", "~") for token in path.split("/")[1:]]
+
+
+def _index(container, token, allow_end=False):
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token[0] == "0"):
+        raise PatchConflictError(f"Invalid array index {token!r}.")
+    position = int(token)
+    if position > len(container) or (position == len(container) and not allow_end):
+        raise PatchConflictError(f"Array index {token} is out of range.")
+    return position
+
+
+def _get(document, path):
+    for token in path:
+        if isinstance(document, dict) and token in document:
+            document = document[token]
+        elif isinstance(document, list):
+            document = document[_index(document, token)]
+        else:
+            raise PatchConflictError(f"Path /{'/'.join(path)} does not exist.")
+    return document
+
+
+def _add(document, path, value):
+    """Copy of ``document`` with ``value`` added at ``path``."""
+    if not path:
+        return value
+    token, rest = path[0], path[1:]
+    if isinstance(document, dict):
+        if rest and token not in document:
+            raise PatchConflictError(f"Path /{'/'.join(path)} does not exist.")
+        copy = dict(document)
+        copy[token] = _add(document[token], rest, value) if rest else value
+        return copy
+    if isinstance(document, list):
+        copy = list(document)
+        if rest:
+            position = _index(document, token)
+            copy[position] = _add(document[position], rest, value)
+        else:
+            copy.insert(_index(document, token, allow_end=True), value)
+        return copy
+    raise PatchConflictError(f"Path /{'/'.join(path)} does not exist.")
+
+
+def _remove(document, path):
+    """Copy of ``document`` without the value at ``path``, and that value."""
+    if not path:
+        raise InvalidPatchError("Can't remove the whole document.")
+    token, rest = path[0], path[1:]
+    if isinstance(document, dict) and token in document:
+        copy = dict(document)
+        if rest:
+            copy[token], removed = _remove(document[token], rest)
+        else:
+            removed = copy.pop(token)
+        return copy, removed
+    if isinstance(document, list):
+        position = _index(document, token)
+        copy = list(document)
+        if rest:
+            copy[position], removed = _remove(document[position], rest)
+        else:
+            removed = copy.pop(position)
+        return copy, removed
+    raise PatchConflictError(f"Path /{'/'.join(path)} does not exist.")
@@ -0,0 +1,271 @@
+from bisect import bisect_left, bisect_right, insort
+
+
+class Registry:
+    """Insertion-ordered collection of entities with a hash index on one key field.
+
+    Used both for the global class-level collections (``Device.devices``) and
+    for each parent's child collection (``room.devices``), so membership tests,
+    removal and lookup by name are O(1) at every level of the tree.
+
+    Behaves like the plain lists it replaces (iteration, len, indexing,
+    append/remove/clear) but also keeps ``key value -> entities`` buckets so
+    ``get()`` is O(1) instead of a linear scan.  Names are not required to be
+    unique at this level, so a key shared by several entities maps to an
+    ordered set of them and ``get()`` returns the oldest, matching what the
+    old ``next(...)`` scans returned.  The usual case of a unique key maps
+    straight to the entity, saving a dict per entry.
+
+    ``indexes`` names further fields to keep secondary indexes on (say,
+    ``status``); ``having(field, value)`` returns their members in O(1) and
+    ``reindex()`` moves an entity when one of those fields changes.  An entry
+    may also be a ``(field, key function)`` pair to bucket by a value derived
+    from the field, such as the grid cell of a GPS position.
+    ``sums`` names ``(field, group field)`` pairs to keep running totals of,
+    such as room ``size`` per ``floor``; ``totals()`` reads them and
+    ``resum()`` adjusts them when either field changes.
+
+    Members must have a stable integer ``id``.  A sorted list of ids backs
+    ``page()`` so cursor pagination costs O(log n + limit); removed ids are
+    left in place and skipped until enough pile up to be worth compacting.
+    """
+
+    __slots__ = (
+        "key", "on_change", "version", "indexes", "sums", "summed", "_index_keys", "_items", "_index", "_ids", "_stale"
+    )
+
+    def __init__(self, key, on_change=None, indexes=(), sums=()):
+        self.key = key
+        self.on_change = on_change  # called after membership changes
+        self.version = 0  # bumped whenever membership or a member's content changes
+        self._index_keys = dict(entry for entry in indexes if type(entry) is tuple)  # field -> key function
+        self.indexes = {  # field -> value (or derived key) -> {entity: None}
+            entry[0] if type(entry) is tuple else entry: {} for entry in indexes
+        }
+        self.sums = {pair: {} for pair in sums}  # (field, group field) -> group value -> total
+        self.summed = frozenset(field for pair in sums for field in pair)
+        self._items = {}  # id -> entity, in insertion order
+        self._index = {}  # key value -> entity, or {entity: None} if shared
+        self._ids = []  # sorted ids, possibly including removed ones
+        self._stale = 0  # how many ids in self._ids are no longer members
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, entity):
+        return self._items.get(getattr(entity, "id", None)) is entity
+
+    def __getitem__(self, position):
+        # The ends are O(1); anything else falls back to materializing a list.
+        if position == 0 and self._items:
+            return next(iter(self._items.values()))
+        if position == -1 and self._items:
+            return next(reversed(self._items.values()))
+        return list(self._items.values())[position]
+
+    def __repr__(self):
+        return repr(list(self._items.values()))
+
+    def append(self, entity):
+        if entity in self:
+            return
+        self._items[entity.id] = entity
+        self._add_to_index(getattr(entity, self.key), entity)
+        for field, index in self.indexes.items():
+            index.setdefault(self._index_key(field, getattr(entity, field)), {})[entity] = None
+        for (field, group), totals in self.sums.items():
+            _add_total(totals, getattr(entity, group), getattr(entity, field))
+        self._add_id(entity.id)
+        self._changed()
+
+    def remove(self, entity):
+        if entity not in self:
+            raise ValueError(f"{entity!r} is not registered.")
+        del self._items[entity.id]
+        self._forget(entity)
+        self._changed()
+
+    def discard(self, entity):
+        """Remove ``entity`` if it is registered; do nothing otherwise."""
+        if entity in self:
+            self.remove(entity)
+
+    def pop(self):
+        """Remove and return the most recently added entity."""
+        if not self._items:
+            raise IndexError("pop from empty registry")
+        _, entity = self._items.popitem()
+        self._forget(entity)
+        self._changed()
+        return entity
+
+    def clear(self):
+        self._items.clear()
+        self._index.clear()
+        for index in self.indexes.values():
+            index.clear()
+        for totals in self.sums.values():
+            totals.clear()
+        self._ids.clear()
+        self._stale = 0
+        self._changed()
+
+    def get(self, value):
+        """Return the first entity registered under ``value``, or None."""
+        bucket = self._index.get(value)
+        if type(bucket) is dict:
+            return next(iter(bucket))
+        return bucket
+
+    def get_all(self, value):
+        """Every entity registered under ``value``, oldest first."""
+        bucket = self._index.get(value)
+        if bucket is None:
+            return []
+        if type(bucket) is dict:
+            return list(bucket)
+        return [bucket]
+
+    def get_by_id(self, entity_id):
+        return self._items.get(entity_id)
+
+    def having(self, field, value):
+        """Members whose indexed ``field`` equals ``value`` (or shares its derived key), as a sized iterable."""
+        return self.indexes[field].get(self._index_key(field, value), {}).keys()
+
+    def counts(self, field):
+        """Number of members per value of the indexed ``field``."""
+        return {value: len(bucket) for value, bucket in self.indexes[field].items()}
+
+    def totals(self, field, group):
+        """Sum of ``field`` over the members, per value of ``group`` (zero totals are left out)."""
+        return dict(self.sums[(field, group)])
+
+    def page(self, after=None, limit=None):
+        """Return ``(entities, next_cursor)`` ordered by id.
+
+        ``after`` is the last id of the previous page (None for the first
+        page); ``next_cursor`` is None once there is nothing left.
+        """
+        ids = self._ids
+        position = 0 if after is None else bisect_right(ids, after)
+        entities = []
+        while position < len(ids):
+            entity = self._items.get(ids[position])
+            position += 1
+            if entity is None:
+                continue
+            if limit is not None and len(entities) == limit:
+                return entities, entities[-1].id
+            entities.append(entity)
+        return entities, None
+
+    def reindex(self, entity, old_value, new_value, field=None):
+        """Move ``entity`` from the ``old_value`` bucket to ``new_value``.
+
+        ``field`` picks a secondary index; by default the key index is used.
+        """
+        if entity not in self or old_value == new_value:
+            return
+        if field is None or field == self.key:
+            self._remove_from_index(old_value, entity)
+            self._add_to_index(new_value, entity)
+            return
+        old_value = self._index_key(field, old_value)
+        new_value = self._index_key(field, new_value)
+        if old_value == new_value:
+            return
+        index = self.indexes[field]
+        bucket = index[old_value]
+        del bucket[entity]
+        if not bucket:
+            del index[old_value]
+        index.setdefault(new_value, {})[entity] = None
+
+    def resum(self, entity, attr, old_value, new_value):
+        """Adjust the running totals after ``entity.attr`` went from ``old_value`` to ``new_value``."""
+        if entity not in self or old_value == new_value:
+            return
+        for (field, group), totals in self.sums.items():
+            if attr == field:
+                group_value = getattr(entity, group)
+                _add_total(totals, group_value, old_value, -1)
+                _add_total(totals, group_value, new_value)
+            elif attr == group:
+                amount = getattr(entity, field)
+                _add_total(totals, old_value, amount, -1)
+                _add_total(totals, new_value, amount)
+
+    def touch(self):
+        """Record that a member's serialized content changed."""
+        self.version += 1
+
+    def _changed(self):
+        self.version += 1
+        if self.on_change is not None:
+            self.on_change()
+
+    def _add_id(self, entity_id):
+        ids = self._ids
+        if not ids or entity_id > ids[-1]:
+            ids.append(entity_id)
+            return
+        # Re-added or moved entity: reuse its stale slot or insert in order.
+        position = bisect_left(ids, entity_id)
+        if position < len(ids) and ids[position] == entity_id:
+            self._stale -= 1
+        else:
+            insort(ids, entity_id)
+
+    def _forget(self, entity):
+        self._remove_from_index(getattr(entity, self.key), entity)
+        for field, index in self.indexes.items():
+            value = self._index_key(field, getattr(entity, field))
+            bucket = index[value]
+            del bucket[entity]
+            if not bucket:
+                del index[value]
+        for (field, group), totals in self.sums.items():
+            _add_total(totals, getattr(entity, group), getattr(entity, field), -1)
+        self._stale += 1
+        if self._stale > 32 and self._stale > len(self._ids) // 2:
+            self._ids = [entity_id for entity_id in self._ids if entity_id in self._items]
+            self._stale = 0
+
+    def _index_key(self, field, value):
+        key = self._index_keys.get(field) if self._index_keys else None
+        return value if key is None else key(value)
+
+    def _add_to_index(self, value, entity):
+        index = self._index
+        bucket = index.get(value)
+        if bucket is None:
+            index[value] = entity
+        elif type(bucket) is dict:
+            bucket[entity] = None
+        elif bucket is not entity:
+            index[value] = {bucket: None, entity: None}
+
+    def _remove_from_index(self, value, entity):
+        index = self._index
+        bucket = index.get(value)
+        if bucket is entity:
+            del index[value]
+        elif type(bucket) is dict:
+            bucket.pop(entity, None)
+            if len(bucket) == 1:
+                index[value] = next(iter(bucket))
+
+
+def _add_total(totals, group_value, amount, sign=1):
+    # Only numbers count towards a total; a missing or odd value adds nothing.
+    if type(amount) not in (int, float) or not amount:
+        return
+    total = totals.get(group_value, 0) + sign * amount
+    if total:
+        totals[group_value] = total
+    else:
+        del totals[group_value]
@@ -0,0 +1,659 @@
+"""Run several API worker processes, each owning a shard of the homes.
+
+The model lives in process-local registries, so a second uvicorn worker
+would simply hold a second, diverging copy.  Instead each worker process
+runs ``smarthome_api.app`` over its own partition of the data (and its own
+``SMARTHOME_DATA_DIR``), and a router in front of them sends each request
+to the worker that owns it:
+
+* Users are placed by a stable hash of their username; everything below a
+  user (houses, rooms, devices) lives on the same shard as its parent, so
+  cascades, batches and serialization never cross shards.
+* The router keeps a ``Directory`` of which shards hold every name.  It is a
+  local stand-in for a shared coordinator: it is rebuilt from the workers'
+  ``/export`` streams on startup and updated as creates, renames and deletes
+  pass through.
+* Usernames and house names stay unique across shards: before creating or
+  renaming to a name that the directory places elsewhere, the router checks
+  that shard.  Room and device names only need to be unique within their
+  parent, so a request naming one is routed by its ``?house=``/``?room=``
+  scope, or else to the one shard that has it (409 if several do).  Entity
+  ids (``id:<n>``) are local to a worker and need a scope.
+* Collection listings, ``/export``, ``/stats`` (with its per-house and
+  per-user pages) and the unscoped change feed are gathered from every
+  shard.  Cursors become ``"<shard>.<cursor>"``.
+* Moving a house, room or device under a parent on another shard is
+  refused with 409, and an ``atomic`` batch must stay within one shard.
+* Schedules and rules are not sharded: each worker keeps its own in
+  memory, and a rule may watch and change devices on different shards, so
+  ``/schedules`` and ``/rules`` answer 501 here.
+
+Start a router with N workers (needs uvicorn) with::
+
+    python sharding.py --workers 4 --port 8000 --data-dir ./data
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import zlib
+from urllib.parse import quote, unquote
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+try:
+    import msgpack
+except ImportError:  # msgpack bodies on /telemetry are optional
+    msgpack = None
+
+# collection -> (key field, parent collection, create/update field naming the parent)
+COLLECTIONS = {
+    "users": ("username", None, None),
+    "houses": ("name", "users", "owner_username"),
+    "rooms": ("name", "houses", "house_name"),
+    "devices": ("name", "rooms", "room_name"),
+}
+# Worker routes the router doesn't offer (see the module docstring).
+UNSHARDED = ("schedules", "rules")
+# Field naming the entity an item of a PATCH /<collection>:batch applies to.
+BATCH_TARGETS = {"rooms": "room_name", "devices": "device_name"}
+# Prefix of an ``id:<n>`` reference (see smarthome_api).
+ID_PREFIX = "id:"
+# Most specific first: a feed scoped to a room goes to the room's shard.
+FEED_SCOPES = (("room", "rooms"), ("house", "houses"), ("user", "users"))
+
+# Headers that describe one hop and must not be copied between connections.
+_HOP_HEADERS = {"host", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+
+def shard_for(key, shards):
+    """Stable shard number for ``key``; the same in every process and run."""
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+class Directory:
+    """Which shards hold each user, house, room and device name.
+
+    Every name maps to a count per shard, since room and device names can
+    repeat under different parents.  Cascading deletes aren't seen by the
+    router, so the counts may overstate; ``forget()`` drops a shard that
+    turned out not to have the name after all.
+    """
+
+    def __init__(self):
+        self._owners = {collection: {} for collection in COLLECTIONS}
+
+    def shards(self, collection, name):
+        return list(self._owners[collection].get(name, ()))
+
+    def get(self, collection, name):
+        """The one shard holding ``name``, or None if none or several do."""
+        owners = self._owners[collection].get(name)
+        if owners is None or len(owners) != 1:
+            return None
+        return next(iter(owners))
+
+    def set(self, collection, name, shard):
+        owners = self._owners[collection].setdefault(name, {})
+        owners[shard] = owners.get(shard, 0) + 1
+
+    def discard(self, collection, name, shard):
+        owners = self._owners[collection].get(name)
+        if owners is None or shard not in owners:
+            return
+        owners[shard] -= 1
+        if not owners[shard]:
+            self.forget(collection, name, shard)
+
+    def forget(self, collection, name, shard):
+        owners = self._owners[collection].get(name)
+        if owners is not None:
+            owners.pop(shard, None)
+            if not owners:
+                del self._owners[collection][name]
+
+    def __len__(self):
+        return sum(len(owners) for owners in self._owners.values())
+
+
+class ShardRouter:
+    """ASGI front end (``router.app``) spreading the API over worker shards.
+
+    ``shards`` are ``httpx.AsyncClient`` instances, one per worker, whose
+    ``base_url`` points at that worker.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.directory = Directory()
+        # Held while a request may place or rename something, so two of them
+        # can't claim the same name on different shards.
+        self._placement = asyncio.Lock()
+        self.app = FastAPI(lifespan=self._lifespan)
+        self.app.add_api_route(
+            "/{path:path}", self.dispatch, methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE"]
+        )
+
+    @contextlib.asynccontextmanager
+    async def _lifespan(self, app):
+        await self.load()
+        yield
+        for shard in self.shards:
+            await shard.aclose()
+
+    async def load(self):
+        """Rebuild the directory from every shard's export."""
+        for number, shard in enumerate(self.shards):
+            response = await shard.get("/export")
+            response.raise_for_status()
+            for line in response.text.splitlines():
+                record = json.loads(line)
+                collection = record["type"] + "s"
+                key = COLLECTIONS[collection][0]
+                self.directory.set(collection, record[key], number)
+
+    async def dispatch(self, request: Request):
+        segments = [unquote(segment) for segment in request.scope["raw_path"].decode().split("/")[1:]]
+        head = segments[0] if segments else ""
+        collection, _, action = head.partition(":")
+        if head == "telemetry" and request.method == "POST":
+            return await self._ingest(request)
+        if head == "export":
+            return self._export()
+        if head == "stats":
+            if len(segments) == 1:
+                return await self._stats()
+            return await self._list("/".join(segments), request)  # per-house and per-user counts
+        if segments[:2] == ["changes", "sse"]:
+            return await self._change_feed(request)
+        if head in UNSHARDED:
+            return JSONResponse({"detail": f"/{head} is not available through the router."}, status_code=501)
+        if collection not in COLLECTIONS:
+            return JSONResponse({"detail": "Not Found"}, status_code=404)
+        if action == "batch" and len(segments) == 1:
+            return await self._batch(collection, request)
+        if len(segments) == 1 or segments[1] == "":
+            if request.method == "POST":
+                return await self._create(collection, request)
+            return await self._list(collection, request)
+        shard = await self._locate(collection, segments[1], request.query_params)
+        if len(segments) > 2 or request.method not in ("PUT", "PATCH", "DELETE"):
+            return await self._forward(shard, request)  # reads and sub-resources
+        return await self._change(collection, segments[1], shard, request)
+
+    # -- single entities --------------------------------------------------
+
+    async def _create(self, collection, request):
+        body = await request.body()
+        try:
+            payload = json.loads(body)
+            name = payload[COLLECTIONS[collection][0]]
+        except (ValueError, KeyError, TypeError):
+            return await self._forward(0, request, body)  # let a worker report the bad request
+        async with self._placement:
+            shard = await self._placement_for(collection, payload)
+            if await self._taken_elsewhere(collection, name, shard):
+                return _conflict(collection, name)
+            response = await self._forward(shard, request, body)
+            if response.status_code == 200:
+                self.directory.set(collection, name, shard)
+        return response
+
+    async def _change(self, collection, name, shard, request):
+        body = await request.body()
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            payload = {}
+        key = COLLECTIONS[collection][0]
+        if isinstance(payload, list):  # a JSON Patch: of its operations only a rename matters here
+            payload = {
+                key: operation.get("value")
+                for operation in payload
+                if isinstance(operation, dict)
+                and operation.get("op") in ("add", "replace")
+                and operation.get("path") == "/" + key
+            }
+        if not isinstance(payload, dict):
+            payload = {}
+        new_name = payload.get(key)
+        async with self._placement:
+            parent_shard = await self._parent_shard(collection, payload)
+            if parent_shard is not None and parent_shard != shard:
+                return _cross_shard(collection, name)
+            renamed = new_name is not None and new_name != name
+            if renamed and await self._taken_elsewhere(collection, new_name, shard):
+                return _conflict(collection, new_name)
+            response = await self._forward(shard, request, body)
+            if response.status_code == 200:
+                # An ``id:<n>`` reference doesn't say which name to drop; the
+                # stale entry is forgotten the next time it is probed.
+                if request.method == "DELETE":
+                    self.directory.discard(collection, name, shard)
+                elif renamed:
+                    self.directory.discard(collection, name, shard)
+                    self.directory.set(collection, new_name, shard)
+        return response
+
+    async def _placement_for(self, collection, payload):
+        """Shard a new entity goes to: its parent's, or by hash for users."""
+        shard = await self._parent_shard(collection, payload)
+        if shard is not None:
+            return shard
+        # A user, or an unknown parent: any shard will answer with the usual 404.
+        return shard_for(str(payload[COLLECTIONS[collection][0]]), len(self.shards))
+
+    async def _parent_shard(self, collection, payload):
+        """Shard of the parent named in a create/update body, if it names a known one."""
+        _, parent_collection, parent_field = COLLECTIONS[collection]
+        if parent_field is None or payload.get(parent_field) is None:
+            return None
+        if collection == "devices" and payload.get("house_name") is not None:
+            return self.directory.get("houses", payload["house_name"])
+        try:
+            return await self._locate(parent_collection, payload[parent_field], {})
+        except HTTPException as exc:
+            if exc.status_code == 404:
+                return None
+            raise
+
+    async def _locate(self, collection, ref, params):
+        """Shard holding the entity ``ref`` names, or HTTPException if there isn't exactly one.
+
+        Rooms and devices may be scoped by ``house``/``room`` in ``params``;
+        otherwise a name held by several shards is looked up on each.
+        """
+        label = collection[:-1].capitalize()
+        if collection in ("rooms", "devices") and params.get("house") is not None:
+            shard = self.directory.get("houses", params["house"])
+            if shard is None:
+                raise HTTPException(status_code=404, detail="House not found.")
+            return shard
+        if collection == "devices" and params.get("room") is not None:
+            return await self._locate("rooms", params["room"], {})
+        if ref.startswith(ID_PREFIX):
+            raise HTTPException(
+                status_code=400, detail=f"Ids are local to a worker; name the {collection[:-1]} or pass its house."
+            )
+        candidates = self.directory.shards(collection, ref)
+        if len(candidates) > 1:
+            found = []
+            for shard in candidates:
+                response = await self.shards[shard].get(f"/{collection}/{quote(ref, safe='')}")
+                if response.status_code == 404:
+                    self.directory.forget(collection, ref, shard)  # left over from a cascading delete
+                else:
+                    found.append(shard)
+            candidates = found
+        if not candidates:
+            raise HTTPException(status_code=404, detail=f"{label} not found.")
+        if len(candidates) > 1:
+            raise HTTPException(status_code=409, detail=f"Several {collection} are named '{ref}'; pass the house.")
+        return candidates[0]
+
+    async def _taken_elsewhere(self, collection, name, shard):
+        """True if ``name`` is in use on a shard other than ``shard``.
+
+        Room and device names may repeat across parents, so only usernames
+        and house names are checked.
+        """
+        if collection in ("rooms", "devices"):
+            return False
+        for owner in self.directory.shards(collection, name):
+            if owner == shard:
+                continue
+            response = await self.shards[owner].get(f"/{collection}/{quote(name, safe='')}")
+            if response.status_code == 404:
+                self.directory.forget(collection, name, owner)  # left over from a cascading delete
+                continue
+            return True
+        return False
+
+    # -- collections ------------------------------------------------------
+
+    async def _list(self, collection, request):
+        """Gather a listing (or a map of per-entity counts) from every shard, or page through them."""
+        params = dict(request.query_params)
+        if "limit" not in params and "cursor" not in params:
+            responses = await asyncio.gather(
+                *(shard.get(f"/{collection}", params=params) for shard in self.shards)
+            )
+            for response in responses:
+                if response.status_code != 200:
+                    return _relay(response)
+            replies = [response.json() for response in responses]
+            if all(isinstance(reply, dict) for reply in replies):
+                return JSONResponse({name: count for reply in replies for name, count in reply.items()})
+            return JSONResponse([entity for reply in replies for entity in reply])
+
+        # One shard per page; the cursor says which shard and where in it.
+        shard, inner = 0, None
+        if params.get("cursor"):
+            prefix, _, inner = params.pop("cursor").partition(".")
+            if not prefix.isdigit() or int(prefix) >= len(self.shards):
+                return JSONResponse({"detail": "Invalid cursor."}, status_code=400)
+            shard, inner = int(prefix), inner or None
+        if inner is not None:
+            params["cursor"] = inner
+        response = await self.shards[shard].get(f"/{collection}", params=params)
+        if response.status_code != 200:
+            return _relay(response)
+        headers = {}
+        next_inner = response.headers.get("X-Next-Cursor")
+        if next_inner is not None:
+            headers["X-Next-Cursor"] = f"{shard}.{next_inner}"
+        elif shard + 1 < len(self.shards):
+            headers["X-Next-Cursor"] = f"{shard + 1}."
+        return Response(content=response.content, media_type="application/json", headers=headers)
+
+    async def _batch(self, collection, request):
+        if collection not in BATCH_TARGETS:
+            return JSONResponse({"detail": "Not Found"}, status_code=404)
+        body = await request.body()
+        try:
+            payload = json.loads(body)
+            items = payload["names"] if request.method == "DELETE" else payload["items"]
+            atomic = payload.get("atomic", False)
+        except (ValueError, KeyError, TypeError):
+            return await self._forward(0, request, body)
+
+        async with self._placement:
+            groups = {}  # shard -> [original index]
+            results = [None] * len(items)
+            for index, item in enumerate(items):
+                shard = await self._batch_shard(collection, request.method, item)
+                if isinstance(shard, dict):
+                    results[index] = dict(shard, index=index)
+                else:
+                    groups.setdefault(shard, []).append(index)
+            if atomic and (len(groups) > 1 or any(results)):
+                detail = "An atomic batch must stay within one shard." if len(groups) > 1 else None
+                return _atomic_failure(results, groups, detail)
+
+            key = "names" if request.method == "DELETE" else "items"
+            replies = await asyncio.gather(*(
+                self.shards[shard].request(
+                    request.method,
+                    f"/{collection}:batch",
+                    json={key: [items[index] for index in indexes], "atomic": atomic},
+                )
+                for shard, indexes in groups.items()
+            ))
+            applied = True
+            for (shard, indexes), reply in zip(groups.items(), replies):
+                if reply.status_code not in (200, 400) or "results" not in reply.json():
+                    return _relay(reply)
+                outcome = reply.json()
+                applied = applied and outcome["applied"]
+                for index, result in zip(indexes, outcome["results"]):
+                    results[index] = dict(result, index=index)
+                    if result["status"] == 200:
+                        self._record_batch_result(collection, request.method, items[index], shard)
+        return JSONResponse({"applied": applied, "results": results}, status_code=200 if applied else 400)
+
+    async def _batch_shard(self, collection, method, item):
+        """Shard for one batch item, or an error result if it can't go anywhere."""
+        key = COLLECTIONS[collection][0]
+        try:
+            if method == "POST":
+                shard = await self._placement_for(collection, item)
+                name, new_name = None, item[key]
+            else:
+                name = item if method == "DELETE" else item[BATCH_TARGETS[collection]]
+                shard = await self._locate(collection, name, {})
+                new_name = item.get(key) if method == "PATCH" else None
+            parent_shard = await self._parent_shard(collection, item) if method == "PATCH" else None
+        except (KeyError, TypeError, AttributeError):
+            return 0  # malformed; the worker reports it
+        except HTTPException as exc:
+            return {"status": exc.status_code, "detail": exc.detail}
+        if parent_shard is not None and parent_shard != shard:
+            return {"status": 409, "detail": f"Cannot move {collection[:-1]} '{name}' under a parent on another shard."}
+        if new_name is not None and new_name != name and await self._taken_elsewhere(collection, new_name, shard):
+            return {"status": 400, "detail": f"{collection[:-1].capitalize()} '{new_name}' already exists."}
+        return shard
+
+    def _record_batch_result(self, collection, method, item, shard):
+        if method == "POST":
+            self.directory.set(collection, item["name"], shard)
+        elif method == "DELETE":
+            self.directory.discard(collection, item, shard)
+        elif item.get("name") is not None and item["name"] != item[BATCH_TARGETS[collection]]:
+            self.directory.discard(collection, item[BATCH_TARGETS[collection]], shard)
+            self.directory.set(collection, item["name"], shard)
+
+    # -- telemetry, export and change feed --------------------------------
+
+    async def _ingest(self, request):
+        body = await request.body()
+        content_type = request.headers.get("content-type", "")
+        try:
+            if content_type.startswith("application/msgpack"):
+                if msgpack is None:
+                    return JSONResponse({"detail": "msgpack is not installed on this server."}, status_code=415)
+                columns = msgpack.unpackb(body)
+            else:
+                columns = json.loads(body)
+            devices, metrics, timestamps, values = (columns[c] for c in ("device", "metric", "ts", "value"))
+            if not all(isinstance(column, list) for column in (devices, metrics, timestamps, values)):
+                raise ValueError("device, metric, ts and value must be lists.")
+            if not len(devices) == len(metrics) == len(timestamps) == len(values):
+                raise ValueError("device, metric, ts and value must have the same length.")
+            rows = list(zip(devices, metrics, timestamps, values))
+            # Each distinct name is resolved once; looking names up also
+            # catches ones that can't be names (e.g. a list).
+            placed = {}
+            split = {}
+            unknown = set()
+            for row in rows:
+                if row[0] not in placed:
+                    placed[row[0]] = await self._device_shard(row[0])
+                shard = placed[row[0]]
+                if shard is None:
+                    unknown.add(row[0])
+                    continue
+                split.setdefault(shard, []).append(row)
+        except (ValueError, TypeError, KeyError) as exc:
+            return JSONResponse({"detail": f"Invalid telemetry batch: {exc}"}, status_code=400)
+
+        replies = await asyncio.gather(*(
+            self.shards[shard].post("/telemetry", json=dict(zip(("device", "metric", "ts", "value"), map(list, zip(*part)))))
+            for shard, part in split.items()
+        ))
+        accepted = 0
+        for reply in replies:
+            if reply.status_code != 200:
+                return _relay(reply)
+            outcome = reply.json()
+            accepted += outcome["accepted"]
+            unknown.update(outcome["unknown_devices"])
+        return {"accepted": accepted, "rejected": len(rows) - accepted, "unknown_devices": sorted(unknown, key=str)}
+
+    async def _device_shard(self, ref):
+        """Shard holding the one device ``ref`` names, or None if none or several do.
+
+        Like ``_locate()``, a name held by several shards is looked up on each
+        (dropping the ones that no longer have it).  An ``id:<n>`` can't be
+        scoped here, so it is looked up on every shard.
+        """
+        if not isinstance(ref, str):
+            return None
+        if ref.startswith(ID_PREFIX):
+            path = f"/devices/{quote(ref, safe='')}"
+            replies = await asyncio.gather(*(shard.get(path) for shard in self.shards))
+            found = [number for number, reply in enumerate(replies) if reply.status_code == 200]
+            return found[0] if len(found) == 1 else None
+        try:
+            return await self._locate("devices", ref, {})
+        except HTTPException:
+            return None
+
+    def _export(self):
+        async def chunks():
+            for shard in self.shards:
+                async with shard.stream("GET", "/export") as response:
+                    async for chunk in response.aiter_bytes():
+                        yield chunk
+        return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+    async def _stats(self):
+        """Add up every shard's counters (each is a count, a total or a map of them)."""
+        replies = await asyncio.gather(*(shard.get("/stats") for shard in self.shards))
+        merged = {}
+        for reply in replies:
+            if reply.status_code != 200:
+                return _relay(reply)
+            for key, value in reply.json().items():
+                if isinstance(value, dict):
+                    totals = merged.setdefault(key, {})
+                    for group, amount in value.items():
+                        totals[group] = totals.get(group, 0) + amount
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    async def _change_feed(self, request):
+        shards = range(len(self.shards))
+        for param, collection in FEED_SCOPES:
+            name = request.query_params.get(param)
+            if name is None:
+                continue
+            if collection == "rooms":
+                shards = [await self._locate(collection, name, request.query_params)]
+                break
+            owner = self.directory.get(collection, name)
+            if owner is None:
+                return JSONResponse({"detail": f"{param.capitalize()} '{name}' not found."}, status_code=404)
+            shards = [owner]
+            break
+        return StreamingResponse(
+            self._merged_events(request, shards),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    async def _merged_events(self, request, shards):
+        """Interleave whole SSE messages from several shards' feeds."""
+        queue = asyncio.Queue(maxsize=1000)
+
+        async def pump(shard):
+            async with self.shards[shard].stream(
+                "GET", "/changes/sse", params=request.query_params, timeout=None
+            ) as response:
+                message = []
+                async for line in response.aiter_lines():
+                    if line:
+                        message.append(line)
+                    elif message:
+                        await queue.put(("\n".join(message) + "\n\n").encode())
+                        message = []
+
+        tasks = [asyncio.ensure_future(pump(shard)) for shard in shards]
+        try:
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(queue.get(), 15)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # -- plumbing ---------------------------------------------------------
+
+    async def _forward(self, shard, request, body=None):
+        if body is None:
+            body = await request.body()
+        url = request.scope["raw_path"].decode()
+        if request.scope.get("query_string"):
+            url += "?" + request.scope["query_string"].decode()
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in _HOP_HEADERS}
+        response = await self.shards[shard].request(request.method, url, content=body, headers=headers)
+        return _relay(response)
+
+
+def _relay(response):
+    headers = {k: v for k, v in response.headers.items() if k.lower() not in _HOP_HEADERS}
+    return Response(content=response.content, status_code=response.status_code, headers=headers)
+
+
+def _conflict(collection, name):
+    return JSONResponse(
+        {"detail": f"{collection[:-1].capitalize()} '{name}' already exists."}, status_code=400
+    )
+
+
+def _cross_shard(collection, name):
+    return JSONResponse(
+        {"detail": f"Cannot move {collection[:-1]} '{name}' under a parent on another shard."},
+        status_code=409,
+    )
+
+
+def _atomic_failure(results, groups, detail):
+    for indexes in groups.values():
+        for index in indexes:
+            results[index] = (
+                {"index": index, "status": 400, "detail": detail}
+                if detail
+                else {"index": index, "status": 424, "detail": "Not applied because another item failed."}
+            )
+    return JSONResponse({"applied": False, "results": results}, status_code=400)
+
+
+def serve(workers, port, data_dir=None, host="127.0.0.1"):
+    """Start ``workers`` API processes on the ports after ``port`` and route to them."""
+    import uvicorn
+
+    processes = []
+    for number in range(workers):
+        env = dict(os.environ)
+        if data_dir is not None:
+            env["SMARTHOME_DATA_DIR"] = os.path.join(data_dir, f"shard-{number}")
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "smarthome_api:app",
+             "--host", host, "--port", str(port + 1 + number), "--log-level", "warning"],
+            env=env,
+        ))
+    try:
+        _wait_until_up(host, range(port + 1, port + 1 + workers))
+        router = ShardRouter([
+            httpx.AsyncClient(base_url=f"http://{host}:{port + 1 + number}", timeout=30)
+            for number in range(workers)
+        ])
+        uvicorn.run(router.app, host=host, port=port, log_level="warning")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def _wait_until_up(host, ports, timeout=30):
+    async def wait():
+        async with httpx.AsyncClient() as client:
+            for port in ports:
+                for _ in range(timeout * 10):
+                    try:
+                        await client.get(f"http://{host}:{port}/users")
+                        break
+                    except httpx.TransportError:
+                        await asyncio.sleep(0.1)
+                else:
+                    raise RuntimeError(f"worker on port {port} did not start")
+    asyncio.run(wait())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--data-dir")
+    args = parser.parse_args()
+    serve(args.workers, args.port, args.data_dir, args.host)
@@ -1,5 +1,354 @@
-class User:
-    users = []
+import logging
+import threading
+from sys import intern
+
+import geo
+import patches
+from registry import Registry
+
+# Callables notified of every change to a registered entity, as
+# ``listener(op, entity, changes)`` with ``op`` one of "create", "update",
+# "patch" or "delete".  ``changes`` maps changed attributes to their new
+# values (empty for create/delete); parent attributes carry the parent entity
+# itself.  A "patch" comes from ``merge()`` and carries, for mergeable dict
+# attributes, the merge patch that was applied rather than the whole dict.
+listeners = []
+
+# Model events worth a log line.  Structured details go in ``extra={"fields":
+# {...}}``; nothing is printed unless the application configures a handler.
+logger = logging.getLogger("smarthome")
+
+# Guards the whole model.  Entities don't take it themselves; callers that
+# share the model between threads (the API's routes) hold it around each
+# read-check-write sequence so it happens as one step.
+lock = threading.RLock()
+
+
+class Entity:
+    """Base class that keeps registries, ownership links and caches in step.
+
+    Subclasses describe themselves with a few class attributes:
+
+    * ``_registry``: the class-level Registry holding every instance.
+    * ``_parent_link``: ``(parent attribute, parent's child collection)``,
+      or None for top-level entities.
+    * ``_children``: name of the entity's own child collection, if any.
+    * ``_fields``: attributes that appear in ``to_dict()``.
+    * ``_shown_by_children``: the attribute children embed in their own
+      ``to_dict()`` (e.g. a house shows its owner's username).
+    * ``_mergeable``: dict attributes ``merge()`` patches rather than replaces.
+
+    Every entity gets a stable ``id`` from a per-class counter when it is
+    created; ids only ever grow, so they double as pagination cursors.
+    ``version`` starts at 1 when the entity is registered and goes up by one
+    with every reported change to its own fields, for optimistic concurrency.
+    ``revision`` goes up whenever ``to_dict()`` may have changed, including
+    through a child or a parent it embeds, so it can tag the serialized form.
+    ``restore()`` recreates a persisted entity under its original id.
+
+    Assigning the key attribute (through ``update()`` or directly) re-buckets
+    the entity, assigning the parent attribute moves the entity from the old
+    parent's child collection to the new one, and assigning any serialized
+    field drops the cached ``to_dict()`` of the entity and its ancestors.
+    Changes to registered entities are reported to ``listeners``; ``update()``
+    goes through ``assign()`` so it is reported once, with only the fields
+    whose values actually changed.
+
+    Entities use ``__slots__`` rather than a per-instance ``__dict__``, and
+    the strings named in ``_interned`` (types and statuses, which repeat
+    across millions of devices) are interned so equal values share one object.
+    """
+
+    __slots__ = ("id", "version", "revision", "_dict_cache", "_pending", "_live")
+
+    _registry = None
+    _parent_link = None
+    _children = None
+    _fields = ()
+    _shown_by_children = None
+    _interned = frozenset()
+    _mergeable = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._last_id = 0
+        # Attributes __setattr__ has to look at; everything else is stored as-is.
+        tracked = set(cls._fields)
+        if cls._registry is not None:
+            tracked.add(cls._registry.key)
+            tracked.update(cls._registry.indexes)
+            tracked.update(cls._registry.summed)
+        cls._parent_attr = None
+        if cls._parent_link is not None:
+            cls._parent_attr = cls._parent_link[0]
+            tracked.add(cls._parent_attr)
+        cls._tracked = frozenset(tracked)
+
+    def __new__(cls, *args, **kwargs):
+        entity = super().__new__(cls)
+        cls._last_id += 1
+        set_slot = object.__setattr__
+        set_slot(entity, "id", cls._last_id)
+        set_slot(entity, "version", 0)
+        set_slot(entity, "revision", 0)
+        set_slot(entity, "_dict_cache", None)
+        set_slot(entity, "_pending", None)
+        set_slot(entity, "_live", False)  # set once the entity is registered
+        return entity
+
+    @classmethod
+    def restore(cls, entity_id, *args, **kwargs):
+        """Construct an entity that takes ``entity_id`` instead of a fresh id."""
+        last_id = cls._last_id
+        cls._last_id = entity_id - 1
+        try:
+            return cls(*args, **kwargs)
+        finally:
+            cls._last_id = max(last_id, entity_id)
+
+    def __setattr__(self, attr, value):
+        # Until __init__ registers the entity there is no index entry, cache or
+        # listener to maintain, only the link into the parent (which is why
+        # constructors set the key before the parent).
+        if attr in self._interned and type(value) is str:
+            value = intern(value)
+        if attr not in self._tracked or (not self._live and attr != self._parent_attr):
+            object.__setattr__(self, attr, value)
+            return
+        old = getattr(self, attr, None)
+        object.__setattr__(self, attr, value)
+        if old is value:
+            return
+
+        registry = self._registry
+        if attr == registry.key:
+            registry.reindex(self, old, value)
+        elif attr in registry.indexes:
+            registry.reindex(self, old, value, attr)
+        if attr in registry.summed:
+            registry.resum(self, attr, old, value)
+
+        parent_attr = None
+        if self._parent_link is not None:
+            parent_attr, children_attr = self._parent_link
+            if attr == parent_attr:
+                if old is not None:
+                    getattr(old, children_attr).discard(self)
+                if value is not None:
+                    getattr(value, children_attr).append(self)
+            else:
+                parent = getattr(self, parent_attr, None)
+                if parent is not None:
+                    siblings = getattr(parent, children_attr)
+                    if attr == siblings.key:
+                        siblings.reindex(self, old, value)
+
+        if attr in self._fields:
+            self._invalidate()
+        if attr == self._shown_by_children:
+            for child in getattr(self, self._children, ()):
+                child._invalidate()
+
+        if old != value:
+            if self._pending is not None:
+                self._pending[attr] = value
+            elif self in registry:
+                object.__setattr__(self, "version", self.version + 1)
+                if listeners:
+                    self._emit("update", {attr: value})
+
+    def assign(self, **values):
+        """Set several attributes and report them as a single change."""
+        pending = {}
+        object.__setattr__(self, "_pending", pending)
+        try:
+            for attr, value in values.items():
+                setattr(self, attr, value)
+        finally:
+            object.__setattr__(self, "_pending", None)
+        if pending and self in self._registry:
+            object.__setattr__(self, "version", self.version + 1)
+            self._emit("update", pending)
+
+    def merge(self, **changes):
+        """Apply ``changes`` as a single change, patching the ``_mergeable`` dicts.
+
+        Values for mergeable attributes are RFC 7396 merge patches: nested
+        dicts merge, None removes a key and anything else replaces it.  The
+        dicts are rebuilt rather than edited in place, because cached
+        ``to_dict()`` output and queued change events may still hold the old
+        ones.  Listeners get a "patch" carrying only what took effect: the
+        effective merge patch for mergeable attributes, the new value for
+        the rest.
+        """
+        pending = {}
+        effective = {}
+        object.__setattr__(self, "_pending", pending)
+        try:
+            for attr, value in changes.items():
+                if attr in self._mergeable:
+                    value, effective[attr] = patches.merge_patch(getattr(self, attr), value)
+                    if effective[attr] == {}:
+                        continue
+                setattr(self, attr, value)
+        finally:
+            object.__setattr__(self, "_pending", None)
+        if pending and self in self._registry:
+            object.__setattr__(self, "version", self.version + 1)
+            self._emit("patch", {attr: effective.get(attr, value) for attr, value in pending.items()})
+
+    def _register(self):
+        object.__setattr__(self, "_live", True)
+        object.__setattr__(self, "version", 1)
+        self._registry.append(self)
+        self._emit("create", {})
+
+    def _unregister(self):
+        self._registry.remove(self)
+        self._emit("delete", {})
+
+    def _emit(self, op, changes):
+        for listener in listeners:
+            listener(op, self, changes)
+
+    @classmethod
+    def parent_type(cls):
+        return _PARENT_TYPES.get(cls)
+
+    @classmethod
+    def select(cls, **criteria):
+        """Registered entities matching every criterion, ordered by id.
+
+        A criterion is either a field (``status="off"``) or an ancestor
+        entity under its parent attribute name (``house=house``,
+        ``owner=user``).  Fields the registry indexes and ancestors can both
+        list their matches without a scan, so the smallest of those
+        candidate sets is the only one checked against the remaining
+        criteria; a full scan is only needed when nothing narrows it.
+        """
+        registry = cls._registry
+        ancestors = cls._ancestor_attrs()
+        candidates = registry
+        size = len(registry)
+        checks = []
+        for attr, value in criteria.items():
+            if attr in ancestors:
+                if not isinstance(value, ancestors[attr]):
+                    return []
+                checks.append(lambda entity, ancestor=value: _is_under(entity, ancestor))
+                continue
+            checks.append(lambda entity, attr=attr, value=value: getattr(entity, attr) == value)
+            if attr in registry.indexes:
+                matches = registry.having(attr, value)
+                if len(matches) < size:
+                    candidates, size = matches, len(matches)
+        # Counting a subtree costs as much as its intermediate levels, so
+        # stop counting as soon as it can't beat the best candidate set.
+        for attr, value in criteria.items():
+            if attr in ancestors:
+                count = _count_descendants(value, cls, size)
+                if count < size:
+                    candidates, size = _descendants(value, cls), count
+        selected = [entity for entity in candidates if all(check(entity) for check in checks)]
+        selected.sort(key=_by_id)
+        return selected
+
+    @classmethod
+    def _ancestor_attrs(cls):
+        """Map each ancestor's attribute name to its type, e.g. Room: house, owner."""
+        ancestors = {}
+        child = cls
+        while child._parent_link is not None:
+            parent = child.parent_type()
+            ancestors[child._parent_link[0]] = parent
+            child = parent
+        return ancestors
+
+    def parent(self):
+        if self._parent_link is None:
+            return None
+        return getattr(self, self._parent_link[0], None)
+
+    def touch(self, *fields):
+        """Mark the entity changed after mutating ``settings``/``data`` in place.
+
+        Naming the mutated fields also reports them to ``listeners``.
+        """
+        self._invalidate()
+        if fields and self in self._registry:
+            object.__setattr__(self, "version", self.version + 1)
+            self._emit("update", {field: getattr(self, field) for field in fields})
+
+    def _invalidate(self):
+        # Every ancestor embeds this entity, so they all get a new revision.
+        node = self
+        while node is not None:
+            object.__setattr__(node, "revision", node.revision + 1)
+            node = node.parent()
+        # A cached ancestor implies cached descendants, so once we reach a
+        # node that is already dirty everything above it is dirty too (and
+        # its collection's version was bumped when that happened).
+        node = self
+        while node is not None and node._dict_cache is not None:
+            object.__setattr__(node, "_dict_cache", None)
+            node._registry.touch()
+            node = node.parent()
+
+    @classmethod
+    def serializable_fields(cls):
+        """Names accepted by ``to_dict(fields=...)``."""
+        fields = ("id",) + cls._fields
+        return fields + (cls._children,) if cls._children else fields
+
+    def to_dict(self, depth=None, fields=None):
+        """Serialize the entity, reusing the cached dict if nothing changed.
+
+        ``depth`` limits how many levels of children are embedded (0 leaves
+        them out entirely) and ``fields`` picks which keys to return.  Only the
+        full default form is cached; the returned dict is shared with the
+        cache and must not be mutated.
+        """
+        if fields is not None:
+            if self._children not in fields:
+                depth = 0
+            result = self.to_dict(depth)
+            if not isinstance(result, dict):
+                return result
+            return {field: result[field] for field in fields if field in result}
+        if depth is not None:
+            return self._serialize(depth)
+        cached = self._dict_cache
+        if cached is not None:
+            return cached
+        result = self._serialize()
+        if isinstance(result, dict):
+            object.__setattr__(self, "_dict_cache", result)
+        return result
+
+    def to_record(self):
+        """Flat form of the entity: its own fields plus type, id and parent id."""
+        parent = self.parent()
+        record = {
+            "type": type(self).__name__.lower(),
+            "id": self.id,
+            "parent": parent.id if parent is not None else None,
+        }
+        record.update(self.to_dict(0))
+        return record
+
+    def _nested(self, depth):
+        """Serialize the children one level further down."""
+        child_depth = None if depth is None else depth - 1
+        return [child.to_dict(child_depth) for child in getattr(self, self._children)]
+
+
+class User(Entity):
+    __slots__ = ("name", "username", "phone", "privileges", "email", "houses")
+    users = Registry("username")
+    _registry = users
+    _children = "houses"
+    _fields = ("name", "username", "phone", "privileges", "email")
+    _shown_by_children = "username"
 
     def __init__(self, name="", username="", phone="", privileges="", email=""):
         self.name = name
@@ -7,9 +356,9 @@ class User:
         self.phone = phone
         self.privileges = privileges
         self.email = email
-        self.houses = []
+        self.houses = Registry("name", on_change=self._invalidate)
         try:
-            User.users.append(self)
+            self._register()
         except:
             ValueError("User already exists.")
 
@@ -25,164 +374,233 @@ class User:
         return user
 
     def delete(self):
-        print(f"Deleting User: {self.username}")
+        houses = len(self.houses)
 
         # Ensure all houses are deleted
         while len(self.houses) > 0:
             house = self.houses.pop()
-            print(f"Deleting House: {house.name}")
             house.delete()
 
         # Remove from users list
         if self in User.users:
-            User.users.remove(self)
-            print(f"User {self.username} removed successfully!")
-
-        print("Final User List After Deletion:", User.users)
+            self._unregister()
+            logger.info(
+                "Deleted user %s", self.username,
+                extra={"fields": {"user_id": self.id, "username": self.username, "houses": houses}},
+            )
 
 
     def update(self, name, username, phone, privileges, email):
         try:
-            self.name = name
-            self.username = username
-            self.phone = phone
-            self.privileges = privileges
-            self.email = email
+            self.assign(name=name, username=username, phone=phone, privileges=privileges, email=email)
             return f"User {self.username} updated successfully!"
         except:
             return ValueError("User update failed.")
 
-    def to_dict(self):
+    def _serialize(self, depth=None):
         try:
-            return {
+            result = {
+                "id": self.id,
                 "name": self.name,
                 "username": self.username,
                 "phone": self.phone,
                 "privileges": self.privileges,
                 "email": self.email,
-                "houses": [house.to_dict() for house in self.houses]
             }
+            if depth != 0:
+                result["houses"] = self._nested(depth)
+            return result
         except:
             return ValueError("User to_dict failed.")
 
-class House:
-    houses = []
+class _Position:
+    """A free-form "lat, lon" string attribute that also keeps it parsed.
+
+    The text is stored as given in ``_<name>``; the entity's ``coordinates``
+    slot holds ``(latitude, longitude)`` floats, or None if the text isn't
+    a position ``geo.parse_gps()`` understands.
+    """
+
+    def __set_name__(self, owner, name):
+        self.slot = owner.__dict__["_" + name]
+
+    def __get__(self, entity, owner=None):
+        if entity is None:
+            return self
+        return self.slot.__get__(entity, owner)
+
+    def __set__(self, entity, value):
+        self.slot.__set__(entity, value)
+        object.__setattr__(entity, "coordinates", geo.parse_gps(value))
+
+
+class House(Entity):
+    __slots__ = ("name", "address", "_gps", "coordinates", "owner", "rooms")
+    houses = Registry("name", indexes=(("gps", geo.grid_cell),))
+    _registry = houses
+    _parent_link = ("owner", "houses")
+    _children = "rooms"
+    _fields = ("name", "address", "gps", "owner")
+    _shown_by_children = "name"
+    gps = _Position()
 
     def __init__(self, name="", address="", gps="", owner=None):
         self.name = name
         self.address = address
         self.gps = gps
-        self.owner = owner
-        self.rooms = []
-        if owner:
-            owner.houses.append(self)
-        else:
+        self.rooms = Registry("name", on_change=self._invalidate)
+        self.owner = owner  # links the house into owner.houses
+        if not owner:
             ValueError("House must have an owner.")
-        House.houses.append(self)
+        self._register()
 
     def create_blank(self):
         return House()
 
+    @classmethod
+    def near(cls, latitude, longitude, radius_km):
+        """Houses within ``radius_km`` of the point, ordered by id."""
+        return geo.near(cls.houses, "gps", latitude, longitude, radius_km)
+
+    @classmethod
+    def within(cls, south, west, north, east):
+        """Houses inside the box (``west > east`` crosses the antimeridian), ordered by id."""
+        return geo.within(cls.houses, "gps", south, west, north, east)
+
     def delete(self):
-        while self.rooms:
-            self.rooms[0].delete()
+        for room in list(self.rooms):
+            room.delete()
 
         if self.owner and self in self.owner.houses:
             self.owner.houses.remove(self)  # FIX: Only remove if it exists
 
-        House.houses.remove(self)
+        self._unregister()
 
     def update(self, name, address, gps, owner):
         try:
-            self.name = name
-            self.address = address
-            self.gps = gps
-            self.owner = owner
+            self.assign(name=name, address=address, gps=gps, owner=owner)
             message = f"House {self.name} updated successfully!"
             return message
         except:
             return ValueError("House update failed.")
 
 
-    def to_dict(self):
+    def _serialize(self, depth=None):
         try:
-            return {
+            result = {
+                "id": self.id,
                 "name": self.name,
                 "address": self.address,
                 "gps": self.gps,
                 "owner": self.owner.username if self.owner else None,  # FIX: Store only username, not full object
-                "rooms": [room.to_dict() for room in self.rooms]
             }
+            if depth != 0:
+                result["rooms"] = self._nested(depth)
+            return result
         except:
             return ValueError("House to_dict failed.")
 
 
 
-class Room:
-    rooms = []
+class Room(Entity):
+    __slots__ = ("name", "floor", "size", "house", "room_type", "devices")
+    rooms = Registry("name", indexes=("room_type", "floor"), sums=(("size", "floor"),))
+    _registry = rooms
+    _parent_link = ("house", "rooms")
+    _children = "devices"
+    _fields = ("name", "floor", "size", "house", "room_type")
+    _interned = frozenset({"room_type"})
 
     def __init__(self, name="", floor=0, size=0, house=None, room_type=""):
         self.name = name
         self.floor = floor
         self.size = size
-        self.house = house
-        self.devices = []
+        self.devices = Registry("name", on_change=self._invalidate)
+        self.house = house  # links the room into house.rooms
         self.room_type = room_type
-        if house:
-            house.rooms.append(self)
-        Room.rooms.append(self)
+        self._register()
 
     def create_blank(self):
         return Room()
 
     def delete(self):
         """Delete all devices before removing room from house."""
-        while self.devices:
-            self.devices[0].delete()
+        for device in list(self.devices):
+            device.delete()
         if self.house:
             self.house.rooms.remove(self)
-        Room.rooms.remove(self)
+        self._unregister()
     def update(self, name, floor, size, house, room_type):
         try:
-            self.name = name
-            self.floor = floor
-            self.size = size
-            self.house = house
-            self.room_type = room_type
+            self.assign(name=name, floor=floor, size=size, house=house, room_type=room_type)
             message = f"Room {self.name} updated successfully!"
             return message
         except:
             return ValueError("Room update failed.")
 
-    def to_dict(self):
+    def _serialize(self, depth=None):
         try:
-            return {
+            result = {
+                "id": self.id,
                 "name": self.name,
                 "floor": self.floor,
                 "size": self.size,
                 "house": self.house.name if self.house else None,  # FIX: Store house name, not full object
                 "room_type": self.room_type,
-                "devices": [device.to_dict() for device in self.devices]
             }
+            if depth != 0:
+                result["devices"] = self._nested(depth)
+            return result
         except:
             return ValueError("Room to_dict failed.")
 
 
 
 
-class Device:
-    devices = []
+class _LazyDict:
+    """A dict attribute that stores nothing while it is empty.
+
+    Most devices never get ``settings`` or ``data``.  Assigning an empty
+    value leaves the backing slot (``_<name>``) at None, and a dict is only
+    created the first time the attribute is read, so it can still be filled
+    in place.  ``_serialize`` reads the slot directly to avoid that.
+    """
+
+    def __set_name__(self, owner, name):
+        self.slot = owner.__dict__["_" + name]
+
+    def __get__(self, entity, owner=None):
+        if entity is None:
+            return self
+        value = self.slot.__get__(entity, owner)
+        if value is None:
+            value = {}
+            self.slot.__set__(entity, value)
+        return value
+
+    def __set__(self, entity, value):
+        self.slot.__set__(entity, value if value else None)
+
+
+class Device(Entity):
+    __slots__ = ("device_type", "name", "room", "_settings", "_data", "status")
+    devices = Registry("name", indexes=("device_type", "status"))
+    _registry = devices
+    _parent_link = ("room", "devices")
+    _fields = ("device_type", "name", "settings", "data", "status")
+    _interned = frozenset({"device_type", "status"})
+    _mergeable = frozenset({"settings", "data"})
+    settings = _LazyDict()
+    data = _LazyDict()
 
     def __init__(self, device_type="", name="", room=None, settings=None, data=None, status=""):
         self.device_type = device_type
         self.name = name
-        self.room = room
-        self.settings = settings if settings else {}
-        self.data = data if data else {}
+        self.room = room  # links the device into room.devices
+        self.settings = settings
+        self.data = data
         self.status = status
-        if room:
-            room.devices.append(self)
-        Device.devices.append(self)
+        self._register()
 
     def create_blank(self):
         return Device()
@@ -191,30 +609,148 @@ class Device:
         """Remove device from its associated room."""
         if self.room:
             self.room.devices.remove(self)
-        Device.devices.remove(self)
+        self._unregister()
 
     def update(self, device_type, name, room, settings, data, status):
         try:
-            self.device_type = device_type
-            self.name = name
-            self.room = room
-            self.settings = settings
-            self.data = data
-            self.status = status
+            self.assign(
+                device_type=device_type, name=name, room=room, settings=settings, data=data, status=status
+            )
             message = f"Device {self.name} updated successfully!"
             return message
         except:
             return ValueError("Device update failed.")
 
-    def to_dict(self):
+    def _serialize(self, depth=None):
         try:
             return {
+                "id": self.id,
                 "device_type": self.device_type,
                 "name": self.name,
-                "settings": self.settings,
-                "data": self.data,
+                "settings": self._settings or {},
+                "data": self._data or {},
                 "status": self.status
             }
         except:
             return ValueError("Device to_dict failed.")
 
+
+
+
+def _by_id(entity):
+    return entity.id
+
+
+def _is_under(entity, ancestor):
+    node = entity.parent()
+    while node is not None:
+        if node is ancestor:
+            return True
+        node = node.parent()
+    return False
+
+
+def _count_descendants(entity, cls, limit):
+    """Number of ``cls`` entities below ``entity``, or ``limit`` if there are at least that many."""
+    children = getattr(entity, entity._children)
+    if not children or isinstance(children[0], cls):
+        return min(len(children), limit)
+    count = 0
+    for child in children:
+        count += _count_descendants(child, cls, limit - count)
+        if count >= limit:
+            return limit
+    return count
+
+
+def _descendants(entity, cls):
+    for child in getattr(entity, entity._children):
+        if isinstance(child, cls):
+            yield child
+        else:
+            yield from _descendants(child, cls)
+
+
+def _iter_registry(registry, batch_size, last_id):
+    # Page by id rather than iterating the dict so the walk survives entities
+    # being added or removed while it is suspended; ids above ``last_id``
+    # were handed out after the walk started.
+    cursor = None
+    while True:
+        entities, cursor = registry.page(cursor, batch_size)
+        for entity in entities:
+            if entity.id > last_id:
+                return
+            yield entity
+        if cursor is None:
+            return
+
+
+def walk(batch_size=1000):
+    """Lazily yield every entity, each parent before its children.
+
+    Yields every user, then every house, room and device, each type in id
+    order, so an entity moved to another parent while the walk is suspended
+    is still yielded exactly once.  Entities created after the walk started
+    are left out, and so the walk raises ``RuntimeError`` if one of them
+    became the parent of an entity it still has to yield.  Only one page of
+    each registry is held at a time.
+    """
+    last_ids = {cls: cls._last_id for cls in (User, House, Room, Device)}
+    for cls in (User, House, Room, Device):
+        for entity in _iter_registry(cls._registry, batch_size, last_ids[cls]):
+            parent = entity.parent() if cls is not User else None
+            if parent is not None and parent.id > last_ids[type(parent)]:
+                raise RuntimeError(f"{cls.__name__} {entity.id} moved to a newer parent during the walk.")
+            yield entity
+
+
+def summary():
+    """Counts and totals over the whole model, for dashboards.
+
+    Nothing here visits the devices or depends on how many there are:
+    counts per status and type are the sizes of ``Device.devices``' index
+    buckets and room sizes are totalled per floor as rooms change.  Counts
+    per house and per user grow with the fleet, so they are paged through
+    ``rooms_per_house()`` and ``houses_per_user()`` instead.
+    """
+    return {
+        "users": len(User.users),
+        "houses": len(House.houses),
+        "rooms": len(Room.rooms),
+        "devices": len(Device.devices),
+        "devices_by_status": Device.devices.counts("status"),
+        "devices_by_type": Device.devices.counts("device_type"),
+        "room_size_by_floor": Room.rooms.totals("size", "floor"),
+    }
+
+
+def rooms_per_house(after=None, limit=None):
+    """``({house name: number of rooms}, next_cursor)`` for one page of houses by id."""
+    houses, next_cursor = House.houses.page(after, limit)
+    return {house.name: len(house.rooms) for house in houses}, next_cursor
+
+
+def houses_per_user(after=None, limit=None):
+    """``({username: number of houses}, next_cursor)`` for one page of users by id."""
+    users, next_cursor = User.users.page(after, limit)
+    return {user.username: len(user.houses) for user in users}, next_cursor
+
+
+ENTITY_TYPES = {"user": User, "house": House, "room": Room, "device": Device}
+_PARENT_TYPES = {House: User, Room: House, Device: Room}
+
+
+def restore(record):
+    """Recreate an entity from its ``to_record()`` form under its original id.
+
+    The parent named by ``record["parent"]`` must already be registered.
+    """
+    cls = ENTITY_TYPES[record["type"]]
+    kwargs = {field: record[field] for field in cls._fields if field in record}
+    if cls._parent_link is not None:
+        parent_attr = cls._parent_link[0]
+        parent_id = record.get("parent")
+        parent_registry = cls.parent_type()._registry
+        kwargs[parent_attr] = parent_registry.get_by_id(parent_id) if parent_id is not None else None
+    return cls.restore(record["id"], **kwargs)
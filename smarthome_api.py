@@ -1,11 +1,201 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import asyncio
+import atexit
+import contextlib
+import functools
+import json
+import logging
+import logging.handlers
+import math
+import os
+import queue
+import uuid
+from bisect import bisect_right
+from itertools import islice
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 
 # Import your classes from smartphone.py
-from smarthome import User, House, Room, Device
-
-app = FastAPI()
+from smarthome import (
+    User, House, Room, Device, lock as model_lock, logger as model_logger, houses_per_user, rooms_per_house, summary, walk,
+)
+from automation import RuleEngine, Scheduler, apply_change
+from events import EventBus
+from patches import InvalidPatchError, PatchConflictError, json_patch, merge_diff
+from storage import FileStorage
+from telemetry import Ingestor, TelemetryStore
+
+try:
+    import msgpack
+except ImportError:  # msgpack bodies on /telemetry are optional
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # responses are encoded with the json module without it
+    orjson = None
+
+@contextlib.asynccontextmanager
+async def _lifespan(app):
+    task = asyncio.ensure_future(scheduler.run())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+app = FastAPI(lifespan=_lifespan)
+
+# Set SMARTHOME_DATA_DIR to keep state across restarts: the directory holds a
+# write-ahead log and compacted snapshots (see storage.FileStorage).
+storage = None
+if os.environ.get("SMARTHOME_DATA_DIR"):
+    storage = FileStorage(os.environ["SMARTHOME_DATA_DIR"])
+if storage is not None:
+    storage.open()
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, with the record's ``fields`` extra merged in."""
+
+    def format(self, record):
+        line = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        line.update(getattr(record, "fields", None) or {})
+        return json.dumps(line, default=str)
+
+# Model log lines (see smarthome.logger) are off unless SMARTHOME_LOG_LEVEL
+# is set.  Requests only put records on a queue; a listener thread formats
+# them and writes them to stderr, so no route waits on that I/O.
+log_listener = None
+if os.environ.get("SMARTHOME_LOG_LEVEL"):
+    _log_queue = queue.SimpleQueue()
+    _log_output = logging.StreamHandler()
+    _log_output.setFormatter(JsonLogFormatter())
+    log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    model_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+    model_logger.setLevel(os.environ["SMARTHOME_LOG_LEVEL"].upper())
+    model_logger.propagate = False
+
+# Sensor history lives here rather than in Device.data (see telemetry.py).
+telemetry = TelemetryStore()
+telemetry.attach()
+ingestor = Ingestor(telemetry, lambda name: _find_unique_device(name))
+
+# Change notifications pushed to /changes/ws and /changes/sse (see events.py).
+events = EventBus()
+events.attach()
+
+# Timed device changes, applied by a task started with the app, and rules
+# reacting to incoming device data (see automation.py).
+scheduler = Scheduler(after_run=lambda: _flush_storage())
+rules = RuleEngine()
+rules.attach()
+
+class FlushStorage:
+    """Hand each mutating request's log entries to the OS before replying.
+
+    A plain ASGI middleware: one declared with ``@app.middleware("http")``
+    runs every request through an extra task and body stream, which costs
+    about as much as a route itself.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or storage is None or scope["method"] in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_flushed(message):
+            if message["type"] == "http.response.start":
+                await run_in_threadpool(_flush_storage)
+            await send(message)
+
+        await self.app(scope, receive, send_flushed)
+
+app.add_middleware(FlushStorage)
+
+@app.exception_handler(RequestValidationError)
+async def validation_failed(request: Request, exc: RequestValidationError):
+    """FastAPI's 422 without echoing the rejected inputs, which may be NaN or infinite."""
+    errors = [{key: value for key, value in error.items() if key != "input"} for error in exc.errors()]
+    return FastJSONResponse({"detail": jsonable_encoder(errors)}, status_code=422)
+
+def _flush_storage():
+    if storage is None:
+        return
+    with model_lock:
+        storage.flush()
+
+def synchronized(handler):
+    """Run a function while holding the model lock, blocking until it is free.
+
+    For work done in a thread (bulk telemetry parsing, storage flushes);
+    routes use ``on_loop`` instead.
+    """
+    @functools.wraps(handler)
+    def locked(*args, **kwargs):
+        with model_lock:
+            return handler(*args, **kwargs)
+    return locked
+
+def on_loop(handler):
+    """Serve a plain-function route on the event loop while holding the model lock.
+
+    FastAPI hands ``def`` routes to a threadpool, which costs two thread
+    switches per request and leaves the threads fighting over the GIL and
+    the model lock.  Route bodies only touch the in-memory model (storage
+    writes are buffered and flushed by the middleware in a thread), so they
+    don't block and can run on the loop directly.  With no ``await`` inside,
+    each one runs as a single step, so requests can't interleave; the lock
+    is only contended by threads (the scheduler, bulk telemetry), and while
+    one holds it the route waits without stalling the loop.
+
+    A dict or list the route returns is encoded into a ``FastJSONResponse``
+    here, keeping the status and headers the route set on its ``response``
+    parameter.  FastAPI would otherwise validate it against the route's
+    ``response_model`` and copy it through ``jsonable_encoder`` first, which
+    for a user is the whole tree below it; the model only documents the
+    response in the OpenAPI schema.
+
+    ``__wrapped__`` is the plain function, which FastAPI reads the
+    parameters from.
+    """
+    @functools.wraps(handler)
+    async def locked(*args, **kwargs):
+        if not model_lock.acquire(blocking=False):
+            await _acquire_model_lock()
+        try:
+            result = handler(*args, **kwargs)
+            if not isinstance(result, (dict, list)):
+                return result
+            encoded = FastJSONResponse(result)
+        finally:
+            model_lock.release()
+        response = kwargs.get("response")
+        if response is not None:
+            encoded.status_code = response.status_code or encoded.status_code
+            encoded.headers.raw.extend(response.headers.raw)
+        return encoded
+    return locked
+
+async def _acquire_model_lock():
+    """Wait for a thread to release the model lock, yielding to other requests meanwhile."""
+    delay = 0.0001
+    while not model_lock.acquire(blocking=False):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.01)
 
 # -----------------------------------
 # Pydantic Models (Request Schemas)
@@ -58,6 +248,7 @@ class DeviceCreate(BaseModel):
     data: Dict[str, Any] = {}
     status: str
     room_name: str
+    house_name: Optional[str] = None  # picks among rooms with the same name
 
 class DeviceUpdate(BaseModel):
     device_type: Optional[str] = None
@@ -66,28 +257,180 @@ class DeviceUpdate(BaseModel):
     data: Optional[Dict[str, Any]] = None
     status: Optional[str] = None
     room_name: Optional[str] = None
+    house_name: Optional[str] = None  # picks among rooms with the same name
+
+
+# -----------------------------------
+# Pydantic Models (Response Schemas)
+# -----------------------------------
+# These document ``to_dict()`` in the OpenAPI schema; responses are encoded
+# directly rather than validated against them (see ``on_loop``).  Children
+# are left out at ``depth=0``, and ``fields`` keeps only the fields named.
+
+class DeviceOut(BaseModel):
+    id: int
+    device_type: str
+    name: str
+    settings: Dict[str, Any]
+    data: Dict[str, Any]
+    status: str
+
+class RoomOut(BaseModel):
+    id: int
+    name: str
+    floor: Optional[int] = None
+    size: Optional[int] = None
+    house: Optional[str] = None  # the house's name
+    room_type: str
+    devices: List[DeviceOut] = []
+
+class HouseOut(BaseModel):
+    id: int
+    name: str
+    address: str
+    gps: Optional[str] = None
+    owner: Optional[str] = None  # the owner's username
+    rooms: List[RoomOut] = []
+
+class UserOut(BaseModel):
+    id: int
+    name: str
+    username: str
+    phone: str
+    privileges: str
+    email: str
+    houses: List[HouseOut] = []
+
+
+class RoomBatchUpdateItem(RoomUpdate):
+    room_name: str  # a name, or ``id:<n>`` if several rooms share it
+
+class DeviceBatchUpdateItem(DeviceUpdate):
+    device_name: str  # a name, or ``id:<n>`` if several devices share it
+
+class RoomBatchCreate(BaseModel):
+    items: List[RoomCreate]
+    atomic: bool = False
+
+class RoomBatchUpdate(BaseModel):
+    items: List[RoomBatchUpdateItem]
+    atomic: bool = False
+
+class DeviceBatchCreate(BaseModel):
+    items: List[DeviceCreate]
+    atomic: bool = False
+
+class DeviceBatchUpdate(BaseModel):
+    items: List[DeviceBatchUpdateItem]
+    atomic: bool = False
+
+class BatchDelete(BaseModel):
+    names: List[str]
+    atomic: bool = False
+
+
+class TelemetrySample(BaseModel):
+    metric: str
+    ts: float = Field(allow_inf_nan=False)
+    value: float = Field(allow_inf_nan=False)
+
+class TelemetryUpload(BaseModel):
+    samples: List[TelemetrySample]
+
+
+class DeviceCommand(BaseModel):
+    device_type: Optional[str] = None  # only devices of this type; all if omitted
+    settings: Optional[Dict[str, Any]] = None  # merged into each device's settings
+    status: Optional[str] = None
+
+
+class ScheduleCreate(BaseModel):
+    device_name: str
+    room_name: Optional[str] = None
+    house_name: Optional[str] = None
+    at: Optional[float] = Field(None, allow_inf_nan=False)  # Unix time; or
+    in_seconds: Optional[float] = Field(None, ge=0, allow_inf_nan=False)
+    every: Optional[float] = Field(None, gt=0, allow_inf_nan=False)  # repeat interval in seconds
+    settings: Optional[Dict[str, Any]] = None  # merged into the device's settings
+    status: Optional[str] = None
+
+class RuleCreate(BaseModel):
+    device_name: str  # the device whose data is watched
+    room_name: Optional[str] = None
+    house_name: Optional[str] = None
+    field: str
+    op: str
+    value: Any
+    target_name: Optional[str] = None  # device to change; the watched one by default
+    target_room_name: Optional[str] = None  # pick among targets with the same name
+    target_house_name: Optional[str] = None
+    settings: Optional[Dict[str, Any]] = None
+    status: Optional[str] = None
+
+
+class ListParams:
+    """Query parameters shared by the collection endpoints.
+
+    ``limit``/``cursor`` page through the collection by entity id (the next
+    cursor comes back in the ``X-Next-Cursor`` header), ``fields`` is a
+    comma-separated projection and ``depth`` limits nested children.
+    """
+
+    def __init__(self, limit=None, cursor=None, fields=None, depth=None):
+        self.limit = limit
+        self.cursor = cursor
+        self.fields = fields
+        self.depth = depth
+
+    def is_default(self) -> bool:
+        return self.limit is None and self.cursor is None and self.fields is None and self.depth is None
+
+
+async def list_params(
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[int] = Query(None, ge=0),
+    fields: Optional[str] = None,
+    depth: Optional[int] = Query(None, ge=0),
+) -> ListParams:
+    # A coroutine, so FastAPI doesn't send it to the threadpool like it
+    # would a class or plain function dependency.
+    return ListParams(limit, cursor, fields, depth)
 
 
 # =========================================
 #                USER ROUTES
 # =========================================
 
-@app.get("/users", response_model=List[Dict[str, Any]])
-def get_all_users():
+@app.get("/users", response_model=List[UserOut])
+@on_loop
+def get_all_users(request: Request, params: ListParams = Depends(list_params)):
     """Return a list of all users."""
-    return [u.to_dict() for u in User.users]
+    return _list_collection("users", User, User.users, request, params)
 
-@app.get("/users/{username}", response_model=Dict[str, Any])
-def get_user(username: str):
+@app.get("/users/{username}", response_model=UserOut)
+@on_loop
+def get_user(username: str, response: Response):
     """Return a single user by username."""
     user = _find_user_by_username(username)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found.")
+    response.headers["ETag"] = _entity_etag(user)
     return user.to_dict()
 
-@app.post("/users", response_model=Dict[str, Any])
+@app.get("/users/{username}/houses", response_model=List[HouseOut])
+@on_loop
+def get_user_houses(username: str, params: ListParams = Depends(list_params)):
+    """Return one user's houses, paged like /houses."""
+    user = _find_user_by_username(username)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found.")
+    return _list_page(House, params, user.houses.page)
+
+@app.post("/users", response_model=UserOut)
+@on_loop
 def create_user(user_data: UserCreate):
     """Create a new user and return the created user."""
+    _check_name(user_data.username)
     # Check if a user with the same username already exists
     if _find_user_by_username(user_data.username) is not None:
         raise HTTPException(status_code=400, detail="Username already exists.")
@@ -100,12 +443,14 @@ def create_user(user_data: UserCreate):
     )
     return new_user.to_dict()
 
-@app.put("/users/{username}", response_model=Dict[str, Any])
-def update_user(username: str, user_data: UserUpdate):
+@app.put("/users/{username}", response_model=UserOut)
+@on_loop
+def update_user(username: str, user_data: UserUpdate, response: Response, if_match: Optional[str] = Header(None)):
     """Update a user's information."""
     user = _find_user_by_username(username)
     if not user:
         raise HTTPException(status_code=404, detail="User not found.")
+    _check_if_match(user, if_match)
 
     # Only update fields that are provided (non-None)
     updated_name = user_data.name if user_data.name is not None else user.name
@@ -115,8 +460,10 @@ def update_user(username: str, user_data: UserUpdate):
     updated_email = user_data.email if user_data.email is not None else user.email
 
     # Check if we changed username and if the new username is taken
-    if updated_username != user.username and _find_user_by_username(updated_username):
-        raise HTTPException(status_code=400, detail="Updated username already exists.")
+    if updated_username != user.username:
+        _check_name(updated_username)
+        if _find_user_by_username(updated_username):
+            raise HTTPException(status_code=400, detail="Updated username already exists.")
 
     user.update(
         updated_name,
@@ -125,14 +472,17 @@ def update_user(username: str, user_data: UserUpdate):
         updated_privileges,
         updated_email,
     )
+    response.headers["ETag"] = _entity_etag(user)
     return user.to_dict()
 
 @app.delete("/users/{username}", response_model=dict)
-def delete_user(username: str):
+@on_loop
+def delete_user(username: str, if_match: Optional[str] = Header(None)):
     """Delete a user."""
     user = _find_user_by_username(username)
     if not user:
         raise HTTPException(status_code=404, detail="User not found.")
+    _check_if_match(user, if_match)
     user.delete()
     return {"message": f"User '{username}' deleted successfully."}
 
@@ -141,22 +491,84 @@ def delete_user(username: str):
 #               HOUSE ROUTES
 # =========================================
 
-@app.get("/houses", response_model=List[Dict[str, Any]])
-def get_all_houses():
-    """Return a list of all houses."""
-    return [h.to_dict() for h in House.houses]
-
-@app.get("/houses/{house_name}", response_model=Dict[str, Any])
-def get_house(house_name: str):
+@app.get("/houses", response_model=List[HouseOut])
+@on_loop
+def get_all_houses(
+    request: Request,
+    params: ListParams = Depends(list_params),
+    near: Optional[str] = None,
+    radius_km: Optional[float] = Query(None, gt=0, le=20_040),
+    bbox: Optional[str] = None,
+):
+    """Return a list of all houses, or those in an area.
+
+    ``near=lat,lon`` with ``radius_km`` selects houses within that distance,
+    ``bbox=south,west,north,east`` those inside the box; given both, a
+    house must match both.  Houses whose ``gps`` can't be parsed never match.
+    """
+    if near is None and bbox is None:
+        return _list_collection("houses", House, House.houses, request, params)
+    selected = None
+    if near is not None:
+        if radius_km is None:
+            raise HTTPException(status_code=400, detail="near needs radius_km.")
+        latitude, longitude = _parse_coordinates(near, "near", ("lat", "lon"))
+        selected = House.near(latitude, longitude, radius_km)
+    if bbox is not None:
+        south, west, north, east = _parse_coordinates(bbox, "bbox", ("south", "west", "north", "east"))
+        if south > north:
+            raise HTTPException(status_code=400, detail="bbox south must not be above north.")
+        boxed = House.within(south, west, north, east)
+        if selected is None:
+            selected = boxed
+        else:
+            inside = set(boxed)
+            selected = [house for house in selected if house in inside]
+    return _list_page(House, params, lambda after, limit: _page_selection(selected, after, limit))
+
+@app.get("/houses/{house_name}", response_model=HouseOut)
+@on_loop
+def get_house(house_name: str, response: Response):
     """Return a single house by house name."""
     house = _find_house_by_name(house_name)
     if house is None:
         raise HTTPException(status_code=404, detail="House not found.")
+    response.headers["ETag"] = _entity_etag(house)
     return house.to_dict()
 
-@app.post("/houses", response_model=Dict[str, Any])
+@app.get("/houses/{house_name}/rooms", response_model=List[RoomOut])
+@on_loop
+def get_house_rooms(house_name: str, params: ListParams = Depends(list_params)):
+    """Return one house's rooms, paged like /rooms."""
+    house = _find_house_by_name(house_name)
+    if house is None:
+        raise HTTPException(status_code=404, detail="House not found.")
+    return _list_page(Room, params, house.rooms.page)
+
+@app.get("/houses/{house_name}/devices", response_model=List[DeviceOut])
+@on_loop
+def get_house_devices(house_name: str, params: ListParams = Depends(list_params)):
+    """Return the devices in all of one house's rooms, paged like /devices."""
+    house = _find_house_by_name(house_name)
+    if house is None:
+        raise HTTPException(status_code=404, detail="House not found.")
+    devices = Device.select(house=house)
+    return _list_page(Device, params, lambda after, limit: _page_selection(devices, after, limit))
+
+@app.post("/houses/{house_name}/command", response_model=Dict[str, Any])
+@on_loop
+def command_house(house_name: str, command: DeviceCommand):
+    """Apply one settings/status change to every device in a house (of ``device_type``, if given)."""
+    house = _find_house_by_name(house_name)
+    if house is None:
+        raise HTTPException(status_code=404, detail="House not found.")
+    return _run_command(command, house=house)
+
+@app.post("/houses", response_model=HouseOut)
+@on_loop
 def create_house(house_data: HouseCreate):
     """Create a new house."""
+    _check_name(house_data.name)
     # Check if house with the same name exists
     if _find_house_by_name(house_data.name):
         raise HTTPException(status_code=400, detail="House with this name already exists.")
@@ -173,20 +585,24 @@ def create_house(house_data: HouseCreate):
     )
     return new_house.to_dict()
 
-@app.put("/houses/{house_name}", response_model=Dict[str, Any])
-def update_house(house_name: str, house_data: HouseUpdate):
+@app.put("/houses/{house_name}", response_model=HouseOut)
+@on_loop
+def update_house(house_name: str, house_data: HouseUpdate, response: Response, if_match: Optional[str] = Header(None)):
     """Update a house's information."""
     house = _find_house_by_name(house_name)
     if house is None:
         raise HTTPException(status_code=404, detail="House not found.")
+    _check_if_match(house, if_match)
 
     # Only update fields that are provided (non-None)
     new_name = house_data.name if house_data.name is not None else house.name
     new_address = house_data.address if house_data.address is not None else house.address
     new_gps = house_data.gps if house_data.gps is not None else house.gps
 
-    if new_name != house.name and _find_house_by_name(new_name):
-        raise HTTPException(status_code=400, detail="Another house already has that name.")
+    if new_name != house.name:
+        _check_name(new_name)
+        if _find_house_by_name(new_name):
+            raise HTTPException(status_code=400, detail="Another house already has that name.")
 
     if house_data.owner_username is not None:
         new_owner = _find_user_by_username(house_data.owner_username)
@@ -196,14 +612,17 @@ def update_house(house_name: str, house_data: HouseUpdate):
         new_owner = house.owner
 
     house.update(new_name, new_address, new_gps, new_owner)
+    response.headers["ETag"] = _entity_etag(house)
     return house.to_dict()
 
 @app.delete("/houses/{house_name}", response_model=dict)
-def delete_house(house_name: str):
+@on_loop
+def delete_house(house_name: str, if_match: Optional[str] = Header(None)):
     """Delete a house."""
     house = _find_house_by_name(house_name)
     if house is None:
         raise HTTPException(status_code=404, detail="House not found.")
+    _check_if_match(house, if_match)
     house.delete()
     return {"message": f"House '{house_name}' deleted successfully."}
 
@@ -212,43 +631,735 @@ def delete_house(house_name: str):
 #               ROOM ROUTES
 # =========================================
 
-@app.get("/rooms", response_model=List[Dict[str, Any]])
-def get_all_rooms():
-    """Return a list of all rooms."""
-    return [r.to_dict() for r in Room.rooms]
+@app.get("/rooms", response_model=List[RoomOut])
+@on_loop
+def get_all_rooms(
+    request: Request,
+    params: ListParams = Depends(list_params),
+    room_type: Optional[str] = None,
+    floor: Optional[int] = None,
+    house: Optional[str] = None,
+    owner: Optional[str] = None,
+):
+    """Return a list of all rooms, or those matching every filter given."""
+    criteria = _filter_criteria(
+        {"room_type": room_type, "floor": floor},
+        {"house": (house, _find_house_by_name), "owner": (owner, _find_user_by_username)},
+    )
+    return _list_collection("rooms", Room, Room.rooms, request, params, criteria)
 
-@app.get("/rooms/{room_name}", response_model=Dict[str, Any])
-def get_room(room_name: str):
-    """Return a single room by name."""
-    room = _find_room_by_name(room_name)
+@app.get("/rooms/{room_name}", response_model=RoomOut)
+@on_loop
+def get_room(room_name: str, response: Response, house: Optional[str] = None):
+    """Return a single room by name (within ``house``) or ``id:<n>``."""
+    room = _scoped_room(room_name, house)
     if room is None:
         raise HTTPException(status_code=404, detail="Room not found.")
+    response.headers["ETag"] = _entity_etag(room)
     return room.to_dict()
 
-@app.post("/rooms", response_model=Dict[str, Any])
+@app.get("/rooms/{room_name}/devices", response_model=List[DeviceOut])
+@on_loop
+def get_room_devices(room_name: str, params: ListParams = Depends(list_params), house: Optional[str] = None):
+    """Return one room's devices, paged like /devices."""
+    room = _scoped_room(room_name, house)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Room not found.")
+    return _list_page(Device, params, room.devices.page)
+
+@app.post("/rooms/{room_name}/command", response_model=Dict[str, Any])
+@on_loop
+def command_room(room_name: str, command: DeviceCommand, house: Optional[str] = None):
+    """Apply one settings/status change to every device in a room (of ``device_type``, if given)."""
+    room = _scoped_room(room_name, house)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Room not found.")
+    return _run_command(command, room=room)
+
+@app.post("/rooms", response_model=RoomOut)
+@on_loop
 def create_room(room_data: RoomCreate):
     """Create a new room."""
-    # Check if a room with the same name already exists
-    if _find_room_by_name(room_data.name):
-        raise HTTPException(status_code=400, detail="Room with this name already exists.")
+    return _plan_room_create(room_data)()
+
+@app.put("/rooms/{room_name}", response_model=RoomOut)
+@on_loop
+def update_room(
+    room_name: str,
+    room_data: RoomUpdate,
+    response: Response,
+    house: Optional[str] = None,
+    if_match: Optional[str] = Header(None),
+):
+    """Update room details."""
+    room = _scoped_room(room_name, house)
+    _check_if_match(room, if_match)
+    result = _plan_room_update(room_name, room_data, scope=house)()
+    response.headers["ETag"] = _entity_etag(room)
+    return result
 
-    house = _find_house_by_name(room_data.house_name)
-    if house is None:
-        raise HTTPException(status_code=404, detail="House not found for this room.")
+@app.delete("/rooms/{room_name}", response_model=dict)
+@on_loop
+def delete_room(room_name: str, house: Optional[str] = None, if_match: Optional[str] = Header(None)):
+    """Delete a room."""
+    _check_if_match(_scoped_room(room_name, house), if_match)
+    return _plan_room_delete(room_name, scope=house)()
+
+@app.post("/rooms:batch", response_model=Dict[str, Any])
+@on_loop
+def create_rooms(batch: RoomBatchCreate, response: Response):
+    """Create many rooms in one request."""
+    houses = {}
+    return _run_batch(
+        batch.items, lambda item, claimed: _plan_room_create(item, claimed, houses), batch.atomic, response
+    )
 
-    new_room = Room(
-        name=room_data.name,
-        floor=room_data.floor,
-        size=room_data.size,
-        house=house,
-        room_type=room_data.room_type,
+@app.patch("/rooms:batch", response_model=Dict[str, Any])
+@on_loop
+def update_rooms(batch: RoomBatchUpdate, response: Response):
+    """Update many rooms in one request."""
+    houses = {}
+    return _run_batch(
+        batch.items,
+        lambda item, claimed: _plan_room_update(item.room_name, item, claimed, houses),
+        batch.atomic,
+        response,
     )
-    return new_room.to_dict()
 
-@app.put("/rooms/{room_name}", response_model=Dict[str, Any])
-def update_room(room_name: str, room_data: RoomUpdate):
-    """Update room details."""
-    room = _find_room_by_name(room_name)
+@app.delete("/rooms:batch", response_model=Dict[str, Any])
+@on_loop
+def delete_rooms(batch: BatchDelete, response: Response):
+    """Delete many rooms in one request."""
+    return _run_batch(batch.names, _plan_room_delete, batch.atomic, response)
+
+
+# =========================================
+#              DEVICE ROUTES
+# =========================================
+
+@app.get("/devices", response_model=List[DeviceOut])
+@on_loop
+def get_all_devices(
+    request: Request,
+    params: ListParams = Depends(list_params),
+    device_type: Optional[str] = None,
+    status: Optional[str] = None,
+    room: Optional[str] = None,
+    house: Optional[str] = None,
+    owner: Optional[str] = None,
+):
+    """Return a list of all devices, or those matching every filter given."""
+    criteria = _filter_criteria(
+        {"device_type": device_type, "status": status},
+        {
+            "room": (room, lambda name: _scoped_room(name, house)),
+            "house": (house, _find_house_by_name),
+            "owner": (owner, _find_user_by_username),
+        },
+    )
+    return _list_collection("devices", Device, Device.devices, request, params, criteria)
+
+@app.get("/devices/{device_name}", response_model=DeviceOut)
+@on_loop
+def get_device(device_name: str, response: Response, room: Optional[str] = None, house: Optional[str] = None):
+    """Return a single device by name (within ``room``/``house``) or ``id:<n>``."""
+    device = _scoped_device(device_name, room, house)
+    if device is None:
+        raise HTTPException(status_code=404, detail="Device not found.")
+    response.headers["ETag"] = _entity_etag(device)
+    return device.to_dict()
+
+@app.post("/devices", response_model=DeviceOut)
+@on_loop
+def create_device(device_data: DeviceCreate):
+    """Create a new device."""
+    return _plan_device_create(device_data)()
+
+@app.put("/devices/{device_name}", response_model=DeviceOut)
+@on_loop
+def update_device(
+    device_name: str,
+    device_data: DeviceUpdate,
+    response: Response,
+    room: Optional[str] = None,
+    house: Optional[str] = None,
+    if_match: Optional[str] = Header(None),
+):
+    """Update device details."""
+    device = _scoped_device(device_name, room, house)
+    _check_if_match(device, if_match)
+    result = _plan_device_update(device_name, device_data, scope=(room, house))()
+    response.headers["ETag"] = _entity_etag(device)
+    return result
+
+# Members of the document PATCH /devices/{device_name} edits.
+DEVICE_PATCH_FIELDS = ("device_type", "name", "status", "settings", "data")
+
+@app.patch("/devices/{device_name}", response_model=DeviceOut)
+async def patch_device(
+    device_name: str,
+    request: Request,
+    room: Optional[str] = None,
+    house: Optional[str] = None,
+    if_match: Optional[str] = Header(None),
+):
+    """Change part of a device.
+
+    The body is a merge patch (RFC 7396, ``application/merge-patch+json`` or
+    plain JSON) or a JSON Patch (RFC 6902, ``application/json-patch+json``)
+    over ``{device_type, name, status, settings, data}``.  Nested keys in
+    ``settings``/``data`` are changed without resending the rest, and only
+    the keys that actually changed are reported to storage and the change
+    feeds.
+    """
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+    # Locked like an ``on_loop`` route, once the body has been read.
+    if not model_lock.acquire(blocking=False):
+        await _acquire_model_lock()
+    try:
+        device = _patch_device(device_name, (room, house), body, content_type, if_match)
+        return FastJSONResponse(device.to_dict(), headers={"ETag": _entity_etag(device)})
+    finally:
+        model_lock.release()
+
+def _patch_device(device_name: str, scope: tuple, body: bytes, content_type: str, if_match: Optional[str]) -> Device:
+    """Apply a PATCH body to the device it names and return the device; the caller holds the model lock."""
+    try:
+        patch = json.loads(body, parse_constant=_reject_constant, parse_float=_finite_float)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"The patch is not valid JSON: {exc}")
+    device = _scoped_device(device_name, *scope)
+    if device is None:
+        raise HTTPException(status_code=404, detail="Device not found.")
+    _check_if_match(device, if_match)
+
+    if content_type.startswith("application/json-patch+json"):
+        changes = _json_patch_changes(device, patch)
+    else:
+        if not isinstance(patch, dict):
+            raise HTTPException(status_code=400, detail="A merge patch must be a JSON object.")
+        changes = dict(patch)
+        for attr in ("settings", "data"):
+            if attr in changes and changes[attr] is None:  # removing the member empties it
+                changes[attr] = dict.fromkeys(getattr(device, attr))
+    unknown = set(changes) - set(DEVICE_PATCH_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Can't patch {', '.join(sorted(unknown))}.")
+    for attr in ("device_type", "name", "status"):
+        if attr in changes and not isinstance(changes[attr], str):
+            raise HTTPException(status_code=400, detail=f"{attr} must be a string.")
+    for attr in ("settings", "data"):
+        if attr in changes and not isinstance(changes[attr], dict):
+            raise HTTPException(status_code=400, detail=f"{attr} must be an object.")
+
+    new_name = changes.get("name", device.name)
+    if new_name != device.name:
+        _check_name(new_name)
+    if device.room is not None and device.room.devices.get(new_name) not in (None, device):
+        raise HTTPException(status_code=400, detail="Another device in that room already has that name.")
+    device.merge(**changes)
+    return device
+
+def _json_patch_changes(device, operations) -> Dict[str, Any]:
+    """Apply JSON Patch ``operations`` to the device's document and return them as a merge patch."""
+    document = {attr: getattr(device, attr) for attr in DEVICE_PATCH_FIELDS}
+    try:
+        patched = json_patch(document, operations)
+    except InvalidPatchError as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON Patch: {exc}")
+    except PatchConflictError as exc:
+        raise HTTPException(status_code=409, detail=f"The patch could not be applied: {exc}")
+    if not isinstance(patched, dict) or set(patched) != set(DEVICE_PATCH_FIELDS):
+        raise HTTPException(status_code=400, detail=f"The patched device must keep exactly {', '.join(DEVICE_PATCH_FIELDS)}.")
+    changes = {}
+    for attr, value in patched.items():
+        if value is document[attr]:
+            continue
+        if attr in ("settings", "data") and isinstance(value, dict):
+            value = merge_diff(document[attr], value)
+            if value is None:
+                raise HTTPException(status_code=400, detail=f"{attr} values can't be null.")
+        changes[attr] = value
+    return changes
+
+def _reject_constant(name: str):
+    # json.loads accepts NaN and Infinity, which aren't JSON and can't be sent back out.
+    raise ValueError(f"{name} is not a JSON value")
+
+def _finite_float(text: str) -> float:
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError(f"{text} is out of range")
+    return value
+
+@app.delete("/devices/{device_name}", response_model=dict)
+@on_loop
+def delete_device(
+    device_name: str, room: Optional[str] = None, house: Optional[str] = None, if_match: Optional[str] = Header(None)
+):
+    """Delete a device."""
+    _check_if_match(_scoped_device(device_name, room, house), if_match)
+    return _plan_device_delete(device_name, scope=(room, house))()
+
+@app.post("/devices:batch", response_model=Dict[str, Any])
+@on_loop
+def create_devices(batch: DeviceBatchCreate, response: Response):
+    """Create many devices in one request."""
+    rooms = {}
+    return _run_batch(
+        batch.items, lambda item, claimed: _plan_device_create(item, claimed, rooms), batch.atomic, response
+    )
+
+@app.patch("/devices:batch", response_model=Dict[str, Any])
+@on_loop
+def update_devices(batch: DeviceBatchUpdate, response: Response):
+    """Update many devices in one request."""
+    rooms = {}
+    return _run_batch(
+        batch.items,
+        lambda item, claimed: _plan_device_update(item.device_name, item, claimed, rooms),
+        batch.atomic,
+        response,
+    )
+
+@app.delete("/devices:batch", response_model=Dict[str, Any])
+@on_loop
+def delete_devices(batch: BatchDelete, response: Response):
+    """Delete many devices in one request."""
+    return _run_batch(batch.names, _plan_device_delete, batch.atomic, response)
+
+
+# =========================================
+#             TELEMETRY ROUTES
+# =========================================
+
+@app.post("/devices/{device_name}/telemetry", response_model=Dict[str, Any])
+@on_loop
+def add_telemetry(
+    device_name: str, upload: TelemetryUpload, room: Optional[str] = None, house: Optional[str] = None
+):
+    """Append timestamped readings to a device's history."""
+    device = _scoped_device(device_name, room, house)
+    if device is None:
+        raise HTTPException(status_code=404, detail="Device not found.")
+    accepted = sum(
+        telemetry.append(device, sample.metric, sample.ts, sample.value) for sample in upload.samples
+    )
+    return {"accepted": accepted, "rejected": len(upload.samples) - accepted}
+
+@app.get("/devices/{device_name}/telemetry", response_model=Dict[str, Any])
+@on_loop
+def get_telemetry(
+    device_name: str,
+    metric: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    bucket: Optional[float] = Query(None, gt=0),
+    room: Optional[str] = None,
+    house: Optional[str] = None,
+):
+    """Return readings for one metric, optionally as min/max/mean per time bucket.
+
+    Without ``metric``, list the metrics recorded for the device.
+    """
+    device = _scoped_device(device_name, room, house)
+    if device is None:
+        raise HTTPException(status_code=404, detail="Device not found.")
+    if metric is None:
+        return {"device": device.name, "metrics": telemetry.metrics(device)}
+    key = "buckets" if bucket is not None else "samples"
+    return {"device": device.name, "metric": metric, key: telemetry.query(device, metric, start, end, bucket)}
+
+
+@app.post("/telemetry", response_model=Dict[str, Any])
+async def ingest_telemetry(request: Request):
+    """Ingest readings for many devices at once in a columnar layout.
+
+    The body is ``{"device": [...], "metric": [...], "ts": [...], "value": [...]}``
+    with one entry per reading, as JSON or (if msgpack is installed) as
+    ``application/msgpack``.  The body is parsed directly rather than
+    through a pydantic model to keep large batches cheap.  Each device's
+    ``data`` is then updated once with its newest value per metric.
+    """
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/msgpack") and msgpack is None:
+        raise HTTPException(status_code=415, detail="msgpack is not installed on this server.")
+    return FastJSONResponse(await run_in_threadpool(_ingest, body, content_type))
+
+@synchronized
+def _ingest(body: bytes, content_type: str):
+    try:
+        if content_type.startswith("application/msgpack"):
+            columns = msgpack.unpackb(body)
+        else:
+            columns = json.loads(body)
+        accepted, rejected, unknown = ingestor.submit(
+            columns["device"], columns["metric"], columns["ts"], columns["value"]
+        )
+    except (ValueError, TypeError, KeyError) as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid telemetry batch: {exc}")
+    finally:
+        ingestor.flush()
+    return {"accepted": accepted, "rejected": rejected, "unknown_devices": unknown}
+
+
+# =========================================
+#            CHANGE FEED ROUTES
+# =========================================
+
+SSE_HEARTBEAT_SECONDS = 15
+
+@app.websocket("/changes/ws")
+async def change_feed_ws(websocket: WebSocket, user: Optional[str] = None, house: Optional[str] = None, room: Optional[str] = None):
+    """Push a JSON message for every change in scope until the client disconnects."""
+    try:
+        filters = _feed_filters(user, house, room)
+    except HTTPException as exc:
+        await websocket.close(code=1008, reason=exc.detail)
+        return
+    await websocket.accept()
+    subscription = events.subscribe(**filters)
+    receiver = asyncio.ensure_future(websocket.receive())
+    try:
+        while True:
+            getter = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                getter.cancel()
+                if receiver.result()["type"] == "websocket.disconnect":
+                    return
+                receiver = asyncio.ensure_future(websocket.receive())  # client messages are ignored
+                continue
+            await websocket.send_text(_encode_json(getter.result()).decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        subscription.close()
+
+@app.get("/changes/sse")
+async def change_feed_sse(request: Request, user: Optional[str] = None, house: Optional[str] = None, room: Optional[str] = None):
+    """Server-Sent Events version of /changes/ws, for clients without WebSockets."""
+    subscription = events.subscribe(**_feed_filters(user, house, room))
+    return StreamingResponse(
+        _sse_events(request, subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+async def _sse_events(request, subscription):
+    try:
+        while not await request.is_disconnected():
+            try:
+                event = await asyncio.wait_for(subscription.get(), SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            yield _sse_message(event)
+    finally:
+        subscription.close()
+
+def _sse_message(event):
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (
+        event["version"], event["op"].encode(), _encode_json(event)
+    )
+
+def _feed_filters(user, house, room):
+    """Resolve the feed's ``user``/``house``/``room`` names to the ids events are scoped by."""
+    filters = {}
+    for kind, name, find in (
+        ("user", user, _find_user_by_username),
+        ("house", house, _find_house_by_name),
+        ("room", room, lambda name: _scoped_room(name, house)),
+    ):
+        if name is None:
+            continue
+        entity = find(name)
+        if entity is None:
+            raise HTTPException(status_code=404, detail=f"{kind.capitalize()} '{name}' not found.")
+        filters[kind] = entity.id
+    return filters
+
+
+# =========================================
+#              EXPORT ROUTES
+# =========================================
+
+EXPORT_CHUNK_SIZE = 500
+
+@app.get("/export")
+async def export_all():
+    """Stream every entity as NDJSON, one flat record per line, parents first.
+
+    Entities created while the export runs are left out.  If the export
+    can't stay consistent (an entity it has yet to send moved under one of
+    those), the stream is cut off rather than finished without it.
+    """
+    return StreamingResponse(_export_chunks(), media_type="application/x-ndjson")
+
+def _export_chunks():
+    # The lock is taken per chunk so a long export doesn't stall writers.
+    entities = walk(EXPORT_CHUNK_SIZE)
+    while True:
+        with model_lock:
+            lines = [_encode_json(entity.to_record()) for entity in islice(entities, EXPORT_CHUNK_SIZE)]
+        if not lines:
+            return
+        yield b"\n".join(lines) + b"\n"
+
+
+# =========================================
+#            AUTOMATION ROUTES
+# =========================================
+
+@app.post("/schedules", response_model=Dict[str, Any])
+@on_loop
+def create_schedule(job_data: ScheduleCreate):
+    """Schedule a settings/status change for a device, once or every ``every`` seconds."""
+    device = _scoped_device(job_data.device_name, job_data.room_name, job_data.house_name)
+    if device is None:
+        raise HTTPException(status_code=404, detail="Device not found.")
+    if (job_data.at is None) == (job_data.in_seconds is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of at and in_seconds.")
+    at = job_data.at if job_data.at is not None else scheduler.clock() + job_data.in_seconds
+    try:
+        job = scheduler.schedule(device, at, job_data.settings, job_data.status, job_data.every)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return job.to_dict()
+
+@app.get("/schedules", response_model=List[Dict[str, Any]])
+@on_loop
+def get_schedules():
+    """Return the pending jobs, soonest first."""
+    return [job.to_dict() for job in scheduler.jobs()]
+
+@app.delete("/schedules/{job_id}", response_model=dict)
+@on_loop
+def delete_schedule(job_id: int):
+    """Cancel a pending job."""
+    if not scheduler.cancel(job_id):
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return {"message": f"Job {job_id} cancelled."}
+
+@app.post("/rules", response_model=Dict[str, Any])
+@on_loop
+def create_rule(rule_data: RuleCreate):
+    """Add a rule that changes a device when another's data meets a condition."""
+    watched = _scoped_device(rule_data.device_name, rule_data.room_name, rule_data.house_name)
+    if watched is None:
+        raise HTTPException(status_code=404, detail="Device not found.")
+    target = None
+    if rule_data.target_name is not None:
+        target = _scoped_device(rule_data.target_name, rule_data.target_room_name, rule_data.target_house_name)
+        if target is None:
+            raise HTTPException(status_code=404, detail="Target device not found.")
+    try:
+        rule = rules.add(
+            watched, rule_data.field, rule_data.op, rule_data.value, target, rule_data.settings, rule_data.status
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return rule.to_dict()
+
+@app.get("/rules", response_model=List[Dict[str, Any]])
+@on_loop
+def get_rules():
+    """Return every rule."""
+    return [rule.to_dict() for rule in rules.rules()]
+
+@app.delete("/rules/{rule_id}", response_model=dict)
+@on_loop
+def delete_rule(rule_id: int):
+    """Remove a rule."""
+    if not rules.remove(rule_id):
+        raise HTTPException(status_code=404, detail="Rule not found.")
+    return {"message": f"Rule {rule_id} removed."}
+
+
+# =========================================
+#               STATS ROUTES
+# =========================================
+
+@app.get("/stats", response_model=Dict[str, Any])
+@on_loop
+def get_stats():
+    """Return entity counts and totals, kept up to date as entities change."""
+    return summary()
+
+@app.get("/stats/houses", response_model=Dict[str, int])
+@on_loop
+def get_rooms_per_house(
+    limit: Optional[int] = Query(None, ge=1, le=1000), cursor: Optional[int] = Query(None, ge=0)
+):
+    """Return the number of rooms in each house, paged by house id like /houses."""
+    return _counts_page(*rooms_per_house(cursor, limit))
+
+@app.get("/stats/users", response_model=Dict[str, int])
+@on_loop
+def get_houses_per_user(
+    limit: Optional[int] = Query(None, ge=1, le=1000), cursor: Optional[int] = Query(None, ge=0)
+):
+    """Return the number of houses each user owns, paged by user id like /users."""
+    return _counts_page(*houses_per_user(cursor, limit))
+
+
+# =========================================
+#       HELPER FUNCTIONS (Lookups)
+# =========================================
+
+# Every lookup takes a reference: either a name or ``id:<n>``, the entity's
+# stable id.  Usernames and house names are unique, but room names are only
+# unique within a house and device names within a room, so a bare room or
+# device name is resolved inside its parent when one is given (the child
+# registries double as (house, room name) and (room, device name) indexes)
+# and raises 409 when it is shared by several entities.
+
+ID_PREFIX = "id:"
+
+def _ref_id(ref: str) -> Optional[int]:
+    if ref.startswith(ID_PREFIX) and ref[len(ID_PREFIX):].isdigit():
+        return int(ref[len(ID_PREFIX):])
+    return None
+
+def _check_name(name: str) -> None:
+    """Refuse a new name that reads as an ``id:<n>`` reference, since lookups could never reach it."""
+    if _ref_id(name) is not None:
+        raise HTTPException(status_code=400, detail=f"Names of the form '{ID_PREFIX}<n>' are reserved for ids.")
+
+def _find_user_by_username(username: str) -> Optional[User]:
+    entity_id = _ref_id(username)
+    if entity_id is not None:
+        return User.users.get_by_id(entity_id)
+    return User.users.get(username)
+
+def _find_house_by_name(name: str) -> Optional[House]:
+    entity_id = _ref_id(name)
+    if entity_id is not None:
+        return House.houses.get_by_id(entity_id)
+    return House.houses.get(name)
+
+def _find_room_by_name(name: str, house: Optional[House] = None) -> Optional[Room]:
+    entity_id = _ref_id(name)
+    if entity_id is not None:
+        room = Room.rooms.get_by_id(entity_id)
+        return room if room is not None and (house is None or room.house is house) else None
+    if house is not None:
+        return house.rooms.get(name)
+    return _only(Room.rooms.get_all(name), f"Several rooms are named '{name}'; pass the house or use the room's id.")
+
+def _find_device_by_name(name: str, room: Optional[Room] = None) -> Optional[Device]:
+    entity_id = _ref_id(name)
+    if entity_id is not None:
+        device = Device.devices.get_by_id(entity_id)
+        return device if device is not None and (room is None or device.room is room) else None
+    if room is not None:
+        return room.devices.get(name)
+    return _only(Device.devices.get_all(name), f"Several devices are named '{name}'; pass the room or use the device's id.")
+
+def _find_unique_device(name: str) -> Optional[Device]:
+    """Like _find_device_by_name, but a shared name counts as unknown (for bulk ingest)."""
+    try:
+        return _find_device_by_name(name)
+    except HTTPException:
+        return None
+
+def _only(matches: list, ambiguous: str):
+    if len(matches) > 1:
+        raise HTTPException(status_code=409, detail=ambiguous)
+    return matches[0] if matches else None
+
+def _scoped_room(room_name: str, house_name: Optional[str] = None) -> Optional[Room]:
+    """Find a room, within the house named by ``house_name`` if given."""
+    house = None
+    if house_name is not None:
+        house = _find_house_by_name(house_name)
+        if house is None:
+            return None
+    return _find_room_by_name(room_name, house)
+
+def _scoped_device(device_name: str, room_name: Optional[str] = None, house_name: Optional[str] = None) -> Optional[Device]:
+    """Find a device, within the room (and house) named if given."""
+    if room_name is None:
+        if house_name is None:
+            return _find_device_by_name(device_name)
+        house = _find_house_by_name(house_name)
+        if house is None:
+            raise HTTPException(status_code=404, detail="House not found.")
+        if _ref_id(device_name) is not None:
+            device = _find_device_by_name(device_name)
+            return device if device is not None and device.room is not None and device.room.house is house else None
+        return _only(
+            Device.select(house=house, name=device_name),
+            f"Several devices in this house are named '{device_name}'; pass the room or use the device's id.",
+        )
+    room = _scoped_room(room_name, house_name)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Room not found.")
+    return _find_device_by_name(device_name, room)
+
+
+# =========================================
+#   HELPER FUNCTIONS (Room/device changes)
+# =========================================
+
+# Each _plan_* function validates one change against the current state and
+# returns a callable that applies it, raising HTTPException if the change is
+# invalid.  The single-item routes call the plan straight away; the batch
+# routes validate every item first.  ``claimed`` collects the names a batch
+# touches so two items can't fight over one name, and ``houses``/``rooms``
+# memoize parent lookups across the batch.
+
+MAX_BATCH_SIZE = 10_000
+
+def _claim(claimed: Optional[set], *keys: tuple) -> None:
+    """Reserve ``(parent id, name)`` keys for this batch item."""
+    if claimed is None:
+        return
+    for key in keys:
+        if key in claimed:
+            raise HTTPException(status_code=400, detail=f"'{key[-1]}' is used more than once in this batch.")
+    claimed.update(keys)
+
+def _resolve(cache: Optional[dict], key, find):
+    if cache is None:
+        return find(*key)
+    if key not in cache:
+        cache[key] = find(*key)
+    return cache[key]
+
+def _plan_room_create(room_data: RoomCreate, claimed: Optional[set] = None, houses: Optional[dict] = None):
+    house = _resolve(houses, (room_data.house_name,), _find_house_by_name)
+    if house is None:
+        raise HTTPException(status_code=404, detail="House not found for this room.")
+
+    _check_name(room_data.name)
+    # Room names only need to be unique within their house
+    if house.rooms.get(room_data.name):
+        raise HTTPException(status_code=400, detail="Room with this name already exists in this house.")
+    _claim(claimed, (house.id, room_data.name))
+
+    def apply():
+        new_room = Room(
+            name=room_data.name,
+            floor=room_data.floor,
+            size=room_data.size,
+            house=house,
+            room_type=room_data.room_type,
+        )
+        return new_room.to_dict()
+    return apply
+
+def _plan_room_update(
+    room_name: str,
+    room_data: RoomUpdate,
+    claimed: Optional[set] = None,
+    houses: Optional[dict] = None,
+    scope: Optional[str] = None,
+):
+    room = _scoped_room(room_name, scope)
     if room is None:
         raise HTTPException(status_code=404, detail="Room not found.")
 
@@ -257,71 +1368,66 @@ def update_room(room_name: str, room_data: RoomUpdate):
     new_size = room_data.size if room_data.size is not None else room.size
     new_room_type = room_data.room_type if room_data.room_type is not None else room.room_type
 
-    if new_name != room.name and _find_room_by_name(new_name):
-        raise HTTPException(status_code=400, detail="Another room already has that name.")
-
     if room_data.house_name is not None:
-        new_house = _find_house_by_name(room_data.house_name)
+        new_house = _resolve(houses, (room_data.house_name,), _find_house_by_name)
         if new_house is None:
             raise HTTPException(status_code=404, detail="New house not found.")
     else:
         new_house = room.house
 
-    room.update(new_name, new_floor, new_size, new_house, new_room_type)
-    return room.to_dict()
+    if new_name != room.name:
+        _check_name(new_name)
+    if new_house is not None and new_house.rooms.get(new_name) not in (None, room):
+        raise HTTPException(status_code=400, detail="Another room in that house already has that name.")
+    _claim(claimed, *{_room_key(room), (_id_of(new_house), new_name)})
 
-@app.delete("/rooms/{room_name}", response_model=dict)
-def delete_room(room_name: str):
-    """Delete a room."""
-    room = _find_room_by_name(room_name)
+    def apply():
+        room.update(new_name, new_floor, new_size, new_house, new_room_type)
+        return room.to_dict()
+    return apply
+
+def _plan_room_delete(room_name: str, claimed: Optional[set] = None, scope: Optional[str] = None):
+    room = _scoped_room(room_name, scope)
     if room is None:
         raise HTTPException(status_code=404, detail="Room not found.")
-    room.delete()
-    return {"message": f"Room '{room_name}' deleted successfully."}
+    _claim(claimed, _room_key(room))
 
+    def apply():
+        room.delete()
+        return {"message": f"Room '{room_name}' deleted successfully."}
+    return apply
 
-# =========================================
-#              DEVICE ROUTES
-# =========================================
-
-@app.get("/devices", response_model=List[Dict[str, Any]])
-def get_all_devices():
-    """Return a list of all devices."""
-    return [d.to_dict() for d in Device.devices]
-
-@app.get("/devices/{device_name}", response_model=Dict[str, Any])
-def get_device(device_name: str):
-    """Return a single device by name."""
-    device = _find_device_by_name(device_name)
-    if device is None:
-        raise HTTPException(status_code=404, detail="Device not found.")
-    return device.to_dict()
-
-@app.post("/devices", response_model=Dict[str, Any])
-def create_device(device_data: DeviceCreate):
-    """Create a new device."""
-    # Check if device with the same name already exists
-    if _find_device_by_name(device_data.name):
-        raise HTTPException(status_code=400, detail="Device with this name already exists.")
-
-    room = _find_room_by_name(device_data.room_name)
+def _plan_device_create(device_data: DeviceCreate, claimed: Optional[set] = None, rooms: Optional[dict] = None):
+    room = _resolve(rooms, (device_data.room_name, device_data.house_name), _scoped_room)
     if room is None:
         raise HTTPException(status_code=404, detail="Room not found for this device.")
 
-    new_device = Device(
-        device_type=device_data.device_type,
-        name=device_data.name,
-        room=room,
-        settings=device_data.settings,
-        data=device_data.data,
-        status=device_data.status,
-    )
-    return new_device.to_dict()
-
-@app.put("/devices/{device_name}", response_model=Dict[str, Any])
-def update_device(device_name: str, device_data: DeviceUpdate):
-    """Update device details."""
-    device = _find_device_by_name(device_name)
+    _check_name(device_data.name)
+    # Device names only need to be unique within their room
+    if room.devices.get(device_data.name):
+        raise HTTPException(status_code=400, detail="Device with this name already exists in this room.")
+    _claim(claimed, (room.id, device_data.name))
+
+    def apply():
+        new_device = Device(
+            device_type=device_data.device_type,
+            name=device_data.name,
+            room=room,
+            settings=device_data.settings,
+            data=device_data.data,
+            status=device_data.status,
+        )
+        return new_device.to_dict()
+    return apply
+
+def _plan_device_update(
+    device_name: str,
+    device_data: DeviceUpdate,
+    claimed: Optional[set] = None,
+    rooms: Optional[dict] = None,
+    scope: tuple = (None, None),
+):
+    device = _scoped_device(device_name, *scope)
     if device is None:
         raise HTTPException(status_code=404, detail="Device not found.")
 
@@ -331,41 +1437,225 @@ def update_device(device_name: str, device_data: DeviceUpdate):
     new_data = device_data.data if device_data.data is not None else device.data
     new_status = device_data.status if device_data.status is not None else device.status
 
-    if new_name != device.name and _find_device_by_name(new_name):
-        raise HTTPException(status_code=400, detail="Another device with that name already exists.")
-
     if device_data.room_name is not None:
-        new_room = _find_room_by_name(device_data.room_name)
+        new_room = _resolve(rooms, (device_data.room_name, device_data.house_name), _scoped_room)
         if new_room is None:
             raise HTTPException(status_code=404, detail="New room not found.")
     else:
         new_room = device.room
 
-    device.update(new_device_type, new_name, new_room, new_settings, new_data, new_status)
-    return device.to_dict()
+    if new_name != device.name:
+        _check_name(new_name)
+    if new_room is not None and new_room.devices.get(new_name) not in (None, device):
+        raise HTTPException(status_code=400, detail="Another device in that room already has that name.")
+    _claim(claimed, *{_device_key(device), (_id_of(new_room), new_name)})
 
-@app.delete("/devices/{device_name}", response_model=dict)
-def delete_device(device_name: str):
-    """Delete a device."""
-    device = _find_device_by_name(device_name)
+    def apply():
+        device.update(new_device_type, new_name, new_room, new_settings, new_data, new_status)
+        return device.to_dict()
+    return apply
+
+def _plan_device_delete(device_name: str, claimed: Optional[set] = None, scope: tuple = (None, None)):
+    device = _scoped_device(device_name, *scope)
     if device is None:
         raise HTTPException(status_code=404, detail="Device not found.")
-    device.delete()
-    return {"message": f"Device '{device_name}' deleted successfully."}
+    _claim(claimed, _device_key(device))
+
+    def apply():
+        device.delete()
+        return {"message": f"Device '{device_name}' deleted successfully."}
+    return apply
+
+def _run_command(command: DeviceCommand, **scope) -> Dict[str, Any]:
+    """Apply a scene command to the devices under ``scope`` and count what changed.
+
+    Runs in one pass under the caller's lock, so no other request sees the
+    scene half applied.
+    """
+    if not command.settings and command.status is None:
+        raise HTTPException(status_code=400, detail="A command must change settings or status.")
+    if command.device_type is not None:
+        scope["device_type"] = command.device_type
+    devices = Device.select(**scope)
+    changed = 0
+    for device in devices:
+        version = device.version
+        apply_change(device, command.settings, command.status)
+        changed += device.version != version
+    return {"matched": len(devices), "changed": changed}
+
+def _id_of(entity) -> Optional[int]:
+    return entity.id if entity is not None else None
+
+def _room_key(room: Room) -> tuple:
+    return (_id_of(room.house), room.name)
+
+def _device_key(device: Device) -> tuple:
+    return (_id_of(device.room), device.name)
+
+def _run_batch(items: list, plan, atomic: bool, response: Response) -> Dict[str, Any]:
+    """Validate every item, then apply the valid ones and report per item.
+
+    With ``atomic`` set, nothing is applied unless every item is valid; the
+    valid items are then reported with status 424 and the request fails with 400.
+    """
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batches are limited to {MAX_BATCH_SIZE} items.")
+    claimed = set()
+    plans = []
+    results = []
+    for index, item in enumerate(items):
+        try:
+            plans.append(plan(item, claimed))
+            results.append(None)
+        except HTTPException as exc:
+            plans.append(None)
+            results.append({"index": index, "status": exc.status_code, "detail": exc.detail})
+
+    failed = any(result is not None for result in results)
+    applied = not (atomic and failed)
+    for index, apply in enumerate(plans):
+        if apply is None:
+            continue
+        if applied:
+            results[index] = {"index": index, "status": 200, "result": apply()}
+        else:
+            results[index] = {"index": index, "status": 424, "detail": "Not applied because another item failed."}
+    if not applied:
+        response.status_code = 400
+    return {"applied": applied, "results": results}
 
 
 # =========================================
-#       HELPER FUNCTIONS (Lookups)
+#     HELPER FUNCTIONS (Response cache)
 # =========================================
 
-def _find_user_by_username(username: str) -> Optional[User]:
-    return next((u for u in User.users if u.username == username), None)
-
-def _find_house_by_name(name: str) -> Optional[House]:
-    return next((h for h in House.houses if h.name == name), None)
-
-def _find_room_by_name(name: str) -> Optional[Room]:
-    return next((r for r in Room.rooms if r.name == name), None)
-
-def _find_device_by_name(name: str) -> Optional[Device]:
-    return next((d for d in Device.devices if d.name == name), None)
+# Collection listings are encoded once per registry version and served as
+# bytes until something in that collection (or below it) changes.  The boot id
+# keeps ETags from a previous process from matching after a restart.
+_BOOT_ID = uuid.uuid4().hex[:8]
+_collection_cache: Dict[str, tuple] = {}
+
+def _encode_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+def _entity_etag(entity) -> str:
+    # Tags the entity's whole representation, children included, so it uses
+    # the revision rather than the version.  Like the collection ETags it
+    # includes the boot id: revisions are not persisted, so they start over
+    # after a restart.
+    return f'"{type(entity).__name__.lower()}-{entity.id}-{_BOOT_ID}-{entity.revision}"'
+
+def _check_if_match(entity, if_match: Optional[str]) -> None:
+    """Raise 412 unless ``If-Match`` is absent or names the entity's current ETag."""
+    if if_match is None or entity is None:
+        return
+    candidates = [candidate.strip() for candidate in if_match.split(",")]
+    if "*" not in candidates and _entity_etag(entity) not in candidates:
+        raise HTTPException(status_code=412, detail="The resource has changed since it was read (If-Match failed).")
+
+class FastJSONResponse(Response):
+    """JSON response encoded with ``_encode_json`` (orjson when it is installed)."""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return _encode_json(content)
+
+def _json_response(content: Any, headers: Optional[Dict[str, str]] = None) -> Response:
+    return FastJSONResponse(content, headers=headers)
+
+def _parse_fields(fields: Optional[str], entity_cls) -> Optional[List[str]]:
+    if fields is None:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    allowed = entity_cls.serializable_fields()
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}.")
+    return requested
+
+def _filter_criteria(fields: Dict[str, Any], ancestors: Dict[str, tuple]) -> Optional[Dict[str, Any]]:
+    """Turn list filters into ``Entity.select()`` criteria (None if there are none).
+
+    ``ancestors`` maps a criterion to ``(name, lookup)``; a name that doesn't
+    exist still becomes a criterion, one that matches nothing.
+    """
+    criteria = {field: value for field, value in fields.items() if value is not None}
+    for attr, (name, find) in ancestors.items():
+        if name is not None:
+            criteria[attr] = find(name)
+    return criteria or None
+
+def _parse_coordinates(text: str, param: str, names: tuple) -> List[float]:
+    """Split a comma-separated query parameter into latitudes/longitudes, or raise 400."""
+    try:
+        values = [float(part) for part in text.split(",")]
+    except ValueError:
+        values = []
+    if len(values) != len(names):
+        raise HTTPException(status_code=400, detail=f"{param} must be {','.join(names)}.")
+    for name, value in zip(names, values):
+        bound = 90 if name in ("lat", "south", "north") else 180
+        if not -bound <= value <= bound:
+            raise HTTPException(status_code=400, detail=f"{param} {name} must be between -{bound} and {bound}.")
+    return values
+
+def _list_collection(
+    name: str, entity_cls, registry, request: Request, params: ListParams, criteria: Optional[Dict[str, Any]] = None
+) -> Response:
+    if criteria is None and params.is_default():
+        return _cached_collection_response(name, registry, request)
+    if criteria is None:
+        return _list_page(entity_cls, params, registry.page)
+    selected = entity_cls.select(**criteria)
+    return _list_page(entity_cls, params, lambda after, limit: _page_selection(selected, after, limit))
+
+def _list_page(entity_cls, params: ListParams, page) -> Response:
+    """Serialize one page from ``page(after, limit)``, which returns ``(entities, next_cursor)``."""
+    fields = _parse_fields(params.fields, entity_cls)
+    entities, next_cursor = page(params.cursor, params.limit)
+    headers = {"X-Next-Cursor": str(next_cursor)} if next_cursor is not None else None
+    return _json_response([entity.to_dict(params.depth, fields) for entity in entities], headers)
+
+def _counts_page(counts: Dict[str, int], next_cursor: Optional[int]) -> Response:
+    headers = {"X-Next-Cursor": str(next_cursor)} if next_cursor is not None else None
+    return _json_response(counts, headers)
+
+def _page_selection(entities: list, after: Optional[int], limit: Optional[int]):
+    """``Registry.page()`` over an id-ordered list of entities."""
+    start = 0 if after is None else bisect_right(entities, after, key=_entity_id)
+    if limit is None or start + limit >= len(entities):
+        return entities[start:], None
+    page = entities[start:start + limit]
+    return page, page[-1].id
+
+def _entity_id(entity) -> int:
+    return entity.id
+
+def _cached_collection_response(name: str, registry, request: Request) -> Response:
+    version = registry.version
+    cached = _collection_cache.get(name)
+    if cached is None or cached[0] != version:
+        body = _encode_json([entity.to_dict() for entity in registry])
+        cached = (version, f'"{name}-{_BOOT_ID}-{version}"', body)
+        _collection_cache[name] = cached
+    _, etag, body = cached
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
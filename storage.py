@@ -0,0 +1,207 @@
+import json
+import os
+
+from smarthome import ENTITY_TYPES, listeners, restore, walk
+
+
+class Storage:
+    """Base class for persistence backends.
+
+    A backend rebuilds the model in ``load()`` and is then attached to
+    ``smarthome.listeners`` so every create/update/delete reaches
+    ``record()``.  ``flush()`` makes everything recorded so far durable.
+    """
+
+    def open(self):
+        """Load the persisted state, then start recording changes."""
+        self.load()
+        listeners.append(self.record)
+
+    def close(self):
+        if self.record in listeners:
+            listeners.remove(self.record)
+        self.flush()
+
+    def load(self):
+        raise NotImplementedError
+
+    def record(self, op, entity, changes):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+def encode_changes(entity, changes):
+    """Make ``changes`` JSON-friendly by replacing the parent entity with its id."""
+    if entity._parent_link is None:
+        return changes
+    parent_attr = entity._parent_link[0]
+    if parent_attr not in changes:
+        return changes
+    encoded = dict(changes)
+    parent = encoded[parent_attr]
+    encoded[parent_attr] = parent.id if parent is not None else None
+    return encoded
+
+
+def decode_changes(entity, changes):
+    """Inverse of ``encode_changes()``: turn the parent id back into an entity."""
+    if entity._parent_link is None:
+        return changes
+    parent_attr = entity._parent_link[0]
+    if parent_attr not in changes:
+        return changes
+    decoded = dict(changes)
+    parent_id = decoded[parent_attr]
+    parent_registry = entity.parent_type()._registry
+    decoded[parent_attr] = parent_registry.get_by_id(parent_id) if parent_id is not None else None
+    return decoded
+
+
+def apply_change(op, entity_type, entity_id, payload):
+    """Replay one logged change against the in-memory model.
+
+    Replays are idempotent: creating an id that already exists, or updating
+    or deleting one that is gone, is skipped.
+    """
+    registry = ENTITY_TYPES[entity_type]._registry
+    entity = registry.get_by_id(entity_id)
+    if op == "create":
+        if entity is None:
+            restore(payload)
+    elif entity is None:
+        return
+    elif op == "update":
+        entity.assign(**decode_changes(entity, payload))
+    elif op == "patch":
+        entity.merge(**decode_changes(entity, payload))
+    elif op == "delete":
+        entity.delete()
+
+
+class FileStorage(Storage):
+    """Append-only write-ahead log plus periodic compacted snapshots.
+
+    Every change is appended to ``wal.ndjson`` as one JSON line carrying a
+    sequence number.  After ``snapshot_every`` records the whole model is
+    written to ``snapshot.ndjson`` (a header line with the sequence number
+    and id counters, then one ``to_record()`` per entity, parents first) and
+    the log is started afresh.  Recovery loads the snapshot and replays the
+    log entries with a higher sequence number, so a crash between writing
+    the snapshot and truncating the log is harmless.
+
+    ``record()`` only encodes the entry and keeps it in memory; ``flush()``
+    (which the API runs in a thread after every mutating request) writes
+    the entries to the log, and takes the snapshot once one is due, so no
+    file I/O happens while a change is being made.  Pass ``fsync=True`` to
+    also force the log to disk on every flush.
+    """
+
+    def __init__(self, directory, snapshot_every=1_000_000, fsync=False):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.snapshot_path = os.path.join(directory, "snapshot.ndjson")
+        self.wal_path = os.path.join(directory, "wal.ndjson")
+        self._seq = 0
+        self._since_snapshot = 0
+        self._pending = []  # encoded log lines not yet written
+        self._wal = None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        super().open()
+        self._wal = open(self.wal_path, "a", encoding="utf-8")
+
+    def close(self):
+        super().close()
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+    def load(self):
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as snapshot:
+                header = json.loads(snapshot.readline())
+                snapshot_seq = header["seq"]
+                for line in snapshot:
+                    restore(json.loads(line))
+            for entity_type, last_id in header["last_ids"].items():
+                cls = ENTITY_TYPES[entity_type]
+                cls._last_id = max(cls._last_id, last_id)
+        self._seq = snapshot_seq
+
+        if os.path.exists(self.wal_path):
+            valid_bytes = 0
+            with open(self.wal_path, "rb") as wal:
+                for line in wal:
+                    if not line.endswith(b"\n"):
+                        break  # torn final write from a crash
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    valid_bytes += len(line)
+                    if entry["seq"] <= snapshot_seq:
+                        continue
+                    payload = entry.get("record") if entry["op"] == "create" else entry.get("fields")
+                    apply_change(entry["op"], entry["type"], entry["id"], payload)
+                    self._seq = entry["seq"]
+                    self._since_snapshot += 1
+            # Drop the torn tail so new entries don't get glued onto it.
+            if valid_bytes < os.path.getsize(self.wal_path):
+                with open(self.wal_path, "r+b") as wal:
+                    wal.truncate(valid_bytes)
+
+    def record(self, op, entity, changes):
+        self._seq += 1
+        entry = {"seq": self._seq, "op": op, "type": type(entity).__name__.lower(), "id": entity.id}
+        if op == "create":
+            entry["record"] = entity.to_record()
+        elif op in ("update", "patch"):
+            entry["fields"] = encode_changes(entity, changes)
+        self._pending.append(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._since_snapshot += 1
+
+    def flush(self):
+        """Write the recorded entries to the log, then snapshot if one is due."""
+        if self._wal is None:
+            return
+        self._write_pending()
+        if self._since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def _write_pending(self):
+        pending, self._pending = self._pending, []
+        self._wal.write("".join(pending))
+        self._wal.flush()
+        if self.fsync:
+            os.fsync(self._wal.fileno())
+
+    def snapshot(self):
+        """Write a compacted snapshot of the whole model and reset the log.
+
+        Call it with the model lock held, as the API's flush does.
+        """
+        if self._wal is not None:
+            self._write_pending()
+        header = {
+            "seq": self._seq,
+            "last_ids": {name: cls._last_id for name, cls in ENTITY_TYPES.items()},
+        }
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as snapshot:
+            snapshot.write(json.dumps(header) + "\n")
+            for entity in walk():
+                snapshot.write(json.dumps(entity.to_record(), separators=(",", ":")) + "\n")
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        if self._wal is not None:
+            self._wal.close()
+        self._wal = open(self.wal_path, "w", encoding="utf-8")
+        self._since_snapshot = 0
+
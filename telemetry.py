@@ -0,0 +1,213 @@
+import math
+from array import array
+
+from smarthome import Device, listeners
+
+
+class Series:
+    """Ring buffer of ``(timestamp, value)`` samples for one device metric.
+
+    Timestamps and values live in two ``array('d')`` columns that grow until
+    ``capacity`` and then wrap, overwriting the oldest samples.  Samples must
+    arrive in timestamp order; an older sample than the newest one is
+    rejected, which keeps the buffer sorted so range queries can bisect.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array("d")
+        self.values = array("d")
+        self.head = 0  # physical index of the oldest sample once full
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp, value):
+        timestamps = self.timestamps
+        if timestamps and timestamp < self._timestamp_at(len(timestamps) - 1):
+            return False
+        if len(timestamps) < self.capacity:
+            timestamps.append(timestamp)
+            self.values.append(value)
+        else:
+            timestamps[self.head] = timestamp
+            self.values[self.head] = value
+            self.head = (self.head + 1) % self.capacity
+        return True
+
+    def latest(self):
+        if not self.timestamps:
+            return None
+        last = self._physical(len(self.timestamps) - 1)
+        return self.timestamps[last], self.values[last]
+
+    def range(self, start=None, end=None):
+        """Yield ``(timestamp, value)`` with ``start <= timestamp <= end``."""
+        first = 0 if start is None else self._bisect_left(start)
+        for i in range(first, len(self.timestamps)):
+            physical = self._physical(i)
+            timestamp = self.timestamps[physical]
+            if end is not None and timestamp > end:
+                return
+            yield timestamp, self.values[physical]
+
+    def _physical(self, logical):
+        if len(self.timestamps) < self.capacity:
+            return logical
+        return (self.head + logical) % self.capacity
+
+    def _timestamp_at(self, logical):
+        return self.timestamps[self._physical(logical)]
+
+    def _bisect_left(self, timestamp):
+        low, high = 0, len(self.timestamps)
+        while low < high:
+            mid = (low + high) // 2
+            if self._timestamp_at(mid) < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+
+def downsample(samples, bucket):
+    """Aggregate ``(timestamp, value)`` samples into ``bucket``-second buckets.
+
+    Buckets are aligned to multiples of ``bucket`` and reported with their
+    start time, sample count, min, max and mean.
+    """
+    buckets = []
+    current = None
+    for timestamp, value in samples:
+        start = timestamp - timestamp % bucket
+        if current is None or current["start"] != start:
+            current = {"start": start, "count": 0, "min": value, "max": value, "sum": 0.0}
+            buckets.append(current)
+        current["count"] += 1
+        current["sum"] += value
+        if value < current["min"]:
+            current["min"] = value
+        if value > current["max"]:
+            current["max"] = value
+    for aggregate in buckets:
+        aggregate["mean"] = aggregate.pop("sum") / aggregate["count"]
+    return buckets
+
+
+class TelemetryStore:
+    """Append-only time series for device readings, kept apart from ``Device.data``.
+
+    Series are keyed by ``(device id, metric)`` so renaming or moving a
+    device keeps its history; deleting the device drops it.  Call
+    ``attach()`` to start following device deletions.
+    """
+
+    def __init__(self, capacity=10_000):
+        self.capacity = capacity
+        self._series = {}  # (device id, metric) -> Series
+        self._metrics = {}  # device id -> {metric: None}
+
+    def attach(self):
+        listeners.append(self._on_change)
+
+    def detach(self):
+        if self._on_change in listeners:
+            listeners.remove(self._on_change)
+
+    def append(self, device, metric, timestamp, value):
+        """Store one reading; returns False if it was out of order or not a finite number."""
+        timestamp, value = float(timestamp), float(value)
+        if not (math.isfinite(timestamp) and math.isfinite(value)):
+            return False
+        key = (device.id, metric)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = Series(self.capacity)
+            self._metrics.setdefault(device.id, {})[metric] = None
+        return series.append(timestamp, value)
+
+    def metrics(self, device):
+        return list(self._metrics.get(device.id, ()))
+
+    def series(self, device, metric):
+        return self._series.get((device.id, metric))
+
+    def query(self, device, metric, start=None, end=None, bucket=None):
+        """Raw samples in ``[start, end]``, or per-bucket aggregates if ``bucket`` is set."""
+        series = self.series(device, metric)
+        if series is None:
+            return []
+        samples = series.range(start, end)
+        if bucket is not None:
+            return downsample(samples, bucket)
+        return [{"ts": timestamp, "value": value} for timestamp, value in samples]
+
+    def drop(self, device):
+        for metric in self._metrics.pop(device.id, ()):
+            del self._series[(device.id, metric)]
+
+    def clear(self):
+        self._series.clear()
+        self._metrics.clear()
+
+    def _on_change(self, op, entity, changes):
+        if op == "delete" and isinstance(entity, Device):
+            self.drop(entity)
+
+
+class Ingestor:
+    """Bulk path for sensor readings in columnar form.
+
+    ``submit()`` takes parallel ``device``/``metric``/``ts``/``value``
+    columns, resolves each distinct device name once, appends every reading
+    to the store and remembers only the newest value per device and metric.
+    Readings that are out of order or not finite numbers are rejected.
+    ``flush()`` then folds those into ``Device.data`` with one change per
+    device, however many readings arrived for it.
+    """
+
+    def __init__(self, store, find_device):
+        self.store = store
+        self.find_device = find_device
+        self._pending = {}  # device -> {metric: (timestamp, value)}
+
+    def submit(self, devices, metrics, timestamps, values):
+        """Returns ``(accepted, rejected, unknown device names)``."""
+        if not all(isinstance(column, (list, tuple)) for column in (devices, metrics, timestamps, values)):
+            raise ValueError("device, metric, ts and value must be lists.")
+        if not len(devices) == len(metrics) == len(timestamps) == len(values):
+            raise ValueError("device, metric, ts and value must have the same length.")
+        resolved = {}
+        unknown = set()
+        accepted = 0
+        append = self.store.append
+        pending = self._pending
+        for name, metric, timestamp, value in zip(devices, metrics, timestamps, values):
+            device = resolved.get(name)
+            if device is None:
+                if name in unknown:
+                    continue
+                device = self.find_device(name)
+                if device is None:
+                    unknown.add(name)
+                    continue
+                resolved[name] = device
+            timestamp = float(timestamp)
+            value = float(value)
+            if not append(device, metric, timestamp, value):
+                continue
+            accepted += 1
+            latest = pending.setdefault(device, {})
+            previous = latest.get(metric)
+            if previous is None or timestamp >= previous[0]:
+                latest[metric] = (timestamp, value)
+        return accepted, len(devices) - accepted, sorted(unknown, key=str)
+
+    def flush(self):
+        """Apply the newest pending reading of every metric to ``Device.data``."""
+        pending, self._pending = self._pending, {}
+        for device, latest in pending.items():
+            if device not in Device.devices:
+                continue
+            device.merge(data={metric: value for metric, (_, value) in latest.items()})
+        return len(pending)
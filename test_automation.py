@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+import pytest
+from smarthome import User, House, Room, Device
+from automation import RuleEngine, Scheduler
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    """Ensure each test starts with a fresh state"""
+    User.users.clear()
+    House.houses.clear()
+    Room.rooms.clear()
+    Device.devices.clear()
+
+
+@pytest.fixture
+def engine():
+    engine = RuleEngine()
+    engine.attach()
+    yield engine
+    engine.detach()
+
+
+def test_jobs_run_in_due_order_and_recurring_ones_come_back():
+    thermostat = Device(device_type="thermostat", name="Thermostat", settings={"mode": "heat", "setpoint": 20})
+    lamp = Device(device_type="light", name="Lamp", status="on")
+    scheduler = Scheduler(clock=lambda: 0)
+    scheduler.schedule(thermostat, 100, settings={"setpoint": 17})
+    nightly = scheduler.schedule(lamp, 50, status="off", every=86_400)
+    cancelled = scheduler.schedule(lamp, 10, status="dimmed")
+    assert scheduler.cancel(cancelled.id)
+    assert not scheduler.cancel(cancelled.id)
+    assert [job.due for job in scheduler.jobs()] == [50, 100]
+
+    assert scheduler.run_due(now=40) == 0
+    assert lamp.status == "on"
+    assert scheduler.run_due(now=100) == 2
+    assert thermostat.settings == {"mode": "heat", "setpoint": 17}
+    assert lamp.status == "off"
+    assert scheduler.jobs() == [nightly]
+    assert nightly.due == 50 + 86_400
+
+    # Missed runs are not replayed one by one.
+    lamp.status = "on"
+    assert scheduler.run_due(now=50 + 3 * 86_400 + 5) == 1
+    assert nightly.due == 50 + 4 * 86_400
+
+    lamp.delete()
+    assert scheduler.run_due(now=nightly.due) == 0
+    assert len(scheduler) == 0
+    with pytest.raises(ValueError):
+        scheduler.schedule(thermostat, 0)
+
+
+def test_run_wakes_up_for_earlier_jobs():
+    lamp = Device(device_type="light", name="Lamp", status="on")
+
+    async def scenario():
+        scheduler = Scheduler()
+        scheduler.schedule(lamp, time.time() + 3600, status="later")
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0.01)
+        scheduler.schedule(lamp, time.time() + 0.02, status="off")
+        for _ in range(100):
+            if lamp.status == "off":
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+        assert lamp.status == "off"
+        assert len(scheduler) == 1
+
+    asyncio.run(scenario())
+
+
+def test_rules_fire_when_their_condition_becomes_true(engine):
+    user = User(name="Alice", username="alice")
+    house = House(name="Home", owner=user)
+    room = Room(name="Hall", house=house)
+    sensor = Device(device_type="sensor", name="Sensor", room=room)
+    heater = Device(device_type="heater", name="Heater", room=room, status="off")
+    other = Device(device_type="sensor", name="Other", room=room)
+    engine.add(sensor, "temperature", "<", 18, target=heater, status="on")
+    engine.add(sensor, "temperature", ">=", 22, target=heater, status="off")
+    engine.add(other, "humidity", ">", 70, settings={"alert": True})
+    with pytest.raises(ValueError):
+        engine.add(other, "humidity", ">", float("nan"), settings={"alert": True})
+
+    sensor.data = {"temperature": 17.5}
+    assert heater.status == "on"
+    heater.status = "manual"
+    sensor.data = {"temperature": 17.0}  # still cold: no second firing
+    assert heater.status == "manual"
+    sensor.data = {"temperature": 23}
+    assert heater.status == "off"
+    sensor.data = {"temperature": "n/a"}
+    assert heater.status == "off"
+    sensor.data = {"temperature": 10}
+    assert heater.status == "on"
+    assert other.settings == {}
+
+    sensor.delete()
+    assert [rule.watched for rule in engine.rules()] == [other]
+
+
+def test_data_patches_only_evaluate_rules_on_the_changed_fields(engine, monkeypatch):
+    from automation import Rule
+
+    sensor = Device(device_type="sensor", name="Sensor")
+    engine.add(sensor, "temperature", ">", 25, status="hot")
+    engine.add(sensor, "humidity", ">", 70, status="damp")
+    evaluated = []
+    matches = Rule.matches
+    monkeypatch.setattr(Rule, "matches", lambda rule, data: evaluated.append(rule.field) or matches(rule, data))
+
+    sensor.merge(data={"humidity": 80})
+    assert evaluated == ["humidity"] and sensor.status == "damp"
+    evaluated.clear()
+    sensor.merge(data={"pressure": 1013})
+    assert evaluated == []
+    sensor.data = {"temperature": 30}  # replaced outright: every rule is checked
+    assert sorted(evaluated) == ["humidity", "temperature"] and sensor.status == "hot"
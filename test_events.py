@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from smarthome import User, House, Room, Device
+from events import EventBus, scope_of
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    """Ensure each test starts with a fresh state"""
+    User.users.clear()
+    House.houses.clear()
+    Room.rooms.clear()
+    Device.devices.clear()
+
+
+@pytest.fixture
+def bus():
+    bus = EventBus(queue_size=3)
+    bus.attach()
+    yield bus
+    bus.detach()
+
+
+def test_scope_lists_every_ancestor():
+    user = User(name="Alice", username="alice")
+    house = House(name="Home", owner=user)
+    room = Room(name="Kitchen", house=house)
+    device = Device(name="Lamp", room=room)
+    assert scope_of(device) == {"device": device.id, "room": room.id, "house": house.id, "user": user.id}
+
+
+def test_subscribers_only_see_their_scope(bus):
+    async def scenario():
+        user = User(name="Alice", username="alice")
+        house = House(name="Home", owner=user)
+        kitchen = Room(name="Kitchen", house=house)
+        hall = Room(name="Hall", house=house)
+        lamp = Device(name="Lamp", room=kitchen)
+        fan = Device(name="Fan", room=hall)
+        everything = bus.subscribe()
+        kitchen_only = bus.subscribe(room=kitchen.id)
+        lamp.status = "on"
+        fan.status = "on"
+        lamp.delete()
+        first = await everything.get()
+        assert (first["op"], first["type"], first["changes"]) == ("update", "Device", {"status": "on"})
+        assert [(await kitchen_only.get())["op"] for _ in range(2)] == ["update", "delete"]
+        versions = [first["version"]] + [(await everything.get())["version"] for _ in range(2)]
+        assert versions == sorted(versions)
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_drops_oldest_and_reports_overflow(bus):
+    async def scenario():
+        device = Device(name="Lamp")
+        subscription = bus.subscribe()
+        for i in range(5):
+            device.status = str(i)
+        assert await subscription.get() == {"op": "overflow", "dropped": 2, "version": bus.version}
+        assert [(await subscription.get())["changes"]["status"] for _ in range(3)] == ["2", "3", "4"]
+        subscription.close()
+        device.status = "off"
+        assert not subscription._queue
+
+    asyncio.run(scenario())
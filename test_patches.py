@@ -0,0 +1,71 @@
+import pytest
+from patches import InvalidPatchError, PatchConflictError, json_patch, merge_diff, merge_patch
+
+
+def test_merge_patch_reports_only_what_took_effect():
+    target = {"mode": "heat", "schedule": {"day": 21, "night": 17}, "eco": False}
+    result, effective = merge_patch(target, {
+        "mode": "heat",
+        "schedule": {"night": 16, "away": None},
+        "eco": None,
+        "fan": {"speed": 2},
+        "missing": None,
+    })
+    assert result == {"mode": "heat", "schedule": {"day": 21, "night": 16}, "fan": {"speed": 2}}
+    assert effective == {"schedule": {"night": 16}, "eco": None, "fan": {"speed": 2}}
+    # The target is left alone and unchanged members are shared.
+    assert target["schedule"] == {"day": 21, "night": 17} and "eco" in target
+    assert merge_patch(result, {"mode": "heat", "schedule": {"day": 21}}) == (result, {})
+    # A non-object member replaces whatever was there.
+    assert merge_patch({"a": {"b": 1}}, {"a": [1, 2]}) == ({"a": [1, 2]}, {"a": [1, 2]})
+
+
+def test_merge_diff_round_trips_through_merge_patch():
+    old = {"a": 1, "b": {"c": 2, "d": 3}, "e": [1]}
+    new = {"a": 1, "b": {"c": 4}, "f": "x"}
+    diff = merge_diff(old, new)
+    assert diff == {"b": {"c": 4, "d": None}, "e": None, "f": "x"}
+    assert merge_patch(old, diff)[0] == new
+    assert merge_diff(old, dict(old, g=None)) is None
+
+
+def test_json_patch_operations():
+    document = {"settings": {"mode": "heat", "zones": ["hall"]}, "status": "on"}
+    patched = json_patch(document, [
+        {"op": "test", "path": "/status", "value": "on"},
+        {"op": "replace", "path": "/settings/mode", "value": "cool"},
+        {"op": "add", "path": "/settings/zones/-", "value": "attic"},
+        {"op": "add", "path": "/settings/zones/0", "value": "cellar"},
+        {"op": "copy", "from": "/status", "path": "/settings/was"},
+        {"op": "move", "from": "/settings/was", "path": "/settings/a~1b"},
+        {"op": "remove", "path": "/status"},
+    ])
+    assert patched == {"settings": {"mode": "cool", "zones": ["cellar", "hall", "attic"], "a/b": "on"}}
+    assert document == {"settings": {"mode": "heat", "zones": ["hall"]}, "status": "on"}
+
+    for operations in (
+        [{"op": "test", "path": "/status", "value": "off"}],
+        [{"op": "remove", "path": "/nope"}],
+        [{"op": "add", "path": "/settings/zones/5", "value": 1}],
+        [{"op": "add", "path": "/settings/zones/x", "value": 1}],
+    ):
+        with pytest.raises(PatchConflictError):
+            json_patch(document, operations)
+
+    for operations in (
+        [{"op": "move", "from": "/settings", "path": "/settings/inner"}],
+        [{"op": "replace", "path": "/status"}],
+        [{"op": "frobnicate", "path": "/status"}],
+        [{"op": "copy", "path": "/status"}],
+        [{"path": "/status"}],
+        [{"op": "remove", "path": "status"}],
+        [{"op": "remove", "path": "/settings/x~"}],
+        [{"op": "remove", "path": "/settings/~2x"}],
+        [{"op": "remove", "path": ""}],
+        # Malformed is reported even after an operation that wouldn't apply.
+        [{"op": "remove", "path": "/nope"}, {"op": "frobnicate", "path": "/status"}],
+        {"op": "remove", "path": "/status"},
+    ):
+        with pytest.raises(InvalidPatchError):
+            json_patch(document, operations)
+    assert json_patch({"a~b": 1}, [{"op": "remove", "path": "/a~0b"}]) == {}
@@ -0,0 +1,95 @@
+import itertools
+
+import pytest
+from registry import Registry
+
+_ids = itertools.count(1)
+
+
+class Item:
+    def __init__(self, name):
+        self.id = next(_ids)
+        self.name = name
+
+    def __repr__(self):
+        return f"Item({self.name!r})"
+
+
+def test_behaves_like_a_list():
+    registry = Registry("name")
+    a, b = Item("a"), Item("b")
+    registry.append(a)
+    registry.append(b)
+    assert len(registry) == 2
+    assert list(registry) == [a, b]
+    assert registry[0] is a
+    assert registry[:] == [a, b]
+    assert a in registry
+    registry.remove(a)
+    assert list(registry) == [b]
+    with pytest.raises(ValueError):
+        registry.remove(a)
+
+
+def test_duplicate_keys_return_oldest():
+    registry = Registry("name")
+    first, second = Item("dup"), Item("dup")
+    registry.append(first)
+    registry.append(second)
+    assert registry.get("dup") is first
+    registry.remove(first)
+    assert registry.get("dup") is second
+    third = Item("dup")
+    registry.append(third)
+    registry.remove(second)
+    assert registry.get("dup") is third
+    registry.remove(third)
+    assert registry.get("dup") is None
+
+
+def test_reindex_and_clear():
+    registry = Registry("name")
+    item = Item("old")
+    registry.append(item)
+    registry.reindex(item, "old", "new")
+    item.name = "new"
+    assert registry.get("old") is None
+    assert registry.get("new") is item
+    registry.clear()
+    assert len(registry) == 0
+    assert registry.get("new") is None
+
+
+def test_page_by_id_skips_removed_entries():
+    registry = Registry("name")
+    items = [Item(f"item-{i}") for i in range(10)]
+    for item in items:
+        registry.append(item)
+    registry.remove(items[2])
+    registry.remove(items[3])
+
+    first, cursor = registry.page(limit=3)
+    assert first == [items[0], items[1], items[4]]
+    second, cursor = registry.page(after=cursor, limit=3)
+    assert second == [items[5], items[6], items[7]]
+    last, cursor = registry.page(after=cursor, limit=3)
+    assert last == [items[8], items[9]]
+    assert cursor is None
+
+    registry.append(items[2])
+    assert registry.page(limit=3)[0] == [items[0], items[1], items[2]]
+
+
+def test_index_on_a_derived_key():
+    registry = Registry("id", indexes=(("name", len),))
+    short, other, longer = Item("ab"), Item("cd"), Item("abcd")
+    for item in (short, other, longer):
+        registry.append(item)
+    assert set(registry.having("name", "xy")) == {short, other}
+    assert registry.counts("name") == {2: 2, 4: 1}
+
+    other.name = "cdef"
+    registry.reindex(other, "cd", "cdef", "name")
+    assert set(registry.having("name", "wxyz")) == {other, longer}
+    registry.remove(longer)
+    assert registry.counts("name") == {2: 1, 4: 1}
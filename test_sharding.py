@@ -0,0 +1,215 @@
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.testclient import TestClient
+
+from smarthome import User, House, Room, Device
+from sharding import ShardRouter, shard_for
+import smarthome_api
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    """Ensure each test starts with a fresh state"""
+    User.users.clear()
+    House.houses.clear()
+    Room.rooms.clear()
+    Device.devices.clear()
+
+
+def fake_shard():
+    """A stand-in worker that stores entities as plain dicts, one per name."""
+    app = FastAPI()
+    keys = {"users": "username", "houses": "name", "rooms": "name", "devices": "name"}
+    store = {collection: {} for collection in keys}
+    app.state.store = store
+
+    @app.get("/export")
+    def export():
+        records = (
+            dict(entity, type=collection[:-1]) for collection, entities in store.items() for entity in entities.values()
+        )
+        return Response("".join(json.dumps(record) + "\n" for record in records), media_type="application/x-ndjson")
+
+    @app.post("/telemetry")
+    async def telemetry(request: Request):
+        columns = await request.json()
+        names = columns["device"]
+        unknown = sorted({name for name in names if _fake_lookup(store["devices"], name) is None})
+        accepted = sum(name not in unknown for name in names)
+        return {"accepted": accepted, "rejected": len(names) - accepted, "unknown_devices": unknown}
+
+    @app.get("/{collection}")
+    def listing(collection: str):
+        return list(store[collection].values())
+
+    @app.post("/{collection}")
+    async def create(collection: str, request: Request):
+        entity = await request.json()
+        store[collection][entity[keys[collection]]] = entity
+        return entity
+
+    @app.get("/{collection}/{name}")
+    def read(collection: str, name: str):
+        entity = _fake_lookup(store[collection], name)
+        if entity is None:
+            raise HTTPException(status_code=404, detail="Not found.")
+        return entity
+
+    @app.put("/{collection}/{name}")
+    async def update(collection: str, name: str, request: Request):
+        entity = store[collection].pop(name)
+        entity.update(await request.json())
+        store[collection][entity[keys[collection]]] = entity
+        return entity
+
+    return app
+
+
+def _fake_lookup(entities, ref):
+    if ref.startswith("id:"):
+        return next((entity for entity in entities.values() if f"id:{entity.get('id')}" == ref), None)
+    return entities.get(ref)
+
+
+def router_over(*apps):
+    return ShardRouter([
+        httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://shard") for app in apps
+    ])
+
+
+def usernames_for_each_shard(shards):
+    """One username that hashes to each shard, in shard order."""
+    found = {}
+    i = 0
+    while len(found) < shards:
+        found.setdefault(shard_for(f"user-{i}", shards), f"user-{i}")
+        i += 1
+    return [found[shard] for shard in range(shards)]
+
+
+def test_shard_for_is_stable_and_spreads_keys():
+    assert shard_for("alice123", 4) == shard_for("alice123", 4)
+    counts = [0] * 4
+    for i in range(4000):
+        counts[shard_for(f"user-{i}", 4)] += 1
+    assert min(counts) > 800
+
+
+def test_children_follow_their_owner_and_names_stay_unique():
+    shards = [fake_shard(), fake_shard()]
+    first, second = usernames_for_each_shard(2)
+    with TestClient(router_over(*shards).app) as client:
+        for username in (first, second):
+            assert client.post("/users", json={"username": username, "name": username}).status_code == 200
+        client.post("/houses", json={"name": "Cabin", "owner_username": second})
+        client.post("/rooms", json={"name": "Loft", "house_name": "Cabin"})
+        assert set(shards[1].state.store["rooms"]) == {"Loft"}
+        assert not shards[0].state.store["houses"]
+
+        client.post("/houses", json={"name": "Flat", "owner_username": first})
+        assert client.post("/houses", json={"name": "Cabin", "owner_username": first}).status_code == 400
+        assert client.put("/houses/Flat", json={"name": "Cabin"}).status_code == 400
+        assert client.put("/rooms/Loft", json={"house_name": "Flat"}).status_code == 409
+        assert client.put("/rooms/Loft", json={"name": "Attic"}).status_code == 200
+        assert client.get("/rooms/Attic").json()["name"] == "Attic"
+        assert client.get("/rooms/Loft").status_code == 404
+
+        assert sorted(user["username"] for user in client.get("/users").json()) == sorted([first, second])
+        page = client.get("/users", params={"limit": 10})
+        assert page.headers["X-Next-Cursor"] == "1."
+
+    # A new router finds everything again from the shards' exports.
+    with TestClient(router_over(*shards).app) as client:
+        assert client.get("/rooms/Attic").status_code == 200
+        assert client.get("/houses/Cabin").status_code == 200
+
+
+def test_router_passes_the_real_api_through():
+    with TestClient(router_over(smarthome_api.app).app) as client:
+        client.post("/users", json={
+            "name": "Alice", "username": "alice123", "phone": "", "privileges": "user", "email": ""
+        })
+        client.post("/houses", json={
+            "name": "Beach House", "address": "", "gps": "", "owner_username": "alice123"
+        })
+        client.post("/rooms", json={
+            "name": "Living Room", "floor": 1, "size": 300, "house_name": "Beach House", "room_type": "Common"
+        })
+        batch = client.post("/devices:batch", json={"items": [
+            {"device_type": "sensor", "name": f"Sensor {i}", "status": "on", "room_name": "Living Room"}
+            for i in range(3)
+        ]})
+        assert batch.json()["applied"]
+        assert client.get("/devices/Sensor 2").json()["status"] == "on"
+        ingest = client.post("/telemetry", json={
+            "device": ["Sensor 0", "Ghost"], "metric": ["t", "t"], "ts": [1, 1], "value": [1.0, 2.0]
+        })
+        assert ingest.json() == {"accepted": 1, "rejected": 1, "unknown_devices": ["Ghost"]}
+        for bad in ({"device": [["Sensor 0"]], "metric": ["t"], "ts": [1], "value": [1.0]},
+                    {"device": "Sensor 0", "metric": "tttttttt", "ts": [1] * 8, "value": [1.0] * 8}):
+            assert client.post("/telemetry", json=bad).status_code == 400
+        assert client.get("/schedules").status_code == 501
+        assert client.post("/rules", json={}).status_code == 501
+        assert client.get("/devices/Sensor 0/telemetry", params={"metric": "t"}).json()["samples"] == [
+            {"ts": 1.0, "value": 1.0}
+        ]
+        assert client.request("DELETE", "/devices:batch", json={"names": ["Sensor 1"]}).json()["applied"]
+        assert client.get("/devices/Sensor 1").status_code == 404
+        rename = [{"op": "replace", "path": "/name", "value": "Sensor 9"}]
+        patched = client.patch(
+            "/devices/Sensor 2", content=json.dumps(rename), headers={"Content-Type": "application/json-patch+json"}
+        )
+        assert patched.json()["name"] == "Sensor 9"
+        assert client.get("/devices/Sensor 9").status_code == 200
+        types = [json.loads(line)["type"] for line in client.get("/export").text.splitlines()]
+        assert types.count("device") == 2
+        stats = client.get("/stats").json()
+        assert stats["devices_by_status"] == {"on": 2}
+        assert stats["room_size_by_floor"] == {"1": 300}
+        assert client.get("/stats/houses").json() == {"Beach House": 1}
+        assert client.get("/stats/users", params={"limit": 1}).json() == {"alice123": 1}
+
+
+def test_repeated_room_names_route_by_house():
+    shards = [fake_shard(), fake_shard()]
+    first, second = usernames_for_each_shard(2)
+    with TestClient(router_over(*shards).app) as client:
+        for username, house in ((first, "Flat"), (second, "Cabin")):
+            client.post("/users", json={"username": username, "name": username})
+            client.post("/houses", json={"name": house, "owner_username": username})
+            assert client.post("/rooms", json={"name": "Kitchen", "house_name": house}).status_code == 200
+        assert "Kitchen" in shards[0].state.store["rooms"] and "Kitchen" in shards[1].state.store["rooms"]
+
+        assert client.get("/rooms/Kitchen").status_code == 409
+        assert client.get("/rooms/Kitchen", params={"house": "Cabin"}).json()["house_name"] == "Cabin"
+        assert client.get("/rooms/id:1").status_code == 400
+
+        # Once one of them is gone behind the router's back, the name routes again.
+        del shards[0].state.store["rooms"]["Kitchen"]
+        assert client.get("/rooms/Kitchen").json()["house_name"] == "Cabin"
+
+
+def test_telemetry_resolves_names_held_by_several_shards():
+    shards = [fake_shard(), fake_shard()]
+    first, second = usernames_for_each_shard(2)
+    with TestClient(router_over(*shards).app) as client:
+        for number, (username, house) in enumerate(((first, "Flat"), (second, "Cabin"))):
+            client.post("/users", json={"username": username, "name": username})
+            client.post("/houses", json={"name": house, "owner_username": username})
+            client.post("/rooms", json={"name": "Kitchen", "house_name": house})
+            client.post("/devices", json={"name": "Lamp", "room_name": "Kitchen", "house_name": house, "id": number})
+        readings = {"device": ["Lamp", "id:1"], "metric": ["t", "t"], "ts": [1, 1], "value": [1.0, 2.0]}
+
+        # Two shards hold a Lamp (and a device with id 1 lives on shard 1 only).
+        assert client.post("/telemetry", json=readings).json() == {
+            "accepted": 1, "rejected": 1, "unknown_devices": ["Lamp"]
+        }
+
+        # Once one of them is gone behind the router's back, the name routes again.
+        del shards[0].state.store["devices"]["Lamp"]
+        assert client.post("/telemetry", json=readings).json() == {
+            "accepted": 2, "rejected": 0, "unknown_devices": []
+        }
@@ -1,5 +1,5 @@
 import pytest
-from smarthome import User, House, Room, Device  # Adjust this import as necessary
+from smarthome import User, House, Room, Device, listeners, houses_per_user, rooms_per_house, summary, walk  # Adjust this import as necessary
 
 @pytest.fixture(autouse=True)
 def cleanup():
@@ -147,16 +147,19 @@ def test_create_blank_user():
     print("After Creating Blank User:", len(User.users))
     assert len(User.users) == 1  # Should be 1 now
 
-def test_delete_user(setup_data):
+def test_delete_user(setup_data, caplog):
     user, _, _, _ = setup_data
 
     print("\nBefore Delete:", len(User.users), User.users)
 
-    user.delete()
+    with caplog.at_level("INFO", logger="smarthome"):
+        user.delete()
 
     print("After Delete:", len(User.users), User.users)  # Should be 0 now
 
     assert len(User.users) == 0
+    [record] = caplog.records
+    assert record.fields == {"user_id": user.id, "username": "alice123", "houses": 1}
 
 def test_update_house_2(setup_data):
     _, house, _, _ = setup_data
@@ -209,6 +212,7 @@ def test_user_to_dict():
     )
     
     expected_dict = {
+        "id": user.id,
         "name": "John Doe",
         "username": "jdoe",
         "phone": "123-456-7890",
@@ -216,12 +220,14 @@ def test_user_to_dict():
         "email": "jdoe@example.com",
         "houses": [
             {
+                "id": house.id,
                 "name": "Doe's House",
                 "address": "123 Main St",
                 "gps": "40.7128,-74.0060",
                 "owner": "jdoe",
                 "rooms": [
                     {
+                        "id": room.id,
                         "name": "Living Room",
                         "floor": 1,
                         "size": 200,
@@ -229,6 +235,7 @@ def test_user_to_dict():
                         "room_type": "Common Area",
                         "devices": [
                             {
+                                "id": device.id,
                                 "device_type": "Light",
                                 "name": "Smart Bulb",
                                 "settings": {"brightness": 80},
@@ -243,3 +250,250 @@ def test_user_to_dict():
     }
     
     assert user.to_dict() == expected_dict
+
+
+def test_registry_lookup_by_key():
+    user = User(name="Alice", username="alice123")
+    house = House(name="Alice's House", owner=user)
+    room = Room(name="Living Room", house=house)
+    device = Device(device_type="thermostat", name="Nest Thermostat", room=room)
+    assert User.users.get("alice123") is user
+    assert House.houses.get("Alice's House") is house
+    assert Room.rooms.get("Living Room") is room
+    assert Device.devices.get("Nest Thermostat") is device
+    assert Device.devices.get("Missing") is None
+
+
+def test_registry_follows_renames(setup_data):
+    user, house, room, device = setup_data
+    user.update("Alice", "alice456", "555-1234", "admin", "alice@mail.com")
+    device.name = "Hallway Thermostat"
+    assert User.users.get("alice123") is None
+    assert User.users.get("alice456") is user
+    assert Device.devices.get("Nest Thermostat") is None
+    assert Device.devices.get("Hallway Thermostat") is device
+
+
+def test_registry_forgets_deleted_entities(setup_data):
+    user, house, room, device = setup_data
+    user.delete()
+    assert User.users.get("alice123") is None
+    assert House.houses.get("Alice's House") is None
+    assert Room.rooms.get("Living Room") is None
+    assert Device.devices.get("Nest Thermostat") is None
+
+
+def test_reassigning_parent_moves_child(setup_data):
+    user, house, room, device = setup_data
+    other_room = Room(name="Kitchen", house=house)
+    device.update("thermostat", "Nest Thermostat", other_room, {}, {}, "active")
+    assert device not in room.devices
+    assert other_room.devices.get("Nest Thermostat") is device
+
+
+def test_cascading_delete_removes_subtree():
+    user = User(username="landlord")
+    for h in range(3):
+        house = House(name=f"house-{h}", owner=user)
+        for r in range(4):
+            room = Room(name=f"room-{h}-{r}", house=house)
+            for d in range(5):
+                Device(name=f"device-{h}-{r}-{d}", room=room)
+    assert len(Device.devices) == 60
+    user.delete()
+    assert len(User.users) == 0
+    assert len(House.houses) == 0
+    assert len(Room.rooms) == 0
+    assert len(Device.devices) == 0
+
+
+def test_to_dict_is_cached_until_something_changes():
+    user = User(username="alice123")
+    house = House(name="Alice's House", owner=user)
+    room = Room(name="Living Room", house=house)
+    other_room = Room(name="Kitchen", house=house)
+    device = Device(name="Nest Thermostat", room=room, status="on")
+    first = user.to_dict()
+    assert user.to_dict() is first
+
+    kitchen = other_room.to_dict()
+    device.update("thermostat", "Nest Thermostat", room, {}, {}, "off")
+    second = user.to_dict()
+    assert second is not first
+    assert second["houses"][0]["rooms"][0]["devices"][0]["status"] == "off"
+    # The untouched sibling subtree is reused as-is.
+    assert other_room.to_dict() is kitchen
+
+
+def test_to_dict_sees_direct_assignments_and_parent_renames(setup_data):
+    user, house, room, device = setup_data
+    user.to_dict()
+    house.address = "456 Elm St"
+    assert user.to_dict()["houses"][0]["address"] == "456 Elm St"
+    user.username = "alice456"
+    assert house.to_dict()["owner"] == "alice456"
+    device.settings["temperature"] = 68
+    device.touch()
+    assert room.to_dict()["devices"][0]["settings"] == {"temperature": 68}
+
+
+def test_walk_yields_parents_first_then_orphans(setup_data):
+    user, house, room, device = setup_data
+    stray_room = Room(name="Shed")
+    stray_device = Device(name="Stray Plug", room=stray_room)
+    order = list(walk(batch_size=1))
+    assert order.index(user) < order.index(house) < order.index(room) < order.index(device)
+    assert order.index(stray_room) < order.index(stray_device)
+    assert len(order) == len(set(order))
+    assert set(order) == set(User.users) | set(House.houses) | set(Room.rooms) | set(Device.devices)
+
+
+def test_walk_survives_moves_and_refuses_newer_parents():
+    first = User(name="Alice", username="alice")
+    second = User(name="Bob", username="bob")
+    house = House(name="Bob's House", owner=second)
+    room = Room(name="Kitchen", house=house)
+
+    entities = walk(batch_size=1)
+    assert next(entities) is first
+    house.owner = first  # to a user the walk has already passed
+    House(name="Late House", owner=first)
+    assert list(entities) == [second, house, room]
+
+    entities = walk(batch_size=1)
+    assert next(entities) is first
+    house.owner = User(name="Carol", username="carol")
+    with pytest.raises(RuntimeError):
+        list(entities)
+
+
+def test_version_counts_changes_to_own_fields(setup_data):
+    user, house, room, device = setup_data
+    assert Device(name="Fresh", room=room).version == 1
+    version = device.version
+    room_version = room.version
+    revisions = (room.revision, house.revision, user.revision)
+    device.update("thermostat", "Nest Thermostat", room, {}, {}, "off")
+    assert device.version == version + 1
+    device.status = "off"  # unchanged value
+    assert device.version == version + 1
+    device.touch("settings")
+    assert device.version == version + 2
+    assert room.version == room_version  # children don't count
+    # ... but they do change the revision of everything that embeds them.
+    assert all(after > before for after, before in zip((room.revision, house.revision, user.revision), revisions))
+
+
+def test_merge_patches_settings_and_reports_only_the_changes(setup_data):
+    user, house, room, device = setup_data
+    device.settings = {"temperature": 72, "schedule": {"day": 21, "night": 17}}
+    cached = room.to_dict()
+    old_settings = device.settings
+    version = device.version
+    seen = []
+    listeners.append(lambda op, entity, changes: seen.append((op, entity, changes)))
+    try:
+        device.merge(settings={"schedule": {"night": 16}, "temperature": None}, status="on")
+        device.merge(settings={"schedule": {"night": 16}})  # already so: no change at all
+    finally:
+        listeners.pop()
+    assert seen == [("patch", device, {"settings": {"schedule": {"night": 16}, "temperature": None}, "status": "on"})]
+    assert device.settings == {"schedule": {"day": 21, "night": 16}}
+    assert device.version == version + 1
+    # Copy-on-write: earlier readers keep what they were given.
+    assert old_settings == {"temperature": 72, "schedule": {"day": 21, "night": 17}}
+    assert cached["devices"][0]["settings"] == old_settings
+    assert room.to_dict()["devices"][0]["settings"] == device.settings
+
+
+def test_compact_representation(setup_data):
+    user, house, room, device = setup_data
+    assert not hasattr(device, "__dict__")
+    with pytest.raises(AttributeError):
+        device.nickname = "lamp"
+    other = Device(device_type="".join(["ther", "mostat"]), name="Other", room=room, status="".join(["o", "n"]))
+    assert other.device_type is device.device_type
+    assert other._settings is None and other.to_dict()["settings"] == {}
+    other.settings["mode"] = "eco"  # empty dicts are created on first use
+    other.touch("settings")
+    assert other.to_dict()["settings"] == {"mode": "eco"}
+
+
+def test_select_uses_indexes_and_follows_updates(setup_data):
+    user, house, room, device = setup_data
+    garage = Room(name="Garage", house=house, room_type="utility", floor=0)
+    plug = Device(device_type="plug", name="Plug", room=garage, status="offline")
+    lamp = Device(device_type="light", name="Lamp", room=garage, status="offline")
+    assert Device.select(status="offline") == [plug, lamp]
+    assert Device.select(status="offline", device_type="plug", house=house) == [plug]
+    assert Device.select(owner=user) == [device, plug, lamp]
+    assert Room.select(floor=0, owner=user) == [garage]
+
+    plug.update("plug", "Plug", room, {}, {}, "on")
+    assert Device.select(status="offline") == [lamp]
+    assert Device.select(room=garage) == [lamp]
+    lamp.delete()
+    assert Device.select(status="offline") == []
+    assert Device.devices.having("status", "offline") == set()
+    assert Device.select(house=None) == []
+
+
+def test_summary_counters_follow_changes():
+    user = User(name="Alice", username="alice123")
+    house = House(name="Alice's House", owner=user)
+    room = Room(name="Living Room", floor=1, size=200, house=house, room_type="Common Area")
+    device = Device(device_type="thermostat", name="Nest Thermostat", room=room, status="active")
+    garage = Room(name="Garage", floor=0, size=40, house=house, room_type="utility")
+    Device(device_type="plug", name="Plug", room=garage, status="offline")
+    stats = summary()
+    assert stats["devices"] == 2
+    assert stats["devices_by_status"] == {"active": 1, "offline": 1}
+    assert stats["devices_by_type"] == {"thermostat": 1, "plug": 1}
+    assert stats["room_size_by_floor"] == {1: 200, 0: 40}
+    assert "rooms_by_house" not in stats
+    assert rooms_per_house() == ({"Alice's House": 2}, None)
+    assert houses_per_user() == ({"alice123": 1}, None)
+
+    garage.update("Garage", 1, 60, house, "utility")
+    room.size = 150
+    device.status = "offline"
+    stats = summary()
+    assert stats["room_size_by_floor"] == {1: 210}
+    assert stats["devices_by_status"] == {"offline": 2}
+
+    garage.delete()
+    stats = summary()
+    assert stats["room_size_by_floor"] == {1: 150}
+    assert stats["devices_by_type"] == {"thermostat": 1}
+    assert rooms_per_house() == ({"Alice's House": 1}, None)
+    other = House(name="Holiday Home", owner=user)
+    assert rooms_per_house(limit=1) == ({"Alice's House": 1}, house.id)
+    assert rooms_per_house(after=house.id, limit=1) == ({"Holiday Home": 0}, None)
+    assert houses_per_user() == ({"alice123": 2}, None)
+    other.delete()
+
+
+def test_houses_near_a_point_and_inside_a_box():
+    user = User(name="Alice", username="alice123")
+    manhattan = House(name="Manhattan", gps="40.7128° N, 74.0060° W", owner=user)
+    brooklyn = House(name="Brooklyn", gps="40.6782, -73.9442", owner=user)
+    london = House(name="London", gps="51.5074° N, 0.1278° W", owner=user)
+    House(name="Cabin", gps="somewhere in the woods", owner=user)
+    assert manhattan.coordinates == (40.7128, -74.006)
+    assert london.coordinates == (51.5074, -0.1278)
+
+    assert House.near(40.7, -74.0, 10) == [manhattan, brooklyn]
+    assert House.near(40.7, -74.0, 2) == [manhattan]
+    assert House.within(50, -1, 52, 1) == [london]
+    assert House.within(-90, 170, 90, -170) == []
+    # The whole world, however its edges are written.
+    everywhere = [manhattan, brooklyn, london]
+    assert House.within(-90, -180, 90, 180) == everywhere
+    assert House.within(-90, -179.9, 90, 180) == everywhere
+    assert House.within(-90, 10, 90, 9.99) == everywhere
+
+    london.gps = "40.70, -74.01"
+    assert House.near(40.7, -74.0, 2) == [manhattan, london]
+    assert House.within(50, -1, 52, 1) == []
+    manhattan.delete()
+    assert House.near(40.7, -74.0, 10) == [brooklyn, london]
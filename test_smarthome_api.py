@@ -1,3 +1,4 @@
+import json
 import pytest
 from fastapi.testclient import TestClient
 from smarthome_api import app
@@ -239,3 +240,928 @@ def test_delete_user():
     # Confirm user is gone
     get_response = client.get("/users/alice123")
     assert get_response.status_code == 404
+
+
+def test_collection_etag_and_not_modified():
+    """
+    Test that list endpoints return an ETag and answer 304 while nothing changed.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    first = client.get("/users")
+    etag = first.headers["etag"]
+    assert first.json()[0]["username"] == "alice123"
+
+    cached = client.get("/users", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["etag"] == etag
+
+    client.put("/users/alice123", json={"phone": "555-0000"})
+    changed = client.get("/users", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert changed.json()[0]["phone"] == "555-0000"
+
+
+def test_nested_change_invalidates_parent_collections():
+    """
+    Test that updating a device changes the ETag of every collection that embeds it.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    client.post("/rooms", json={
+        "name": "Living Room",
+        "floor": 1,
+        "size": 300,
+        "house_name": "Beach House",
+        "room_type": "Common"
+    })
+    client.post("/devices", json={
+        "device_type": "light",
+        "name": "Lamp",
+        "status": "on",
+        "room_name": "Living Room"
+    })
+    users_etag = client.get("/users").headers["etag"]
+    devices_etag = client.get("/devices").headers["etag"]
+
+    client.put("/devices/Lamp", json={"status": "off"})
+
+    users = client.get("/users", headers={"If-None-Match": users_etag})
+    assert users.status_code == 200
+    assert users.json()[0]["houses"][0]["rooms"][0]["devices"][0]["status"] == "off"
+    devices = client.get("/devices", headers={"If-None-Match": devices_etag})
+    assert devices.status_code == 200
+
+
+def test_cursor_pagination_and_projection():
+    """
+    Test paging through /users with limit/cursor and trimming the payload with fields/depth.
+    """
+    for i in range(5):
+        client.post("/users", json={
+            "name": f"User {i}",
+            "username": f"user{i}",
+            "phone": "555-0000",
+            "privileges": "user",
+            "email": f"user{i}@mail.com"
+        })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "user0"
+    })
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2, "fields": "id,username"}
+        if cursor is not None:
+            params["cursor"] = cursor
+        response = client.get("/users", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert all(set(user) == {"id", "username"} for user in page)
+        seen.extend(user["username"] for user in page)
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            break
+    assert seen == [f"user{i}" for i in range(5)]
+
+    shallow = client.get("/users", params={"depth": 0, "limit": 1}).json()
+    assert "houses" not in shallow[0]
+    one_level = client.get("/users", params={"depth": 1, "limit": 1}).json()
+    assert one_level[0]["houses"][0]["name"] == "Beach House"
+    assert "rooms" not in one_level[0]["houses"][0]
+
+    assert client.get("/users", params={"fields": "password"}).status_code == 400
+
+
+def test_export_streams_ndjson():
+    """
+    Test that GET /export streams one flat record per entity, parents before children.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    client.post("/rooms", json={
+        "name": "Living Room",
+        "floor": 1,
+        "size": 300,
+        "house_name": "Beach House",
+        "room_type": "Common"
+    })
+    client.post("/devices", json={
+        "device_type": "light",
+        "name": "Lamp",
+        "status": "on",
+        "room_name": "Living Room"
+    })
+    response = client.get("/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    records = [json.loads(line) for line in response.text.splitlines()]
+    # Ignore anything left behind by other test modules.
+    ours = {"alice123", "Beach House", "Living Room", "Lamp"}
+    records = [r for r in records if r.get("username", r["name"]) in ours]
+    assert [record["type"] for record in records] == ["user", "house", "room", "device"]
+    assert records[1]["parent"] == records[0]["id"]
+    assert records[3]["parent"] == records[2]["id"]
+    assert records[3]["name"] == "Lamp"
+    assert "rooms" not in records[1]
+
+
+def test_device_batch_create_update_delete():
+    """
+    Test the /devices:batch endpoints, including per-item errors and atomic mode.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    client.post("/rooms:batch", json={"items": [
+        {"name": "Living Room", "floor": 1, "size": 300, "house_name": "Beach House", "room_type": "Common"},
+        {"name": "Kitchen", "floor": 1, "size": 150, "house_name": "Beach House", "room_type": "Common"},
+    ]})
+
+    response = client.post("/devices:batch", json={"items": [
+        {"device_type": "light", "name": "Lamp 1", "status": "on", "room_name": "Living Room"},
+        {"device_type": "light", "name": "Lamp 2", "status": "on", "room_name": "Kitchen"},
+        {"device_type": "light", "name": "Lamp 1", "status": "on", "room_name": "Living Room"},
+        {"device_type": "light", "name": "Lamp 3", "status": "on", "room_name": "Garage"},
+    ]})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["applied"] is True
+    assert [r["status"] for r in body["results"]] == [200, 200, 400, 404]
+    assert client.get("/devices/Lamp 2").json()["status"] == "on"
+
+    response = client.patch("/devices:batch", json={"items": [
+        {"device_name": "Lamp 1", "status": "off"},
+        {"device_name": "Lamp 2", "status": "off", "room_name": "Living Room"},
+    ]})
+    assert [r["status"] for r in response.json()["results"]] == [200, 200]
+    room = client.get("/rooms/Living Room").json()
+    assert sorted(d["name"] for d in room["devices"]) == ["Lamp 1", "Lamp 2"]
+
+    response = client.request("DELETE", "/devices:batch", json={"names": ["Lamp 1", "Missing"], "atomic": True})
+    assert response.status_code == 400
+    assert response.json()["applied"] is False
+    assert [r["status"] for r in response.json()["results"]] == [424, 404]
+    assert client.get("/devices/Lamp 1").status_code == 200
+
+    response = client.request("DELETE", "/devices:batch", json={"names": ["Lamp 1", "Lamp 2"]})
+    assert response.json()["applied"] is True
+    assert client.get("/devices/Lamp 1").status_code == 404
+
+
+def test_telemetry_ingest_and_query():
+    """
+    Test posting readings to a device and reading them back raw and downsampled.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    client.post("/rooms", json={
+        "name": "Living Room",
+        "floor": 1,
+        "size": 300,
+        "house_name": "Beach House",
+        "room_type": "Common"
+    })
+    client.post("/devices", json={
+        "device_type": "thermostat",
+        "name": "Nest Thermostat",
+        "status": "on",
+        "room_name": "Living Room"
+    })
+    samples = [{"metric": "temperature", "ts": t, "value": 20 + t} for t in range(0, 120, 10)]
+    response = client.post("/devices/Nest Thermostat/telemetry", json={"samples": samples})
+    assert response.json() == {"accepted": 12, "rejected": 0}
+
+    metrics = client.get("/devices/Nest Thermostat/telemetry").json()
+    assert metrics["metrics"] == ["temperature"]
+    raw = client.get("/devices/Nest Thermostat/telemetry",
+                     params={"metric": "temperature", "start": 30, "end": 50}).json()
+    assert [s["value"] for s in raw["samples"]] == [50, 60, 70]
+    buckets = client.get("/devices/Nest Thermostat/telemetry",
+                         params={"metric": "temperature", "bucket": 60}).json()["buckets"]
+    assert [(b["start"], b["min"], b["max"], b["mean"]) for b in buckets] == [(0, 20, 70, 45), (60, 80, 130, 105)]
+
+
+def test_bulk_telemetry_ingest_updates_device_data():
+    """
+    Test the columnar /telemetry endpoint: history is stored and data keeps the newest value.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    client.post("/rooms", json={
+        "name": "Living Room",
+        "floor": 1,
+        "size": 300,
+        "house_name": "Beach House",
+        "room_type": "Common"
+    })
+    for name in ("Sensor A", "Sensor B"):
+        client.post("/devices", json={
+            "device_type": "sensor",
+            "name": name,
+            "data": {"firmware": "1.0"},
+            "status": "on",
+            "room_name": "Living Room"
+        })
+    response = client.post("/telemetry", json={
+        "device": ["Sensor A", "Sensor B", "Sensor A", "Ghost", "Sensor A"],
+        "metric": ["temperature", "temperature", "temperature", "temperature", "humidity"],
+        "ts": [1, 1, 2, 2, 2],
+        "value": [20.0, 18.0, 21.0, 0.0, 40.0],
+    })
+    assert response.status_code == 200
+    assert response.json() == {"accepted": 4, "rejected": 1, "unknown_devices": ["Ghost"]}
+    assert client.get("/devices/Sensor A").json()["data"] == {"firmware": "1.0", "temperature": 21.0, "humidity": 40.0}
+    history = client.get("/devices/Sensor A/telemetry", params={"metric": "temperature"}).json()
+    assert [s["value"] for s in history["samples"]] == [20.0, 21.0]
+
+    bad = client.post("/telemetry", json={"device": ["Sensor A"], "metric": [], "ts": [], "value": []})
+    assert bad.status_code == 400
+    bad = client.post("/telemetry", json={"device": "DD", "metric": "tt", "ts": [1, 2], "value": [1, 2]})
+    assert bad.status_code == 400
+    overflow = client.post(
+        "/telemetry",
+        content='{"device": ["Sensor A", "Sensor A"], "metric": ["t", "t"], "ts": [3, 4], "value": [1e400, NaN]}',
+        headers={"Content-Type": "application/json"},
+    )
+    assert overflow.json() == {"accepted": 0, "rejected": 2, "unknown_devices": []}
+    assert "t" not in client.get("/devices/Sensor A").json()["data"]
+    assert client.get("/users").status_code == 200
+    single = client.post(
+        "/devices/Sensor A/telemetry",
+        content='{"samples": [{"metric": "t", "ts": 5, "value": 1e400}]}',
+        headers={"Content-Type": "application/json"},
+    )
+    assert single.status_code == 422
+
+
+def test_change_feed_websocket_pushes_scoped_updates():
+    """
+    Test that /changes/ws pushes updates for the subscribed room only.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    for room in ("Living Room", "Garage"):
+        client.post("/rooms", json={
+            "name": room,
+            "floor": 1,
+            "size": 300,
+            "house_name": "Beach House",
+            "room_type": "Common"
+        })
+    for name, room in (("Lamp", "Living Room"), ("Opener", "Garage")):
+        client.post("/devices", json={
+            "device_type": "light",
+            "name": name,
+            "status": "off",
+            "room_name": room
+        })
+    with client.websocket_connect("/changes/ws?room=Living Room") as websocket:
+        client.put("/devices/Opener", json={"status": "on"})
+        client.put("/devices/Lamp", json={"status": "on"})
+        event = websocket.receive_json()
+    assert (event["op"], event["type"], event["changes"]) == ("update", "Device", {"status": "on"})
+    assert client.get("/devices/Lamp").json()["status"] == "on"
+
+    assert client.get("/changes/sse", params={"room": "Attic"}).status_code == 404
+
+
+def test_if_match_rejects_stale_writes():
+    """
+    Test optimistic concurrency: PUT/DELETE with an outdated ETag get 412.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    etag = client.get("/users/alice123").headers["ETag"]
+    first = client.put("/users/alice123", json={"phone": "555-0000"}, headers={"If-Match": etag})
+    assert first.status_code == 200
+    assert first.headers["ETag"] != etag
+    stale = client.put("/users/alice123", json={"phone": "555-1111"}, headers={"If-Match": etag})
+    assert stale.status_code == 412
+    assert client.get("/users/alice123").json()["phone"] == "555-0000"
+    assert client.delete("/users/alice123", headers={"If-Match": etag}).status_code == 412
+    assert client.delete("/users/alice123", headers={"If-Match": first.headers["ETag"]}).status_code == 200
+
+
+def test_etag_changes_with_embedded_children():
+    """
+    Test that a house's and its owner's ETags change when a room is added or renamed.
+    """
+    client.post("/users", json={"name": "Alice", "username": "alice123", "phone": "", "privileges": "user", "email": ""})
+    client.post("/houses", json={"name": "Beach House", "address": "", "gps": "", "owner_username": "alice123"})
+    user_etag = client.get("/users/alice123").headers["ETag"]
+    house_etag = client.get("/houses/Beach House").headers["ETag"]
+    client.post("/rooms", json={
+        "name": "Kitchen", "floor": 1, "size": 100, "house_name": "Beach House", "room_type": "Common"
+    })
+    house = client.get("/houses/Beach House")
+    assert [room["name"] for room in house.json()["rooms"]] == ["Kitchen"]
+    assert house.headers["ETag"] != house_etag
+    assert client.get("/users/alice123").headers["ETag"] != user_etag
+    stale = client.put("/houses/Beach House", json={"address": "1 Shore Rd"}, headers={"If-Match": house_etag})
+    assert stale.status_code == 412
+
+    house_etag = house.headers["ETag"]
+    client.put("/rooms/Kitchen", json={"name": "Galley"})
+    assert client.get("/houses/Beach House").headers["ETag"] != house_etag
+
+
+def test_concurrent_creates_with_the_same_name_admit_one():
+    """
+    Test that parallel requests can't both pass the duplicate-name check.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def create(_):
+        return client.post("/users", json={
+            "name": "Racer",
+            "username": "racer",
+            "phone": "",
+            "privileges": "user",
+            "email": ""
+        }).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(pool.map(create, range(32)))
+    assert statuses.count(200) == 1
+    assert len([user for user in client.get("/users").json() if user["username"] == "racer"]) == 1
+
+
+def test_routes_run_on_the_event_loop_and_wait_for_the_model_lock():
+    """
+    Test that no route goes through the threadpool, and that a request
+    waits while a thread holds the model lock.
+    """
+    import inspect
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi.routing import APIRoute
+    from smarthome import lock as model_lock
+
+    for route in app.routes:
+        if isinstance(route, APIRoute):
+            assert inspect.iscoroutinefunction(route.endpoint), route.path
+            for dependency in route.dependant.dependencies:
+                assert inspect.iscoroutinefunction(dependency.call), route.path
+
+    held, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with model_lock:
+            held.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    held.wait()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(client.get, "/users")
+        assert not release.wait(0.05) and not pending.done()
+        release.set()
+        assert pending.result(timeout=5).status_code == 200
+    holder.join()
+
+
+def test_list_filters_devices_and_rooms():
+    """
+    Test server-side filters on /devices and /rooms, with paging.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    for house in ("Beach House", "City Flat"):
+        client.post("/houses", json={
+            "name": house,
+            "address": "",
+            "gps": "",
+            "owner_username": "alice123"
+        })
+        client.post("/rooms", json={
+            "name": f"{house} Hall",
+            "floor": 1 if house == "City Flat" else 0,
+            "size": 10,
+            "house_name": house,
+            "room_type": "Common"
+        })
+        for i in range(3):
+            client.post("/devices", json={
+                "device_type": "thermostat" if i else "light",
+                "name": f"{house} Device {i}",
+                "status": "offline" if i == 2 else "on",
+                "room_name": f"{house} Hall"
+            })
+
+    def names(path, **params):
+        return [entity["name"] for entity in client.get(path, params=params).json()]
+
+    assert names("/devices", device_type="thermostat", status="offline", house="Beach House") == [
+        "Beach House Device 2"
+    ]
+    assert names("/devices", status="offline") == ["Beach House Device 2", "City Flat Device 2"]
+    assert names("/devices", house="Nowhere") == []
+    assert names("/rooms", floor=1, owner="alice123") == ["City Flat Hall"]
+
+    first = client.get("/devices", params={"device_type": "thermostat", "limit": 3})
+    assert len(first.json()) == 3
+    rest = client.get("/devices", params={"device_type": "thermostat", "cursor": first.headers["X-Next-Cursor"]})
+    assert [d["name"] for d in rest.json()] == ["City Flat Device 2"]
+    assert "X-Next-Cursor" not in rest.headers
+
+
+def test_nested_child_routes_page_through_children():
+    """
+    Test /users/{u}/houses, /houses/{h}/rooms, /houses/{h}/devices and /rooms/{r}/devices.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    for room in ("Kitchen", "Garage"):
+        client.post("/rooms", json={
+            "name": room,
+            "floor": 1,
+            "size": 100,
+            "house_name": "Beach House",
+            "room_type": "Common"
+        })
+        for i in range(2):
+            client.post("/devices", json={
+                "device_type": "light",
+                "name": f"{room} Light {i}",
+                "status": "off",
+                "room_name": room
+            })
+
+    houses = client.get("/users/alice123/houses", params={"depth": 0}).json()
+    assert houses == [{
+        "id": houses[0]["id"], "name": "Beach House", "address": "123 Ocean Drive", "gps": "25.774, -80.196", "owner": "alice123"
+    }]
+    assert [r["name"] for r in client.get("/houses/Beach House/rooms", params={"fields": "name"}).json()] == [
+        "Kitchen", "Garage"
+    ]
+    assert [d["name"] for d in client.get("/rooms/Garage/devices").json()] == ["Garage Light 0", "Garage Light 1"]
+
+    first = client.get("/houses/Beach House/devices", params={"limit": 3})
+    assert [d["name"] for d in first.json()] == ["Kitchen Light 0", "Kitchen Light 1", "Garage Light 0"]
+    rest = client.get("/houses/Beach House/devices", params={"cursor": first.headers["X-Next-Cursor"]})
+    assert [d["name"] for d in rest.json()] == ["Garage Light 1"]
+
+    assert client.get("/rooms/Attic/devices").status_code == 404
+
+    client.post("/houses", json={"name": "Cabin", "address": "", "gps": "", "owner_username": "alice123"})
+    assert "rooms_by_house" not in client.get("/stats").json()
+    first = client.get("/stats/houses", params={"limit": 1})
+    assert first.json() == {"Beach House": 2}
+    rest = client.get("/stats/houses", params={"cursor": first.headers["X-Next-Cursor"]})
+    assert rest.json() == {"Cabin": 0} and "X-Next-Cursor" not in rest.headers
+    assert client.get("/stats/users").json() == {"alice123": 2}
+
+
+def test_room_and_device_names_repeat_across_parents():
+    """
+    Test that room names are unique per house and device names per room, with
+    ``?house=``/``?room=`` or ``id:<n>`` picking between entities sharing a name.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    for house in ("Beach House", "City Flat"):
+        client.post("/houses", json={
+            "name": house,
+            "address": "123 Ocean Drive",
+            "gps": "25.774, -80.196",
+            "owner_username": "alice123"
+        })
+        response = client.post("/rooms", json={
+            "name": "Kitchen",
+            "floor": 1,
+            "size": 100,
+            "house_name": house,
+            "room_type": "Common"
+        })
+        assert response.status_code == 200
+        response = client.post("/devices", json={
+            "device_type": "light",
+            "name": "Lamp",
+            "status": "off",
+            "room_name": "Kitchen",
+            "house_name": house
+        })
+        assert response.status_code == 200
+    assert client.post("/rooms", json={
+        "name": "Kitchen", "floor": 2, "size": 10, "house_name": "City Flat", "room_type": "Common"
+    }).status_code == 400
+
+    assert client.get("/rooms/Kitchen").status_code == 409
+    assert client.get("/devices/Lamp").status_code == 409
+    kitchen = client.get("/rooms/Kitchen", params={"house": "City Flat"}).json()
+    assert kitchen["house"] == "City Flat"
+    assert client.get(f"/rooms/id:{kitchen['id']}").json() == kitchen
+
+    response = client.put(
+        "/devices/Lamp", params={"room": "Kitchen", "house": "City Flat"}, json={"status": "on"}
+    )
+    assert response.status_code == 200
+    lamp = response.json()
+    assert client.get("/devices/Lamp", params={"house": "Beach House"}).json()["status"] == "off"
+    assert client.get(f"/devices/id:{lamp['id']}").json()["status"] == "on"
+
+    assert client.delete("/rooms/Kitchen", params={"house": "Beach House"}).status_code == 200
+    assert client.get("/devices/Lamp").json()["id"] == lamp["id"]
+
+
+def test_names_that_read_as_id_references_are_refused():
+    """
+    Test that ``id:<n>`` names, which lookups would treat as ids, can't be created or renamed to.
+    """
+    user = {"name": "Alice", "phone": "", "privileges": "user", "email": ""}
+    house = {"address": "", "gps": "", "owner_username": "alice123"}
+    room = {"floor": 1, "size": 100, "house_name": "Beach House", "room_type": "Common"}
+    device = {"device_type": "light", "status": "off", "room_name": "Kitchen"}
+
+    assert client.post("/users", json={**user, "username": "id:99"}).status_code == 400
+    client.post("/users", json={**user, "username": "alice123"})
+    assert client.put("/users/alice123", json={"username": "id:7"}).status_code == 400
+    assert client.post("/houses", json={**house, "name": "id:1"}).status_code == 400
+    client.post("/houses", json={**house, "name": "Beach House"})
+    assert client.put("/houses/Beach House", json={"name": "id:2"}).status_code == 400
+    assert client.post("/rooms", json={**room, "name": "id:3"}).status_code == 400
+    client.post("/rooms", json={**room, "name": "Kitchen"})
+    assert client.put("/rooms/Kitchen", json={"name": "id:4"}).status_code == 400
+    assert client.post("/devices", json={**device, "name": "id:5"}).status_code == 400
+    client.post("/devices", json={**device, "name": "Lamp"})
+    assert client.put("/devices/Lamp", json={"name": "id:6"}).status_code == 400
+    assert client.patch("/devices/Lamp", json={"name": "id:6"}).status_code == 400
+    batch = client.post("/devices:batch", json={"items": [{**device, "name": "id:8"}]})
+    assert batch.json()["results"][0]["status"] == 400
+    # Names that only start like one are fine.
+    assert client.put("/devices/Lamp", json={"name": "id:lamp"}).status_code == 200
+    assert client.get("/devices/id:lamp").json()["name"] == "id:lamp"
+
+
+def test_list_houses_near_a_point_or_in_a_box():
+    """
+    Test GET /houses?near=lat,lon&radius_km= and ?bbox=south,west,north,east.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    for name, gps in (
+        ("Manhattan", "40.7128° N, 74.0060° W"),
+        ("Brooklyn", "40.6782, -73.9442"),
+        ("London", "51.5074° N, 0.1278° W"),
+    ):
+        client.post("/houses", json={"name": name, "address": "", "gps": gps, "owner_username": "alice123"})
+
+    response = client.get("/houses", params={"near": "40.7,-74.0", "radius_km": 10, "fields": "name"})
+    assert response.json() == [{"name": "Manhattan"}, {"name": "Brooklyn"}]
+    response = client.get("/houses", params={"bbox": "40,-75,52,0", "limit": 2})
+    assert [h["name"] for h in response.json()] == ["Manhattan", "Brooklyn"]
+    rest = client.get("/houses", params={"bbox": "40,-75,52,0", "cursor": response.headers["X-Next-Cursor"]})
+    assert [h["name"] for h in rest.json()] == ["London"]
+    both = client.get("/houses", params={"near": "40.7,-74.0", "radius_km": 10, "bbox": "40.7,-75,41,-73"})
+    assert [h["name"] for h in both.json()] == ["Manhattan"]
+    world = client.get("/houses", params={"bbox": "-90,-180,90,180"})
+    assert [h["name"] for h in world.json()] == ["Manhattan", "Brooklyn", "London"]
+
+    assert client.get("/houses", params={"near": "40.7,-74.0"}).status_code == 400
+    assert client.get("/houses", params={"bbox": "40,-75,52"}).status_code == 400
+    assert client.get("/houses", params={"near": "95,0", "radius_km": 1}).status_code == 400
+
+
+def test_schedules_and_rules_change_devices():
+    """
+    Test /schedules (applied by the scheduler) and /rules (fired by incoming data).
+    """
+    from smarthome_api import scheduler
+
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    client.post("/rooms", json={
+        "name": "Living Room", "floor": 1, "size": 300, "house_name": "Beach House", "room_type": "Common"
+    })
+    for name, device_type in (("Thermostat", "thermostat"), ("Lamp", "light")):
+        client.post("/devices", json={
+            "device_type": device_type, "name": name, "status": "on", "room_name": "Living Room"
+        })
+
+    job = client.post("/schedules", json={"device_name": "Lamp", "at": 1000, "every": 60, "status": "off"}).json()
+    assert job["device"] == "Lamp" and job["due"] == 1000
+    assert client.post("/schedules", json={"device_name": "Lamp", "status": "off"}).status_code == 400
+    assert client.post("/schedules", json={"device_name": "Ghost", "at": 0, "status": "off"}).status_code == 404
+    for body in ('{"device_name": "Lamp", "at": NaN, "status": "off"}',
+                 '{"device_name": "Lamp", "in_seconds": Infinity, "status": "off"}',
+                 '{"device_name": "Lamp", "at": 1000, "every": 1e400, "status": "off"}'):
+        assert client.post("/schedules", content=body, headers={"Content-Type": "application/json"}).status_code == 422
+    scheduler.run_due(now=1000)
+    assert client.get("/devices/Lamp").json()["status"] == "off"
+    assert client.get("/schedules").json()[0]["due"] == 1060
+    assert client.delete(f"/schedules/{job['id']}").status_code == 200
+    assert client.get("/schedules").json() == []
+
+    rule = client.post("/rules", json={
+        "device_name": "Thermostat", "field": "temperature", "op": ">", "value": 26,
+        "target_name": "Lamp", "status": "fan"
+    })
+    assert rule.status_code == 200
+    assert client.post("/rules", json={
+        "device_name": "Thermostat", "field": "temperature", "op": "~", "value": 1, "status": "x"
+    }).status_code == 400
+    for value in ("NaN", "-Infinity", "1e400"):
+        body = '{"device_name": "Thermostat", "field": "temperature", "op": ">", "value": %s, "status": "x"}' % value
+        assert client.post("/rules", content=body, headers={"Content-Type": "application/json"}).status_code == 400
+    client.put("/devices/Thermostat", json={"data": {"temperature": 28}})
+    assert client.get("/devices/Lamp").json()["status"] == "fan"
+    assert client.get("/rules").json()[0]["active"] is True
+    assert client.delete(f"/rules/{rule.json()['id']}").status_code == 200
+    assert client.get("/rules").json() == []
+
+    # A target name used in two rooms needs a scope.
+    client.post("/rooms", json={
+        "name": "Porch", "floor": 0, "size": 20, "house_name": "Beach House", "room_type": "Outdoor"
+    })
+    client.post("/devices", json={"device_type": "light", "name": "Lamp", "status": "on", "room_name": "Porch"})
+    rule = {"device_name": "Thermostat", "field": "temperature", "op": "<", "value": 10, "target_name": "Lamp", "status": "off"}
+    assert client.post("/rules", json=rule).status_code == 409
+    scoped = client.post("/rules", json={**rule, "target_room_name": "Porch", "target_house_name": "Beach House"})
+    assert scoped.status_code == 200
+    assert scoped.json()["target_id"] == client.get("/devices/Lamp", params={"room": "Porch"}).json()["id"]
+    assert client.post("/rules", json={**rule, "target_room_name": "Attic"}).status_code == 404
+
+
+def test_scene_commands_fan_out_over_a_house_or_room():
+    """
+    Test POST /houses/{h}/command and /rooms/{r}/command.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    for room in ("Kitchen", "Bedroom"):
+        client.post("/rooms", json={
+            "name": room, "floor": 1, "size": 100, "house_name": "Beach House", "room_type": "Common"
+        })
+        for device_type in ("light", "light", "thermostat"):
+            client.post("/devices:batch", json={"items": [{
+                "device_type": device_type,
+                "name": f"{room} {device_type} {i}",
+                "status": "on",
+                "settings": {"brightness": 100},
+                "room_name": room,
+            } for i in range(2)]})
+
+    response = client.post("/houses/Beach House/command", json={"device_type": "light", "status": "off"})
+    assert response.json() == {"matched": 4, "changed": 4}
+    statuses = {d["name"]: d["status"] for d in client.get("/devices").json()}
+    assert statuses["Kitchen light 0"] == "off" and statuses["Bedroom thermostat 1"] == "on"
+
+    response = client.post("/rooms/Kitchen/command", json={"settings": {"brightness": 30}, "status": "off"})
+    assert response.json() == {"matched": 4, "changed": 4}
+    kitchen = client.get("/devices", params={"room": "Kitchen", "device_type": "thermostat"}).json()
+    assert [d["settings"] for d in kitchen] == [{"brightness": 30}] * 2
+    assert client.post("/rooms/Kitchen/command", json={"status": "off"}).json() == {"matched": 4, "changed": 0}
+
+    assert client.post("/rooms/Kitchen/command", json={"device_type": "light"}).status_code == 400
+    assert client.post("/houses/Nowhere/command", json={"status": "off"}).status_code == 404
+
+
+def test_patch_device_with_merge_patch_and_json_patch():
+    """
+    Test PATCH /devices/{device_name} with both patch formats.
+    """
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    client.post("/rooms", json={"name": "Hall", "floor": 1, "size": 10, "house_name": "Beach House", "room_type": "Common"})
+    client.post("/devices", json={
+        "device_type": "thermostat",
+        "name": "Thermostat",
+        "room_name": "Hall",
+        "settings": {"mode": "heat", "schedule": {"day": 21, "night": 17}},
+        "data": {"temperature": 19.5},
+        "status": "on",
+    })
+    client.post("/devices", json={"device_type": "light", "name": "Lamp", "room_name": "Hall", "status": "off"})
+
+    response = client.patch(
+        "/devices/Thermostat",
+        content=json.dumps({"settings": {"schedule": {"night": 16}, "mode": None}, "status": "eco"}),
+        headers={"Content-Type": "application/merge-patch+json"},
+    )
+    assert response.status_code == 200
+    device = response.json()
+    assert device["settings"] == {"schedule": {"day": 21, "night": 16}}
+    assert device["data"] == {"temperature": 19.5} and device["status"] == "eco"
+    etag = response.headers["ETag"]
+
+    response = client.patch(
+        "/devices/Thermostat",
+        content=json.dumps([
+            {"op": "test", "path": "/status", "value": "eco"},
+            {"op": "add", "path": "/settings/schedule/away", "value": 12},
+            {"op": "remove", "path": "/data/temperature"},
+            {"op": "replace", "path": "/name", "value": "Hall Thermostat"},
+        ]),
+        headers={"Content-Type": "application/json-patch+json", "If-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.json()["settings"] == {"schedule": {"day": 21, "night": 16, "away": 12}}
+    assert response.json()["data"] == {}
+    assert client.get("/devices/Hall Thermostat").json() == response.json()
+
+    # A stale ETag, a failed test op, a clashing name and unknown fields are all refused.
+    assert client.patch("/devices/Hall Thermostat", json={"status": "off"}, headers={"If-Match": etag}).status_code == 412
+    failed_test = [{"op": "test", "path": "/status", "value": "off"}]
+    assert client.patch(
+        "/devices/Hall Thermostat", content=json.dumps(failed_test), headers={"Content-Type": "application/json-patch+json"}
+    ).status_code == 409
+    assert client.patch("/devices/Hall Thermostat", json={"name": "Lamp"}).status_code == 400
+    assert client.patch("/devices/Hall Thermostat", json={"id": 5}).status_code == 400
+    assert client.patch("/devices/Hall Thermostat", json={"settings": 5}).status_code == 400
+    assert client.patch("/devices/Nowhere", json={"status": "off"}).status_code == 404
+    assert client.get("/devices/Hall Thermostat").json()["status"] == "eco"
+
+    # Malformed patches are 400; a missing target path (like a failed test) is 409.
+    json_patch_type = {"Content-Type": "application/json-patch+json"}
+    for body, status in (
+        ({"op": "remove", "path": "/status"}, 400),
+        ([{"path": "/status"}], 400),
+        ([{"op": "frobnicate", "path": "/status"}], 400),
+        ([{"op": "remove", "path": "/settings/x~"}], 400),
+        ([{"op": "remove", "path": "/settings/nope"}], 409),
+    ):
+        response = client.patch("/devices/Hall Thermostat", content=json.dumps(body), headers=json_patch_type)
+        assert response.status_code == status, body
+    for body in ('{"data": {"temperature": NaN}}', '{"data": {"temperature": -Infinity}}', '{"data": {"t": 1e400}}'):
+        assert client.patch("/devices/Hall Thermostat", content=body).status_code == 400
+    assert client.get("/devices/Hall Thermostat").json()["data"] == {}
+
+
+def test_typed_response_schemas_describe_what_routes_return():
+    """
+    Test that the OpenAPI schema names the entity schemas and that real
+    responses (encoded without validation) conform to them.
+    """
+    from pydantic import TypeAdapter
+    from smarthome_api import DeviceOut, HouseOut, UserOut
+
+    client.post("/users", json={
+        "name": "Alice",
+        "username": "alice123",
+        "phone": "555-9999",
+        "privileges": "user",
+        "email": "alice@mail.com"
+    })
+    client.post("/houses", json={
+        "name": "Beach House",
+        "address": "123 Ocean Drive",
+        "gps": "25.774, -80.196",
+        "owner_username": "alice123"
+    })
+    client.post("/rooms", json={"name": "Hall", "floor": 1, "size": 10, "house_name": "Beach House", "room_type": "Common"})
+    created = client.post("/devices", json={
+        "device_type": "sensor", "name": "Sensor", "room_name": "Hall", "status": "on", "data": {"t": 1.5}
+    })
+    assert created.headers["content-type"] == "application/json"
+    DeviceOut.model_validate(created.json())
+
+    paths = client.get("/openapi.json").json()["paths"]
+    schema = paths["/users/{username}"]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+    assert schema == {"$ref": "#/components/schemas/UserOut"}
+
+    user = client.get("/users/alice123")
+    assert "ETag" in user.headers
+    assert UserOut.model_validate(user.json()).houses[0].rooms[0].devices[0].data == {"t": 1.5}
+    TypeAdapter(list[HouseOut]).validate_python(client.get("/houses").json())
+    TypeAdapter(list[DeviceOut]).validate_python(client.get("/houses/Beach House/devices").json())
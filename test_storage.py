@@ -0,0 +1,116 @@
+import os
+
+import pytest
+from smarthome import User, House, Room, Device
+from storage import FileStorage
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    """Ensure each test starts with a fresh state"""
+    User.users.clear()
+    House.houses.clear()
+    Room.rooms.clear()
+    Device.devices.clear()
+
+
+def build_home():
+    user = User(name="Alice", username="alice123", phone="555-1234", privileges="admin", email="alice@mail.com")
+    house = House(name="Alice's House", address="123 Main St", gps="40.7128° N, 74.0060° W", owner=user)
+    room = Room(name="Living Room", floor=1, size=200, house=house, room_type="Common Area")
+    Room(name="Kitchen", floor=1, size=120, house=house, room_type="Kitchen")
+    device = Device(device_type="thermostat", name="Nest Thermostat", room=room,
+                    settings={"temperature": 72}, status="active")
+    return user, house, room, device
+
+
+def restart(storage, **kwargs):
+    storage.close()
+    User.users.clear()
+    House.houses.clear()
+    Room.rooms.clear()
+    Device.devices.clear()
+    reopened = FileStorage(storage.directory, **kwargs)
+    reopened.open()
+    return reopened
+
+
+def test_wal_replay_restores_state(tmp_path):
+    storage = FileStorage(str(tmp_path))
+    storage.open()
+    user, house, room, device = build_home()
+    kitchen = Room.rooms.get("Kitchen")
+    device.update("thermostat", "Hall Thermostat", kitchen, {"temperature": 68}, {}, "idle")
+    room.delete()
+    expected = user.to_dict()
+    expected_ids = (user.id, house.id, kitchen.id, device.id)
+
+    storage = restart(storage)
+    restored = User.users.get("alice123")
+    assert restored.to_dict() == expected
+    restored_device = Device.devices.get("Hall Thermostat")
+    assert (restored.id, restored.houses[0].id, restored_device.room.id, restored_device.id) == expected_ids
+    assert Room.rooms.get("Living Room") is None
+    # New entities keep getting fresh ids after recovery.
+    assert Device(name="New Plug", room=restored_device.room).id > restored_device.id
+    storage.close()
+
+
+def test_snapshot_compacts_log(tmp_path):
+    storage = FileStorage(str(tmp_path), snapshot_every=3)
+    storage.open()
+    user, house, room, device = build_home()
+    device.update("thermostat", "Nest Thermostat", room, {"temperature": 70}, {}, "active")
+    expected = user.to_dict()
+    # Nothing touches the files until the flush, which also takes the snapshot.
+    assert os.path.getsize(storage.wal_path) == 0 and not os.path.exists(storage.snapshot_path)
+    storage.flush()
+    assert os.path.exists(storage.snapshot_path)
+    with open(storage.wal_path) as wal:
+        assert len(wal.readlines()) < 6
+
+    storage = restart(storage, snapshot_every=3)
+    assert User.users.get("alice123").to_dict() == expected
+    storage.close()
+
+
+def test_torn_final_line_is_ignored(tmp_path):
+    storage = FileStorage(str(tmp_path))
+    storage.open()
+    build_home()
+    storage.flush()
+    with open(storage.wal_path, "a") as wal:
+        wal.write('{"seq": 99, "op": "dele')
+    storage = restart(storage)
+    assert Device.devices.get("Nest Thermostat") is not None
+    Device.devices.get("Nest Thermostat").delete()
+    storage = restart(storage)
+    assert Device.devices.get("Nest Thermostat") is None
+    storage.close()
+
+
+def test_patches_are_stored_as_merge_patches(tmp_path):
+    def open_storage():
+        storage = FileStorage(str(tmp_path))
+        storage.open()
+        return storage
+
+    storage = open_storage()
+    user, house, room, device = build_home()
+    device.merge(settings={"schedule": {"day": 21, "night": 17}})
+    device.merge(settings={"schedule": {"night": 16}, "temperature": None}, data={"reading": 70.5})
+    expected = device.to_dict()
+    storage.flush()
+    with open(storage.wal_path) as wal:
+        assert wal.readlines()[-1].endswith(
+            '"fields":{"settings":{"schedule":{"night":16},"temperature":null},"data":{"reading":70.5}}}\n'
+        )
+    storage.close()
+
+    User.users.clear()
+    House.houses.clear()
+    Room.rooms.clear()
+    Device.devices.clear()
+    storage = open_storage()
+    assert Device.devices.get("Nest Thermostat").to_dict() == expected
+    storage.close()
@@ -0,0 +1,86 @@
+import pytest
+from smarthome import User, House, Room, Device, listeners
+from telemetry import Ingestor, Series, TelemetryStore, downsample
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    """Ensure each test starts with a fresh state"""
+    User.users.clear()
+    House.houses.clear()
+    Room.rooms.clear()
+    Device.devices.clear()
+
+
+def test_series_wraps_and_stays_sorted():
+    series = Series(capacity=4)
+    for t in range(6):
+        assert series.append(t, t * 10)
+    assert len(series) == 4
+    assert list(series.range()) == [(2, 20), (3, 30), (4, 40), (5, 50)]
+    assert list(series.range(3, 4)) == [(3, 30), (4, 40)]
+    assert series.latest() == (5, 50)
+    assert not series.append(1, 0)
+
+
+def test_downsample_buckets():
+    samples = [(0, 1.0), (5, 3.0), (10, 2.0), (19, 4.0), (20, 5.0)]
+    assert downsample(samples, 10) == [
+        {"start": 0, "count": 2, "min": 1.0, "max": 3.0, "mean": 2.0},
+        {"start": 10, "count": 2, "min": 2.0, "max": 4.0, "mean": 3.0},
+        {"start": 20, "count": 1, "min": 5.0, "max": 5.0, "mean": 5.0},
+    ]
+
+
+def test_store_keys_by_device_and_drops_on_delete():
+    store = TelemetryStore(capacity=100)
+    store.attach()
+    try:
+        device = Device(name="Sensor")
+        store.append(device, "temperature", 1, 20.5)
+        store.append(device, "temperature", 2, 21.5)
+        store.append(device, "power", 2, 300)
+        device.name = "Renamed Sensor"
+        assert store.metrics(device) == ["temperature", "power"]
+        assert store.query(device, "temperature", start=2) == [{"ts": 2.0, "value": 21.5}]
+        assert store.query(device, "temperature", bucket=60)[0]["mean"] == 21.0
+        device.delete()
+        assert store.query(device, "temperature") == []
+    finally:
+        store.detach()
+
+
+def test_ingestor_folds_latest_values_into_device_data():
+    store = TelemetryStore(capacity=100)
+    device = Device(name="Sensor", data={"unit": "C"})
+    updates = []
+    record = lambda op, entity, changes: updates.append(changes)
+    listeners.append(record)
+    ingestor = Ingestor(store, Device.devices.get)
+    accepted, rejected, unknown = ingestor.submit(
+        ["Sensor", "Sensor", "Sensor", "Ghost"],
+        ["temperature", "temperature", "temperature", "temperature"],
+        [1, 3, 2, 1],
+        [20.0, 22.0, 21.0, 0.0],
+    )
+    assert (accepted, rejected, unknown) == (2, 2, ["Ghost"])
+    try:
+        assert ingestor.flush() == 1
+    finally:
+        listeners.remove(record)
+    assert len(updates) == 1
+    assert device.data == {"unit": "C", "temperature": 22.0}
+    assert [s["value"] for s in store.query(device, "temperature")] == [20.0, 22.0]
+    with pytest.raises(ValueError):
+        ingestor.submit(["Sensor"], [], [], [])
+    # Columns must be lists, not strings to iterate character by character.
+    with pytest.raises(ValueError):
+        ingestor.submit("SS", "tt", [5, 6], [1.0, 2.0])
+
+    # Readings that aren't finite numbers never reach the store or Device.data.
+    accepted, rejected, _ = ingestor.submit(
+        ["Sensor"] * 3, ["temperature"] * 3, [4, float("inf"), 5], [float("nan"), 30.0, 1e400]
+    )
+    assert (accepted, rejected) == (0, 3)
+    ingestor.flush()
+    assert device.data == {"unit": "C", "temperature": 22.0}